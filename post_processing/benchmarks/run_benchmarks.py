@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+'''
+benchmark the post-processing stages on synthetic flights
+
+for each flight duration a synthetic flight directory is generated (see
+synthetic.py) and each stage is timed using the real functions from the
+firedrones package. Results are written as JSON so runs can be
+compared before and after a change
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import importlib
+import tempfile
+import traceback
+
+# the firedrones package lives in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from synthetic import SyntheticFlight, THERMAL_DIR, LOG_NAME, SIYI_LOG_NAME, TERRAIN_DIR
+
+class StageSkipped(Exception):
+    '''raised when a stage can't run, eg. a missing dependency'''
+    pass
+
+def import_module(name):
+    '''import a firedrones module, skipping the stage if a dependency is missing'''
+    try:
+        return importlib.import_module('firedrones.' + name)
+    except ImportError as ex:
+        raise StageSkipped("%s: %s" % (name, ex))
+
+class BenchmarkContext(object):
+    '''per-flight state shared between stages'''
+    def __init__(self, flight_dir, flight):
+        self.flight_dir = flight_dir
+        self.flight = flight
+        self.thermal_dir = os.path.join(flight_dir, THERMAL_DIR)
+        self.log = os.path.join(flight_dir, LOG_NAME)
+        self.log_nosiyi = os.path.join(flight_dir, "log_nosiyi.bin")
+        self.siyi_log = os.path.join(flight_dir, SIYI_LOG_NAME)
+        self.terrain_dir = os.path.join(flight_dir, TERRAIN_DIR)
+        self.flight_pos = None
+
+    def get_flight_pos(self):
+        if self.flight_pos is None:
+            flight = import_module('flight')
+            self.flight_pos = flight.get_flight_positions(self.log, time_delta=1.0)
+        return self.flight_pos
+
+    def archive(self):
+        return os.path.join(self.flight_dir, "thermal.fta")
+
+    def evict(self):
+        '''
+        drop the thermal frames and archive from the page cache so they
+        are read from disk, like a flight on slow or networked storage
+        '''
+        from firedrones import archive
+        # pages mapped by an open archive can't be dropped
+        for arc in archive.archives.values():
+            arc.close()
+        archive.archives.clear()
+        files = [os.path.join(self.thermal_dir, f) for f in os.listdir(self.thermal_dir)]
+        for f in files + [self.archive()]:
+            fd = os.open(f, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+    def thermal_files(self):
+        from firedrones.archive import sorted_files
+        return sorted_files(self.thermal_dir)
+
+def prepare(ctx):
+    '''untimed setup: import the modules and create the thermal archive'''
+    from firedrones import archive
+    for name in ['thermal', 'flight', 'mapping', 'logmerge']:
+        try:
+            import_module(name)
+        except StageSkipped:
+            pass
+    if not os.path.exists(ctx.archive()):
+        archive.create_archive(ctx.thermal_dir, ctx.archive())
+
+def stage_frame_loading(ctx):
+    from firedrones import archive
+    count = 0
+    for f in archive.sorted_files(ctx.thermal_dir):
+        if archive.load_thermal_to_temperatures(f) is not None:
+            count += 1
+    return count
+
+def stage_archive_loading(ctx):
+    from firedrones import archive
+    count = 0
+    for f in archive.sorted_files(ctx.archive()):
+        if archive.load_thermal_to_temperatures(f) is not None:
+            count += 1
+    return count
+
+def stage_find_temp_range(ctx):
+    thermal = import_module('thermal')
+    images = ctx.thermal_files()
+    (tmin, tmax) = thermal.find_temp_range(images)
+    return len(images)
+
+def stage_colormap(ctx):
+    thermal = import_module('thermal')
+    try:
+        import matplotlib
+    except ImportError as ex:
+        raise StageSkipped(str(ex))
+    count = 0
+    for f in ctx.thermal_files():
+        if thermal.load_thermal_colormap(f, 0, 188) is not None:
+            count += 1
+    return count
+
+def stage_get_flight_positions(ctx):
+    ctx.flight_pos = None
+    return ctx.get_flight_pos().count()
+
+def stage_frame_catalogue(ctx):
+    catalogue = import_module('catalogue')
+    session = import_module('session').FlightSession(ctx.flight_dir)
+    cat = catalogue.open_catalogue(ctx.thermal_dir, session, rebuild=True)
+    return len(cat.names)
+
+def stage_projection(ctx):
+    flight = import_module('flight')
+    flight_pos = ctx.get_flight_pos()
+    count = 0
+    (w, h) = (flight.thermal_width, flight.thermal_height)
+    corners = [(0, 0), (w, 0), (w, h), (0, h), (w//2, h//2)]
+    for i in range(flight_pos.count()):
+        fpos = flight_pos.get(i)
+        for (x, y) in corners:
+            flight.xy_to_latlon(fpos, x, y)
+            count += 1
+    return count
+
+def stage_terrain_projection(ctx):
+    flight = import_module('flight')
+    terrain = import_module('terrain')
+    if not os.path.isdir(ctx.terrain_dir):
+        raise StageSkipped("no terrain in %s" % ctx.flight_dir)
+    model = terrain.TerrainModel(ctx.terrain_dir)
+    flight_pos = ctx.get_flight_pos()
+    fposes = [flight_pos.get(i) for i in range(flight_pos.count())]
+    # a 40x32 grid over the thermal frame from every flight position
+    (x, y) = np.meshgrid(np.linspace(-1, 1, 40), np.linspace(-1, 1, 32))
+    (lat, lon) = flight.project_pixels(fposes, x.ravel(), y.ravel(), flight.thermal_FOV,
+                                       flight.thermal_width/float(flight.thermal_height), model)
+    return lat.size
+
+def stage_coverage(ctx):
+    coverage = import_module('coverage')
+    flight_pos = ctx.get_flight_pos()
+    grid = coverage.compute_coverage(flight_pos)
+    grid.save(os.path.join(ctx.flight_dir, coverage.COVERAGE_NAME))
+    return flight_pos.count()
+
+class HeatmapSink(object):
+    '''collects heatmap points instead of drawing a map'''
+    def heatmap(self, lats, lons, weights=None):
+        self.count = len(lats)
+
+def stage_heatmap(ctx):
+    mapping = import_module('mapping')
+    images = ctx.thermal_files()
+    mapping.plot_heatmap(HeatmapSink(), images, ctx.get_flight_pos(), min_temp=150.0)
+    return len(images)
+
+def stage_log_merge(ctx):
+    logmerge = import_module('logmerge')
+    out = os.path.join(ctx.flight_dir, "log_merged.bin")
+    logmerge.merge_logs(ctx.log_nosiyi, ctx.siyi_log, out)
+    return os.path.getsize(out)
+
+def stage_log_clip(ctx):
+    clip = import_module('clip')
+    index = clip.LogIndex.build(ctx.log)
+    # a 30 second window from the middle of the flight
+    t0 = index.start_time + 0.5 * ctx.flight.duration
+    return index.slice(ctx.log, os.path.join(ctx.flight_dir, "log_clip.bin"), t0, t0 + 30)
+
+def stage_create_flight_json(ctx):
+    mapping = import_module('mapping')
+    flight_pos = ctx.get_flight_pos()
+    mapping.create_flight_json(flight_pos)
+    return flight_pos.count()
+
+STAGES = [
+    ('frame_loading', stage_frame_loading),
+    ('archive_loading', stage_archive_loading),
+    ('find_temp_range', stage_find_temp_range),
+    ('colormap', stage_colormap),
+    ('get_flight_positions', stage_get_flight_positions),
+    ('frame_catalogue', stage_frame_catalogue),
+    ('projection', stage_projection),
+    ('terrain_projection', stage_terrain_projection),
+    ('coverage', stage_coverage),
+    ('heatmap', stage_heatmap),
+    ('log_merge', stage_log_merge),
+    ('log_clip', stage_log_clip),
+    ('create_flight_json', stage_create_flight_json),
+]
+
+def run_stage(name, func, ctx, repeat, cold=False):
+    '''run a stage repeat times, returning a result dictionary'''
+    ret = { 'stage' : name, 'duration' : ctx.flight.duration }
+    times = []
+    cpu_times = []
+    items = None
+    for i in range(repeat):
+        if cold:
+            ctx.evict()
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        try:
+            items = func(ctx)
+        except StageSkipped as ex:
+            ret['skipped'] = str(ex)
+            return ret
+        except Exception as ex:
+            ret['error'] = traceback.format_exc()
+            return ret
+        times.append(time.perf_counter() - t0)
+        cpu_times.append(time.process_time() - c0)
+    ret['items'] = items
+    ret['times'] = times
+    ret['min'] = min(times)
+    ret['median'] = float(np.median(times))
+    ret['cpu_min'] = min(cpu_times)
+    if items:
+        ret['per_item'] = min(times) / items
+    return ret
+
+def run_benchmarks(durations, stages, repeat, work_dir, frame_rate, log_rate, keep=False, cold=False):
+    results = []
+    for duration in durations:
+        flight_dir = os.path.join(work_dir, "flight_%us" % duration)
+        flight = SyntheticFlight(duration, frame_rate=frame_rate, log_rate=log_rate)
+        if not os.path.exists(flight_dir):
+            print("Generating %us synthetic flight" % duration)
+            flight.write_flight_dir(flight_dir)
+        ctx = BenchmarkContext(flight_dir, flight)
+        prepare(ctx)
+        # stages that write files do so in the flight directory
+        saved_cwd = os.getcwd()
+        os.chdir(flight_dir)
+        try:
+            for (name, func) in STAGES:
+                if stages and not name in stages:
+                    continue
+                r = run_stage(name, func, ctx, repeat, cold=cold)
+                results.append(r)
+                if 'min' in r:
+                    print("%-22s %6us %9.3fs" % (name, duration, r['min']))
+                elif 'skipped' in r:
+                    print("%-22s %6us skipped: %s" % (name, duration, r['skipped']))
+                else:
+                    print("%-22s %6us error" % (name, duration))
+                    print(r['error'])
+        finally:
+            os.chdir(saved_cwd)
+        if not keep:
+            shutil.rmtree(flight_dir)
+    return results
+
+def system_info():
+    return { 'python' : platform.python_version(),
+             'numpy' : np.__version__,
+             'platform' : platform.platform(),
+             'machine' : platform.machine(),
+             'cpus' : os.cpu_count() }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark post-processing stages on synthetic data')
+    parser.add_argument('--durations', type=str, default='60,300,1200', help='comma separated flight durations in seconds')
+    parser.add_argument('--stage', type=str, action='append', default=[], help='stages to run, default all')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each stage')
+    parser.add_argument('--frame-rate', type=float, default=1.0, help='thermal frame rate')
+    parser.add_argument('--log-rate', type=float, default=10.0, help='log rate for POS/ATT/TERR')
+    parser.add_argument('--work-dir', type=str, default=None, help='directory for synthetic flights, default a temporary directory')
+    parser.add_argument('--keep', action='store_true', help='keep generated flights in the work directory')
+    parser.add_argument('--cold', action='store_true', help='drop the thermal frames from the page cache before each run')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--list', action='store_true', help='list stages')
+    args = parser.parse_args()
+
+    if args.list:
+        for (name, func) in STAGES:
+            print(name)
+        sys.exit(0)
+
+    durations = [int(d) for d in args.durations.split(',')]
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='fdbench_')
+    os.makedirs(work_dir, exist_ok=True)
+    started = time.time()
+    results = run_benchmarks(durations, args.stage, args.repeat, work_dir,
+                             args.frame_rate, args.log_rate, keep=args.keep, cold=args.cold)
+    report = { 'started' : started,
+               'system' : system_info(),
+               'frame_rate' : args.frame_rate,
+               'log_rate' : args.log_rate,
+               'repeat' : args.repeat,
+               'cold' : args.cold,
+               'results' : results }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Wrote %s" % args.output)
+    if args.work_dir is None and not args.keep:
+        shutil.rmtree(work_dir)
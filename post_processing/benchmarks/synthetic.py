@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+'''
+generate synthetic flight data for benchmarking
+
+creates a directory laid out as create_combined_video.py expects, with
+raw 640x512 >u2 thermal frames whose mtimes follow the log clock, an
+ArduPilot DataFlash log, a SIYI DataFlash log and an SRTM terrain tile
+under the flight. No real flight data or network access is needed
+'''
+
+import os
+import math
+import struct
+import numpy as np
+
+thermal_width = 640
+thermal_height = 512
+
+C_TO_KELVIN = 273.15
+
+THERMAL_DIR = "102SIYI_TEM"
+LOG_NAME = "log.bin"
+SIYI_LOG_NAME = "SIYI_log.bin"
+TERRAIN_DIR = "terrain"
+
+# terrain height of the flat ground under the flight as logged in TERR
+TERRAIN_HEIGHT = 600.0
+# SRTM3 tile size
+SRTM_SIZE = 1201
+
+# seconds between the unix and GPS epochs, and GPS leap seconds
+GPS_EPOCH = 315964800
+GPS_LEAP_SECONDS = 18
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+FMT_TYPE = 128
+
+# name, format, columns for each synthetic message type
+LOG_FORMATS = {
+    'MSG'  : ('QZ', 'TimeUS,Message'),
+    'GPS'  : ('QBBIHBLLf', 'TimeUS,I,Status,GMS,GWk,NSats,Lat,Lng,Alt'),
+    'POS'  : ('QLLfff', 'TimeUS,Lat,Lng,Alt,RelHomeAlt,RelOriginAlt'),
+    'ATT'  : ('Qffffff', 'TimeUS,DesRoll,Roll,DesPitch,Pitch,DesYaw,Yaw'),
+    'TERR' : ('QBLLHffHH', 'TimeUS,Status,Lat,Lng,Spacing,TerrH,CHeight,Pending,Loaded'),
+    'MODE' : ('QMBB', 'TimeUS,Mode,ModeNum,Rsn'),
+    'CMD'  : ('QHHHffffLLfB', 'TimeUS,CTot,CNum,CId,Prm1,Prm2,Prm3,Prm4,Lat,Lng,Alt,Frame'),
+    'SIGA' : ('Qfff', 'TimeUS,R,P,Y'),
+    'SIRF' : ('Qf', 'TimeUS,SR'),
+    'SITR' : ('Qff', 'TimeUS,TMin,TMax'),
+}
+
+STRUCT_MAP = { 'Q' : 'Q', 'B' : 'B', 'H' : 'H', 'I' : 'I', 'f' : 'f', 'M' : 'b', 'L' : 'i', 'Z' : '64s' }
+
+# plane mode numbers for AUTO and LOITER
+MODE_AUTO = 10
+MODE_LOITER = 12
+
+class DFWriter(object):
+    '''minimal DataFlash log writer'''
+    def __init__(self, filename, types):
+        self.f = open(filename, 'wb')
+        self.ids = {}
+        self.structs = {}
+        for name in types:
+            (fmt, columns) = LOG_FORMATS[name]
+            self.add_format(name, fmt, columns)
+
+    def add_format(self, name, fmt, columns):
+        msg_id = len(self.ids) + 1
+        st = struct.Struct('<' + ''.join(STRUCT_MAP[c] for c in fmt))
+        self.ids[name] = msg_id
+        self.structs[name] = st
+        self.f.write(struct.pack('<BBBBB4s16s64s', HEAD1, HEAD2, FMT_TYPE, msg_id, st.size + 3,
+                                 name.encode(), fmt.encode(), columns.encode()))
+
+    def write(self, name, *values):
+        self.f.write(struct.pack('<BBB', HEAD1, HEAD2, self.ids[name]))
+        self.f.write(self.structs[name].pack(*values))
+
+    def close(self):
+        self.f.close()
+
+def gps_week_ms(unix_time):
+    '''convert unix time to GPS week and milliseconds of week'''
+    t = unix_time - GPS_EPOCH + GPS_LEAP_SECONDS
+    week = int(t // (7*86400))
+    ms = int(round((t - week*7*86400) * 1000))
+    return (week, ms)
+
+class SyntheticFlight(object):
+    '''a deterministic synthetic flight: a circuit around a base point with a fire'''
+    def __init__(self, duration, start_time=1700000000.0, frame_rate=1.0, log_rate=10.0,
+                 lat=-35.42274099, lon=149.00443460, radius=400.0, alt=120.0, seed=1):
+        self.duration = duration
+        self.start_time = start_time
+        self.frame_rate = frame_rate
+        self.log_rate = log_rate
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        self.alt = alt
+        self.rng = np.random.default_rng(seed)
+
+    def state(self, t):
+        '''return (lat, lon, yaw) at t seconds into the flight'''
+        ang = 2 * math.pi * t / 300.0
+        north = self.radius * math.cos(ang)
+        east = self.radius * math.sin(ang)
+        lat = self.lat + math.degrees(north / 6378100.0)
+        lon = self.lon + math.degrees(east / (6378100.0 * math.cos(math.radians(self.lat))))
+        yaw = math.degrees(ang + math.pi/2) % 360
+        return (lat, lon, yaw)
+
+    def frame_times(self):
+        '''return unix times of each thermal frame'''
+        n = int(self.duration * self.frame_rate)
+        return self.start_time + np.arange(n) / self.frame_rate
+
+    def write_thermal_dir(self, thermal_dir):
+        '''write raw >u2 thermal frames with mtimes at the frame times'''
+        os.makedirs(thermal_dir, exist_ok=True)
+        yy, xx = np.mgrid[0:thermal_height, 0:thermal_width].astype(np.float32)
+        times = self.frame_times()
+        for i in range(len(times)):
+            t = i / self.frame_rate
+            # smooth background with a drifting hot spot and sensor noise
+            temp = 20 + 8*np.sin(xx/90.0 + t*0.01) + 5*np.cos(yy/70.0)
+            cx = thermal_width * (0.5 + 0.4*math.sin(t*0.05))
+            cy = thermal_height * (0.5 + 0.4*math.cos(t*0.03))
+            temp += 250 * np.exp(-((xx-cx)**2 + (yy-cy)**2) / 400.0)
+            temp += self.rng.normal(0, 0.1, temp.shape).astype(np.float32)
+            raw = ((temp + C_TO_KELVIN) * 64).astype('>u2')
+            fname = os.path.join(thermal_dir, "IR_%06u.raw" % i)
+            raw.tofile(fname)
+            os.utime(fname, (times[i], times[i]))
+        return len(times)
+
+    def write_siyi_records(self, w, t, time_us):
+        '''write gimbal, rangefinder and thermal range records'''
+        w.write('SIGA', time_us, 0.0, -60.0 + 10*math.sin(t*0.02), 0.0)
+        w.write('SIRF', time_us, self.alt / math.sin(math.radians(60)))
+        w.write('SITR', time_us, 15.0, 20.0 + 250*abs(math.sin(t*0.05)))
+
+    def write_gps(self, w, t, time_us):
+        (lat, lon, yaw) = self.state(t)
+        (week, ms) = gps_week_ms(self.start_time + t)
+        w.write('GPS', time_us, 0, 3, ms, week, 12, int(lat*1e7), int(lon*1e7), self.alt + 600)
+
+    def write_log(self, filename, siyi=True):
+        '''write the ArduPilot log, including SIYI records as in a merged log'''
+        types = ['MSG', 'GPS', 'POS', 'ATT', 'TERR', 'MODE', 'CMD']
+        if siyi:
+            types += ['SIGA', 'SIRF', 'SITR']
+        w = DFWriter(filename, types)
+        w.write('MSG', 0, b'ArduPlane V4.5.0')
+        # mission of waypoints around the circuit
+        ncmd = 8
+        for i in range(ncmd):
+            (lat, lon, yaw) = self.state(i * 300.0 / ncmd)
+            w.write('CMD', 0, ncmd, i, 16, 0, 0, 0, 0, int(lat*1e7), int(lon*1e7), self.alt, 3)
+        n = int(self.duration * self.log_rate)
+        mode = None
+        for i in range(n):
+            t = i / self.log_rate
+            time_us = int(1e6 * (t + 10))
+            (lat, lon, yaw) = self.state(t)
+            new_mode = MODE_AUTO if int(t // 120) % 2 == 0 else MODE_LOITER
+            if new_mode != mode:
+                w.write('MODE', time_us, new_mode, new_mode, 0)
+                mode = new_mode
+            if i % max(int(self.log_rate // 5), 1) == 0:
+                self.write_gps(w, t, time_us)
+            w.write('ATT', time_us, 0.0, 2.0, 0.0, 1.0, yaw, yaw)
+            w.write('POS', time_us, int(lat*1e7), int(lon*1e7), self.alt + 600, self.alt, self.alt)
+            w.write('TERR', time_us, 0, int(lat*1e7), int(lon*1e7), 100, 600.0, self.alt, 0, 100)
+            if siyi:
+                self.write_siyi_records(w, t, time_us)
+        w.close()
+        return n
+
+    def write_siyi_log(self, filename):
+        '''write a SIYI log as recorded by the gimbal, to be merged'''
+        w = DFWriter(filename, ['GPS', 'SIGA', 'SIRF', 'SITR'])
+        n = int(self.duration * self.log_rate)
+        for i in range(n):
+            t = i / self.log_rate
+            time_us = int(1e6 * (t + 5))
+            if i % max(int(self.log_rate // 5), 1) == 0:
+                self.write_gps(w, t, time_us)
+            self.write_siyi_records(w, t, time_us)
+        w.close()
+        return n
+
+    def write_terrain(self, terrain_dir, hill=80.0, hill_radius=150.0):
+        '''
+        write the SRTM tile under the flight, flat at the logged terrain
+        height with a hill at the start of the circuit
+        '''
+        os.makedirs(terrain_dir, exist_ok=True)
+        (tlat, tlon) = (int(math.floor(self.lat)), int(math.floor(self.lon)))
+        name = "%s%02u%s%03u.hgt" % ('N' if tlat >= 0 else 'S', abs(tlat), 'E' if tlon >= 0 else 'W', abs(tlon))
+        step = 1.0 / (SRTM_SIZE - 1)
+        lats = tlat + 1 - np.arange(SRTM_SIZE) * step
+        lons = tlon + np.arange(SRTM_SIZE) * step
+        (hlat, hlon, yaw) = self.state(0)
+        north = np.radians(lats - hlat) * 6378100.0
+        east = np.radians(lons - hlon) * 6378100.0 * math.cos(math.radians(hlat))
+        d2 = north[:,None]**2 + east[None,:]**2
+        heights = TERRAIN_HEIGHT + hill * np.exp(-d2 / (2 * hill_radius**2))
+        heights.round().astype('>i2').tofile(os.path.join(terrain_dir, name))
+        return name
+
+    def write_flight_dir(self, flight_dir):
+        '''write a complete synthetic flight directory'''
+        os.makedirs(flight_dir, exist_ok=True)
+        self.write_terrain(os.path.join(flight_dir, TERRAIN_DIR))
+        self.write_thermal_dir(os.path.join(flight_dir, THERMAL_DIR))
+        self.write_log(os.path.join(flight_dir, LOG_NAME), siyi=True)
+        self.write_log(os.path.join(flight_dir, "log_nosiyi.bin"), siyi=False)
+        self.write_siyi_log(os.path.join(flight_dir, SIYI_LOG_NAME))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='generate a synthetic flight directory')
+    parser.add_argument('flight_dir', help='output directory')
+    parser.add_argument('--duration', type=float, default=300, help='flight duration in seconds')
+    parser.add_argument('--frame-rate', type=float, default=1.0, help='thermal frame rate')
+    parser.add_argument('--log-rate', type=float, default=10.0, help='log rate for POS/ATT/TERR')
+    args = parser.parse_args()
+
+    flight = SyntheticFlight(args.duration, frame_rate=args.frame_rate, log_rate=args.log_rate)
+    flight.write_flight_dir(args.flight_dir)
+    print("Created %s with %u frames" % (args.flight_dir, len(flight.frame_times())))
@@ -0,0 +1,11 @@
+'''
+firedrones flight post-processing library
+
+the products (map, videos, CSV, merged log, thermal archive and viewer
+server) are in their own modules and share the flight log, thermal
+frame and profiling code. Heavy dependencies such as moviepy, gmplot,
+matplotlib and pymavlink are only imported by the functions that need
+them. The command line is in firedrones.cli, run it with
+
+  python -m firedrones COMMAND ...
+'''
@@ -0,0 +1,428 @@
+'''
+chunked lossless archive of raw SIYI thermal frames
+
+each frame is stored as its own chunk so any frame can be decoded
+without touching the rest of the archive. A frame is split into blocks
+of BLOCK_ROWS rows and every row is coded as its difference from the
+first row of its block, biased so small differences of either sign
+have a zero high byte, then split into byte planes. The high bytes are
+nearly all zero so only the few non-zero ones are kept, with their
+positions, and zlib compressed, the block start rows keep their own
+small high byte plane. The low byte plane holds the sensor noise and is
+only compressed when that at least halves it, as inflating it costs
+more than reading it from all but slow storage.
+
+Decoding is a small inflate, a byte scatter and one add of the block
+start rows, with no running sum down the rows, about 0.3 ms a frame. A
+raw file already in the page cache is read in about 0.2 ms, so from a
+warm cache the raw directory is still a little quicker, from disk or
+network storage the archive is quicker as it is half the size. An index
+at the end of the file holds the offset, length, name and mtime of
+every frame
+
+archive members can be used anywhere a thermal directory is expected,
+a member path is ARCHIVE/NAME, which is what os.path.join() gives
+'''
+
+import os
+import sys
+import mmap
+import struct
+import zlib
+import numpy as np
+
+thermal_width = 640
+thermal_height = 512
+
+FRAME_PIXELS = thermal_width * thermal_height
+FRAME_BYTES = FRAME_PIXELS * 2
+
+C_TO_KELVIN = 273.15
+
+ARCHIVE_MAGIC = b'FDTHARC1'
+ARCHIVE_VERSION = 3
+# version 1 archives zlib compressed both planes of column differences,
+# version 2 coded each row against the row above
+READABLE_VERSIONS = (1, 2, 3)
+ARCHIVE_EXTENSION = '.fta'
+
+# file header: magic, version, width, height
+HEADER_FORMAT = '<8sIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# file trailer: index offset, frame count, magic
+TRAILER_FORMAT = '<QI8s'
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+
+# chunk flags, a chunk with none is the zlib compressed raw file contents
+FLAG_DELTA = 1          # version 1 delta coded frame
+FLAG_PLANES = 2         # row delta byte planes
+FLAG_LOW_ZLIB = 4       # low byte plane is zlib compressed
+FLAG_HIGH_SPARSE = 8    # high bytes are the non-zero ones and their positions
+FLAG_BLOCKS = 16        # rows coded against the first row of their block
+
+# version 2 chunks: the compressed high bytes length comes before the planes
+PLANES_FORMAT = '<I'
+PLANES_SIZE = struct.calcsize(PLANES_FORMAT)
+
+# block chunks: the compressed block start high bytes and high bytes
+# lengths come before the planes
+BLOCKS_FORMAT = '<II'
+BLOCKS_SIZE = struct.calcsize(BLOCKS_FORMAT)
+
+# rows in a block, must divide thermal_height. Longer blocks have fewer
+# start rows but more rows far enough from them to need a high byte
+BLOCK_ROWS = 16
+BLOCK_COUNT = thermal_height // BLOCK_ROWS
+
+# offset of the high byte in a native uint16
+HIGH_BYTE = 1 if sys.byteorder == 'little' else 0
+
+# row differences in [-DELTA_BIAS, 255-DELTA_BIAS] have a zero high byte
+DELTA_BIAS = 0x80
+
+# the low byte plane is compressed if that at least halves it
+LOW_PLANE_RATIO = 0.5
+
+# sparse high bytes take 5 bytes each, past this fraction of the plane
+# size the whole plane is kept
+SPARSE_HIGH_RATIO = 0.25
+
+# rows summed at a time when decoding version 2 chunks
+ROW_BLOCK = 8
+
+# longest member name the index holds, in UTF-8 bytes
+MAX_NAME_BYTES = 64
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'),
+                        ('length', '<u4'),
+                        ('raw_size', '<u4'),
+                        ('flags', '<u4'),
+                        ('mtime', '<f8'),
+                        ('name', 'S%u' % MAX_NAME_BYTES)])
+
+def encode_frame(raw, level=1):
+    '''encode a frame of raw >u2 counts as block row byte planes, returning (flags, chunk)'''
+    a = raw.astype(np.uint16).reshape(BLOCK_COUNT, BLOCK_ROWS, thermal_width)
+    d = a - a[:,:1]
+    d += DELTA_BIAS
+    d[:,0] = a[:,0]
+    d = d.reshape(-1)
+    flags = FLAG_BLOCKS
+    hi = (d >> 8).astype(np.uint8)
+    blocks = hi.reshape(BLOCK_COUNT, BLOCK_ROWS, thermal_width)
+    start_hi = blocks[:,0].tobytes()
+    blocks[:,0] = 0
+    pos = np.flatnonzero(hi)
+    if len(pos) * 5 <= FRAME_PIXELS * SPARSE_HIGH_RATIO:
+        gaps = np.diff(pos, prepend=0).astype('<u4')
+        hi = gaps.tobytes() + hi[pos].tobytes()
+        start_hi = zlib.compress(start_hi, level)
+        flags |= FLAG_HIGH_SPARSE
+    else:
+        blocks[:,0] = np.frombuffer(start_hi, dtype=np.uint8).reshape(BLOCK_COUNT, thermal_width)
+        hi = hi.tobytes()
+        start_hi = b''
+    hi = zlib.compress(hi, level)
+    lo = (d & 0xff).astype(np.uint8).tobytes()
+    lo_z = zlib.compress(lo, level)
+    if len(lo_z) <= len(lo) * LOW_PLANE_RATIO:
+        lo = lo_z
+        flags |= FLAG_LOW_ZLIB
+    return (flags, struct.pack(BLOCKS_FORMAT, len(start_hi), len(hi)) + start_hi + hi + lo)
+
+def decode_frame(chunk, flags, out=None):
+    '''decode a block row chunk to flat native uint16 counts, into out if given'''
+    (start_len, hi_len) = struct.unpack_from(BLOCKS_FORMAT, chunk, 0)
+    mv = memoryview(chunk)
+    ofs = BLOCKS_SIZE + start_len
+    hi = zlib.decompress(mv[ofs:ofs+hi_len])
+    lo = mv[ofs+hi_len:]
+    if flags & FLAG_LOW_ZLIB:
+        lo = zlib.decompress(lo)
+    d = out if out is not None else np.empty(FRAME_PIXELS, dtype=np.uint16)
+    d[:] = np.frombuffer(lo, dtype=np.uint8)
+    # the high bytes are written straight into the native bytes of d,
+    # which is much quicker than shifting and adding them
+    b = d.view(np.uint8)
+    if flags & FLAG_HIGH_SPARSE:
+        n = len(hi) // 5
+        pos = np.cumsum(np.frombuffer(hi, dtype='<u4', count=n), dtype=np.uint32)
+        pos *= 2
+        pos += HIGH_BYTE
+        b[pos] = np.frombuffer(hi, dtype=np.uint8, count=n, offset=4*n)
+        start_hi = zlib.decompress(mv[BLOCKS_SIZE:BLOCKS_SIZE+start_len])
+        b.reshape(BLOCK_COUNT, BLOCK_ROWS, thermal_width, 2)[:,0,:,HIGH_BYTE] = \
+            np.frombuffer(start_hi, dtype=np.uint8).reshape(BLOCK_COUNT, thermal_width)
+    else:
+        b[HIGH_BYTE::2] = np.frombuffer(hi, dtype=np.uint8)
+    # uint16 wraps the same way the subtraction did
+    blocks = d.reshape(BLOCK_COUNT, BLOCK_ROWS, thermal_width)
+    start = blocks[:,:1] - np.uint16(DELTA_BIAS)
+    np.add(blocks[:,1:], start, out=blocks[:,1:])
+    return d
+
+def decode_frame_v2(chunk, flags, out=None):
+    '''decode a version 2 row delta chunk to flat native uint16 counts, into out if given'''
+    (hi_len,) = struct.unpack_from(PLANES_FORMAT, chunk, 0)
+    mv = memoryview(chunk)
+    hi = zlib.decompress(mv[PLANES_SIZE:PLANES_SIZE+hi_len])
+    lo = mv[PLANES_SIZE+hi_len:]
+    if flags & FLAG_LOW_ZLIB:
+        lo = zlib.decompress(lo)
+    d = out if out is not None else np.empty(FRAME_PIXELS, dtype=np.uint16)
+    d[:] = np.frombuffer(lo, dtype=np.uint8)
+    if flags & FLAG_HIGH_SPARSE:
+        n = len(hi) // 5
+        pos = np.frombuffer(hi, dtype='<u4', count=n)
+        d[pos] += np.frombuffer(hi, dtype=np.uint8, count=n, offset=4*n).astype(np.uint16) << 8
+    else:
+        d += np.frombuffer(hi, dtype=np.uint8).astype(np.uint16) << 8
+    d -= DELTA_BIAS
+    # running sum down the rows within blocks of ROW_BLOCK rows, then the
+    # block totals carried down, which is much quicker than cumsum along
+    # an axis. uint16 wraps the same way the subtraction did
+    blocks = d.reshape(thermal_height // ROW_BLOCK, ROW_BLOCK, thermal_width)
+    for r in range(1, ROW_BLOCK):
+        np.add(blocks[:,r-1], blocks[:,r], out=blocks[:,r])
+    carry = np.cumsum(blocks[:-1,-1], axis=0, dtype=np.uint16)
+    blocks[1:] += carry[:,None,:]
+    return d
+
+def decode_frame_v1(buf):
+    '''decode a version 1 delta coded frame back to native uint16 counts'''
+    planes = np.frombuffer(buf, dtype=np.uint8).reshape(2, -1)
+    d = (planes[0].astype(np.uint16) << 8) | planes[1]
+    d = d.reshape(thermal_height, thermal_width)
+    # uint16 cumsum wraps the same way the subtraction did
+    return np.cumsum(d, axis=1, dtype=np.uint16).reshape(-1)
+
+def create_archive(thermal_dir, archive_file, level=1):
+    '''create an archive from a directory of raw thermal frames, returns frame count'''
+    entries = scan_dir(thermal_dir)
+    names = [e[0] for e in entries]
+    for name in names:
+        if len(name.encode('utf-8')) > MAX_NAME_BYTES:
+            raise ValueError("%s: name longer than %u bytes" % (os.path.join(thermal_dir, name), MAX_NAME_BYTES))
+    index = np.zeros(len(names), dtype=INDEX_DTYPE)
+    tmp_file = archive_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, ARCHIVE_MAGIC, ARCHIVE_VERSION, thermal_width, thermal_height))
+        offset = HEADER_SIZE
+        for i in range(len(names)):
+            with open(os.path.join(thermal_dir, names[i]), 'rb') as src:
+                data = src.read()
+            if len(data) == FRAME_BYTES:
+                (flags, chunk) = encode_frame(np.frombuffer(data, dtype='>u2'), level)
+            else:
+                # keep invalid frames verbatim so extraction is lossless
+                (flags, chunk) = (0, zlib.compress(data, level))
+            f.write(chunk)
+            index[i] = (offset, len(chunk), len(data), flags, entries[i][2], names[i].encode('utf-8'))
+            offset += len(chunk)
+        f.write(index.tobytes())
+        f.write(struct.pack(TRAILER_FORMAT, offset, len(names), ARCHIVE_MAGIC))
+    os.replace(tmp_file, archive_file)
+    return len(names)
+
+class ThermalArchive(object):
+    '''random access reader for a thermal frame archive'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, width, height) = struct.unpack_from(HEADER_FORMAT, self.data, 0)
+        if magic != ARCHIVE_MAGIC or not version in READABLE_VERSIONS:
+            raise ValueError("%s is not a thermal archive" % filename)
+        if width != thermal_width or height != thermal_height:
+            raise ValueError("%s has unsupported frame size %ux%u" % (filename, width, height))
+        (index_offset, count, magic) = struct.unpack_from(TRAILER_FORMAT, self.data, len(self.data) - TRAILER_SIZE)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError("%s is truncated" % filename)
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE, count=count, offset=index_offset).copy()
+        self.mtimes = self.index['mtime']
+        self.names = [n.decode('utf-8') for n in self.index['name']]
+        self.name_to_idx = { self.names[i] : i for i in range(count) }
+
+    def count(self):
+        return len(self.names)
+
+    def find(self, name):
+        '''find frame index by member name, returns None if not present'''
+        return self.name_to_idx.get(os.path.basename(name), None)
+
+    def chunk(self, idx):
+        '''the stored chunk of a frame and its flags'''
+        e = self.index[idx]
+        return (self.data[e['offset']:e['offset']+e['length']], int(e['flags']))
+
+    def read_bytes(self, idx):
+        '''return the original file contents of a frame'''
+        raw = self.load_raw(idx)
+        if raw is not None:
+            return raw.astype('>u2').tobytes()
+        (chunk, flags) = self.chunk(idx)
+        return zlib.decompress(chunk)
+
+    def load_raw(self, idx, out=None):
+        '''
+        return raw counts for a frame as a flat native uint16 array, or
+        None if invalid. The frame is decoded into out if given
+        '''
+        (chunk, flags) = self.chunk(idx)
+        if flags & FLAG_BLOCKS:
+            return decode_frame(chunk, flags, out)
+        if flags & FLAG_PLANES:
+            return decode_frame_v2(chunk, flags, out)
+        if not (flags & FLAG_DELTA):
+            return None
+        raw = decode_frame_v1(zlib.decompress(chunk))
+        if out is None:
+            return raw
+        out[:] = raw
+        return out
+
+    def load_thermal_to_temperatures(self, idx):
+        '''load a frame returning a temperature array in degrees C'''
+        a = self.load_raw(idx)
+        if a is None:
+            return None
+        return (a / 64.0) - C_TO_KELVIN
+
+    def range_indexes(self, start_time, end_time):
+        '''return frame indexes with mtime in [start_time, end_time]'''
+        i1 = np.searchsorted(self.mtimes, start_time, side='left')
+        i2 = np.searchsorted(self.mtimes, end_time, side='right')
+        return range(i1, i2)
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+# archives opened via member paths, keyed by archive filename
+archives = {}
+
+# parent paths already known not to be archives
+plain_dirs = set()
+
+def is_archive(path):
+    '''return True if path is a thermal archive file'''
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+def open_archive(path):
+    '''open an archive, using the cached reader if already open'''
+    if not path in archives:
+        archives[path] = ThermalArchive(path)
+    return archives[path]
+
+def archive_member(fname):
+    '''return (archive, idx) if fname is an archive member path, otherwise None'''
+    dname = os.path.dirname(fname)
+    if dname in plain_dirs:
+        return None
+    if dname in archives or is_archive(dname):
+        arc = open_archive(dname)
+        idx = arc.find(fname)
+        if idx is not None:
+            return (arc, idx)
+        return None
+    plain_dirs.add(dname)
+    return None
+
+# frame times by path, from directory scans and aligned frame catalogues
+frame_time_cache = {}
+
+def set_frame_times(paths, times):
+    '''record the times of frames so getmtime() needs no stat'''
+    frame_time_cache.update(zip(paths, (float(t) for t in times)))
+
+def scan_dir(dir):
+    '''(name, size, mtime) of the files in a directory sorted by mtime, from one scandir pass'''
+    ret = []
+    with os.scandir(dir) as it:
+        for e in it:
+            if e.is_file():
+                st = e.stat()
+                ret.append((e.name, st.st_size, st.st_mtime))
+    ret.sort(key=lambda x: x[2])
+    return ret
+
+def sorted_files(dir):
+    '''return a list of files sorted by mtime, dir may be a directory or an archive'''
+    if is_archive(dir):
+        arc = open_archive(dir)
+        return [os.path.join(dir, x) for x in arc.names]
+    entries = scan_dir(dir)
+    ret = [os.path.join(dir, e[0]) for e in entries]
+    # keep any aligned catalogue time already recorded
+    for (f, e) in zip(ret, entries):
+        frame_time_cache.setdefault(f, e[2])
+    return ret
+
+def getmtime(fname):
+    '''
+    return the time of a raw thermal file or archive member, the aligned
+    time if it is in a frame catalogue, otherwise its mtime
+    '''
+    t = frame_time_cache.get(fname)
+    if t is not None:
+        return t
+    m = archive_member(fname)
+    if m is not None:
+        (arc, idx) = m
+        return float(arc.mtimes[idx])
+    return os.path.getmtime(fname)
+
+def load_thermal_raw(fname):
+    '''load a raw thermal file or archive member as a flat native uint16 array of raw counts'''
+    m = archive_member(fname)
+    if m is not None:
+        (arc, idx) = m
+        return arc.load_raw(idx)
+    a = np.fromfile(fname, dtype='>u2')
+    if len(a) != thermal_width * thermal_height:
+        return None
+    return a.astype(np.uint16)
+
+def read_raw_into(fname, out):
+    '''read a raw thermal file or archive member into a flat native uint16 row, returning False if invalid'''
+    m = archive_member(fname)
+    if m is not None:
+        (arc, idx) = m
+        return arc.load_raw(idx, out) is not None
+    with open(fname, 'rb') as f:
+        data = f.read(FRAME_BYTES + 1)
+    if len(data) != FRAME_BYTES:
+        return False
+    # a converting copy is much faster than reading in place and byteswapping
+    np.copyto(out, np.frombuffer(data, dtype='>u2'))
+    return True
+
+def load_thermal_to_temperatures(fname):
+    '''load a raw thermal file or archive member returning a temperature array in degrees C'''
+    m = archive_member(fname)
+    if m is not None:
+        (arc, idx) = m
+        return arc.load_thermal_to_temperatures(idx)
+    a = np.fromfile(fname, dtype='>u2')
+    if len(a) != thermal_width * thermal_height:
+        return None
+
+    # get in C
+    return (a / 64.0) - C_TO_KELVIN
+
+def extract_archive(archive_file, out_dir):
+    '''extract all frames of an archive to a directory, restoring mtimes'''
+    arc = ThermalArchive(archive_file)
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(arc.count()):
+        fname = os.path.join(out_dir, arc.names[i])
+        with open(fname, 'wb') as f:
+            f.write(arc.read_bytes(i))
+        os.utime(fname, (arc.mtimes[i], arc.mtimes[i]))
+    count = arc.count()
+    arc.close()
+    return count
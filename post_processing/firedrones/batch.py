@@ -0,0 +1,304 @@
+'''
+batch processing of many flight directories
+
+flight directories are found under some root directories and each
+requested product of each flight becomes a job. Jobs run in worker
+processes, started by a scheduler which keeps within a worker count, a
+limit on concurrent video encodes and a memory budget, using a memory
+estimate for each job based on the number of thermal frames. Shorter
+flights are started first, later jobs that fit are started when an
+earlier job does not.
+
+a worker killed by the OOM killer or a crash breaks the whole process
+pool, failing every job running in it. The pool is replaced and those
+jobs run again, each on its own so the one that breaks the pool again
+is the one that fails.
+
+with --profile each worker profiles its job and hands the stage events
+back with its result, to be merged into the batch trace
+
+a done marker is written in the output directory when a product
+finishes, so after a crash the batch can be run again and only the
+unfinished products are made
+'''
+
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .archive import is_archive, open_archive, thermal_width, thermal_height
+from .products import product_dependencies, use_merged_log, make_product
+from .video import THERMAL_DIR, LOG_NAME
+from .profiling import profiler
+
+DONE_DIR = ".batch"
+
+FRAME_BYTES = thermal_width * thermal_height * 2
+
+# memory estimate for each product as (base MB, MB per thermal frame).
+# The products read frames as they go and the map writes its thumbnail
+# sheets as they fill, so none of them grow with the flight
+MEMORY_ESTIMATE = {
+    'merge' : (150, 0),
+    'csv' : (150, 0),
+    'map' : (250, 0),
+    'thermal-video' : (300, 0),
+    'combined-video' : (500, 0),
+    'fused-video' : (400, 0),
+    'coverage' : (300, 0),
+}
+
+# products which run a video encode
+ENCODE_PRODUCTS = set(['thermal-video', 'combined-video', 'fused-video'])
+
+def is_flight_dir(path):
+    return os.path.exists(os.path.join(path, THERMAL_DIR)) and os.path.exists(os.path.join(path, LOG_NAME))
+
+def find_flight_dirs(root):
+    '''find flight directories at or below root, not looking inside a flight directory'''
+    if is_flight_dir(root):
+        return [root]
+    ret = []
+    try:
+        entries = sorted(os.scandir(root), key=lambda e: e.name)
+    except OSError:
+        return ret
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            ret.extend(find_flight_dirs(e.path))
+        elif e.is_symlink() and e.is_dir() and is_flight_dir(e.path):
+            ret.append(e.path)
+    return ret
+
+def count_thermal_frames(thermal_dir):
+    '''estimate the number of thermal frames without reading them'''
+    if is_archive(thermal_dir):
+        return open_archive(thermal_dir).count()
+    count = 0
+    with os.scandir(thermal_dir) as it:
+        for e in it:
+            if e.is_file() and e.stat().st_size == FRAME_BYTES:
+                count += 1
+    return count
+
+def done_marker(outdir, product):
+    return os.path.join(outdir, DONE_DIR, product + ".done")
+
+def write_done_marker(outdir, product, info):
+    '''atomically write the done marker for a product'''
+    fname = done_marker(outdir, product)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = fname + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, fname)
+
+def run_product_job(flight_dir, outdir, product, opts, t_origin=None):
+    '''
+    make one product in a worker process, returning (elapsed, peak RSS MB,
+    profile events), profiling on the parent's clock if t_origin is given
+    '''
+    from .session import FlightSession
+    if t_origin is not None:
+        profiler.enable_worker(t_origin)
+    t0 = time.time()
+    os.makedirs(outdir, exist_ok=True)
+    session = FlightSession(flight_dir, time_delta=opts.time_delta)
+    if product != 'merge':
+        use_merged_log(session, outdir)
+    make_product(session, product, outdir, opts)
+    peak = profiler.process_peak_rss() / (1024.0 * 1024.0)
+    return (time.time() - t0, peak, profiler.take_events())
+
+class FlightJob(object):
+    '''one flight directory in the batch'''
+    def __init__(self, flight_dir, outdir):
+        self.flight_dir = flight_dir
+        self.outdir = outdir
+        self.frames = count_thermal_frames(os.path.join(flight_dir, THERMAL_DIR))
+        self.jobs = []
+
+    def finished(self):
+        return all(j.state == 'done' for j in self.jobs)
+
+class ProductJob(object):
+    '''one product of one flight'''
+    def __init__(self, flight, product, products):
+        self.flight = flight
+        self.product = product
+        self.deps = product_dependencies(product, products)
+        (base, per_frame) = MEMORY_ESTIMATE[product]
+        self.memory = base + per_frame * flight.frames
+        self.encodes = 1 if product in ENCODE_PRODUCTS else 0
+        self.state = 'pending'
+        # set once a worker died running it, it then runs on its own
+        self.alone = False
+        if os.path.exists(done_marker(flight.outdir, product)):
+            self.state = 'done'
+
+    def name(self):
+        return "%s:%s" % (self.flight.flight_dir, self.product)
+
+class BatchScheduler(object):
+    '''run the products for many flights within worker, encode and memory limits'''
+    def __init__(self, roots, products, opts, outdir=None, workers=None,
+                 max_encodes=2, max_memory=None):
+        self.products = products
+        self.opts = opts
+        self.workers = workers or os.cpu_count() or 1
+        self.max_encodes = max_encodes
+        if max_memory is None:
+            max_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (2*1024*1024)
+        self.max_memory = max_memory
+        self.flights = []
+        for root in roots:
+            for flight_dir in find_flight_dirs(root):
+                self.flights.append(FlightJob(flight_dir, self.flight_outdir(root, flight_dir, outdir)))
+        # short flights first
+        self.flights.sort(key=lambda f: f.frames)
+        self.jobs = []
+        for f in self.flights:
+            for p in products:
+                f.jobs.append(ProductJob(f, p, products))
+            self.jobs.extend(f.jobs)
+        self.by_product = {}
+        for j in self.jobs:
+            self.by_product[(j.flight, j.product)] = j
+
+    def flight_outdir(self, root, flight_dir, outdir):
+        if outdir is None:
+            return flight_dir
+        rel = os.path.relpath(flight_dir, root)
+        if rel == '.':
+            rel = os.path.basename(os.path.abspath(flight_dir))
+        return os.path.join(outdir, rel)
+
+    def print_jobs(self):
+        for f in self.flights:
+            print("%s: %u frames -> %s" % (f.flight_dir, f.frames, f.outdir))
+            for j in f.jobs:
+                print("  %-15s %-8s %6.0fMB" % (j.product, j.state, j.memory))
+
+    def ready(self, job):
+        '''check if a pending job can start, marking it skipped if a dependency failed'''
+        for d in job.deps:
+            state = self.by_product[(job.flight, d)].state
+            if state in ['failed', 'skipped']:
+                job.state = 'skipped'
+                return False
+            if state != 'done':
+                return False
+        return True
+
+    def start_jobs(self, executor, running):
+        '''
+        start pending jobs in priority order while they fit in the limits,
+        returning False if the pool is broken
+        '''
+        memory = sum(j.memory for j in running.values())
+        encodes = sum(j.encodes for j in running.values())
+        for job in self.jobs:
+            if len(running) >= self.workers:
+                break
+            if any(j.alone for j in running.values()):
+                break
+            if job.state != 'pending' or not self.ready(job):
+                continue
+            if job.alone and len(running) > 0:
+                continue
+            if encodes + job.encodes > self.max_encodes:
+                continue
+            # a job bigger than the whole budget runs on its own
+            if len(running) > 0 and memory + job.memory > self.max_memory:
+                continue
+            try:
+                fut = executor.submit(run_product_job, job.flight.flight_dir, job.flight.outdir, job.product, self.opts,
+                                      profiler.t_origin if profiler.enabled else None)
+            except BrokenProcessPool:
+                return False
+            job.state = 'running'
+            job.start = time.time()
+            running[fut] = job
+            memory += job.memory
+            encodes += job.encodes
+        return True
+
+    def make_executor(self):
+        # a fresh worker for each job so memory is returned and peak RSS is per job
+        try:
+            return ProcessPoolExecutor(max_workers=self.workers, max_tasks_per_child=1)
+        except TypeError:
+            return ProcessPoolExecutor(max_workers=self.workers)
+
+    def run(self):
+        '''run all pending jobs, returning True if none failed'''
+        t0 = time.time()
+        todo = [j for j in self.jobs if j.state == 'pending']
+        print("Batch of %u flights, %u jobs to run, %u already done" % (len(self.flights), len(todo), len(self.jobs)-len(todo)))
+        unfinished = set(f for f in self.flights if not f.finished())
+        flights_done = 0
+        jobs_done = 0
+        failed = []
+        running = {}
+        # the opts are sent to the workers, so can't hold the parser or functions
+        opts = self.opts
+        self.opts = type(opts)(**dict((k, v) for (k, v) in vars(opts).items() if not k in ['parser', 'func']))
+        with profiler.stage('batch') as st:
+            executor = self.make_executor()
+            broken = False
+            try:
+                while True:
+                    if not broken and not self.start_jobs(executor, running):
+                        broken = True
+                    if broken and len(running) == 0:
+                        # every job in the broken pool has been seen, start again with a new one
+                        executor.shutdown(wait=True)
+                        executor = self.make_executor()
+                        broken = False
+                        continue
+                    if len(running) == 0:
+                        break
+                    (done, pending) = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        job = running.pop(fut)
+                        try:
+                            (elapsed, peak, events) = fut.result()
+                        except BrokenProcessPool:
+                            broken = True
+                            if job.alone:
+                                job.state = 'failed'
+                                failed.append(job)
+                                print("FAILED %s: worker process died" % job.name())
+                            else:
+                                job.alone = True
+                                job.state = 'pending'
+                                print("Worker died running %s, retrying on its own" % job.name())
+                            continue
+                        except Exception as ex:
+                            job.state = 'failed'
+                            failed.append(job)
+                            print("FAILED %s: %s" % (job.name(), ex))
+                            continue
+                        profiler.merge(events)
+                        job.state = 'done'
+                        jobs_done += 1
+                        write_done_marker(job.flight.outdir, job.product,
+                                          { 'elapsed' : elapsed, 'peak_rss_mb' : peak, 'finished' : time.time() })
+                        if job.flight in unfinished and job.flight.finished():
+                            unfinished.remove(job.flight)
+                            flights_done += 1
+                        hours = (time.time() - t0) / 3600.0
+                        print("Done %s in %.1fs peak %.0fMB (est %.0fMB), %u/%u jobs, %.1f flights/hour" % (
+                            job.name(), elapsed, peak, job.memory, jobs_done, len(todo), flights_done / hours))
+            finally:
+                executor.shutdown(wait=True)
+            st.count = flights_done
+        self.opts = opts
+        skipped = [j for j in self.jobs if j.state in ['skipped', 'pending']]
+        hours = (time.time() - t0) / 3600.0
+        print("Finished %u flights in %.1fs, %.1f flights/hour" % (flights_done, hours*3600, flights_done / max(hours, 1.0e-9)))
+        if failed or skipped:
+            print("%u jobs failed, %u skipped" % (len(failed), len(skipped)))
+        return len(failed) == 0 and len(skipped) == 0
@@ -0,0 +1,264 @@
+'''
+catalogue of the thermal frames of a flight with times on the log clock
+
+the catalogue is built from one os.scandir pass over the thermal
+directory, or from the index of an archive, recording the name, size,
+mtime and validity of every frame. Frame mtimes are set by the camera
+clock and file system, so they are aligned to the log clock by fitting
+an offset and drift rate from the frame mtimes to the cadence of camera
+trigger records, or of SITR records when there are no triggers.
+
+the fit is vectorised. A coarse offset comes from a histogram of the
+differences between a sample of frames and all events within
+MAX_OFFSET seconds of them. Every frame is then matched to its nearest
+event with a searchsorted, and a least squares line through the matches
+is refined once after dropping outliers. A perfectly regular cadence
+only fixes the offset to within a whole number of frame periods, so the
+smallest such offset is used, and with SITR records at a higher rate
+than frames only offsets smaller than the SITR spacing and clock drift
+can be corrected. When too few frames match the mtimes are kept.
+
+the catalogue is saved next to the thermal directory and reused while
+the directory and log are unchanged. Opening it records the aligned
+frame times for getmtime(), so every tool uses the log clock without
+another stat of the frames. The RGB videos are written by the same
+camera, so their times are moved onto the log clock with the same fit
+'''
+
+import os
+import numpy as np
+
+from .archive import is_archive, open_archive, scan_dir, set_frame_times, FRAME_BYTES
+from .profiling import profiler
+
+CATALOGUE_SUFFIX = ".catalogue.npz"
+CATALOGUE_VERSION = 1
+
+# largest camera to log clock offset searched for
+MAX_OFFSET = 30.0
+
+# frames used for the coarse offset search
+OFFSET_SAMPLES = 200
+
+# coarse offset histogram bins per frame period, and the fraction of
+# the highest peak another peak needs to be considered
+COARSE_BINS = 20
+PEAK_RATIO = 0.9
+
+# fewest matched frames for a fit to be used
+MIN_MATCHES = 10
+
+# largest clock rate error accepted from a fit
+MAX_DRIFT = 1.0e-3
+
+def catalogue_file(thermal_dir):
+    '''the catalogue file saved alongside a thermal directory or archive'''
+    return thermal_dir.rstrip('/') + CATALOGUE_SUFFIX
+
+def source_stamp(path):
+    '''(mtime_ns, size) identifying the state of a directory or file, None if missing'''
+    if path is None or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def stamp_or_none(stamp):
+    '''a stamp as loaded from a catalogue, None if it was saved as missing'''
+    stamp = tuple(int(v) for v in stamp)
+    return None if stamp == (0, 0) else stamp
+
+def coarse_offset(mtimes, events, period):
+    '''
+    offset to add to mtimes for the best match with events, from a
+    histogram of the differences between a sample of mtimes and all
+    events within MAX_OFFSET, preferring the smallest offset among near
+    equal peaks as a regular cadence matches at any whole number of
+    periods
+    '''
+    sample = mtimes[np.linspace(0, len(mtimes)-1, min(len(mtimes), OFFSET_SAMPLES)).astype(int)]
+    i0 = np.searchsorted(events, sample - MAX_OFFSET)
+    i1 = np.searchsorted(events, sample + MAX_OFFSET)
+    counts = i1 - i0
+    total = int(counts.sum())
+    if total == 0:
+        return None
+    # index of every event in the window of each sampled frame
+    idx = np.repeat(i0, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    diffs = events[idx] - np.repeat(sample, counts)
+    width = period / COARSE_BINS
+    nbins = int(np.ceil(2 * MAX_OFFSET / width))
+    hist = np.bincount(np.clip(((diffs + MAX_OFFSET) / width).astype(int), 0, nbins-1), minlength=nbins)
+    # score each bin with its neighbours so a peak split over a bin edge counts fully
+    score = np.convolve(hist, np.ones(3), mode='same')
+    centres = (np.arange(nbins) + 0.5) * width - MAX_OFFSET
+    peaks = np.flatnonzero(score >= PEAK_RATIO * score.max())
+    best = peaks[np.argmin(np.abs(centres[peaks]))]
+    # median difference around the chosen bin
+    near = np.abs(diffs - centres[best]) <= width
+    return float(np.median(diffs[near]))
+
+def match_events(mtimes, events, scale, offset, tolerance):
+    '''(frame indexes, event times) of frames with an event within tolerance of scale*mtime+offset'''
+    t = scale * mtimes + offset
+    i = np.clip(np.searchsorted(events, t), 1, len(events)-1)
+    # nearest of the events either side
+    before = events[i-1]
+    after = events[i]
+    nearest = np.where(t - before <= after - t, before, after)
+    ok = np.abs(nearest - t) <= tolerance
+    return (np.flatnonzero(ok), nearest[ok])
+
+def fit_clock(mtimes, events):
+    '''
+    (scale, offset, ref, matches) mapping frame mtimes onto the log clock
+    of sorted event times as ref + offset + scale * (mtime - ref), or None
+    if the events don't fit the frames
+    '''
+    if len(mtimes) < MIN_MATCHES or len(events) < MIN_MATCHES:
+        return None
+    period = float(np.median(np.diff(mtimes)))
+    if period <= 0:
+        return None
+    tolerance = 0.5 * period
+    # fitted relative to the first frame to keep the fit well conditioned
+    ref = float(mtimes[0])
+    rel = mtimes - ref
+    offset = coarse_offset(mtimes, events, period)
+    if offset is None:
+        return None
+    scale = 1.0
+    for i in range(2):
+        (idx, matched) = match_events(rel, events - ref, scale, offset, tolerance)
+        if len(idx) < MIN_MATCHES:
+            return None
+        (scale, offset) = np.polyfit(rel[idx], matched, 1)
+        # the second fit drops matches well off the first line
+        resid = matched - (scale * rel[idx] + offset)
+        tolerance = min(tolerance, max(3 * float(np.median(np.abs(resid))), 0.01))
+    if abs(scale - 1.0) > MAX_DRIFT:
+        return None
+    return (float(scale), float(offset), ref, len(idx))
+
+class FrameCatalogue(object):
+    '''the frames of a thermal directory or archive with their sizes, validity and aligned times'''
+    def __init__(self, thermal_dir, names, sizes, mtimes):
+        self.thermal_dir = thermal_dir
+        self.names = list(names)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self.valid = self.sizes == FRAME_BYTES
+        self.times = self.mtimes.copy()
+        self.scale = 1.0
+        self.offset = 0.0
+        self.ref = 0.0
+        self.matches = 0
+        self.events = None
+        self.stamp = None
+        self.log_stamp = None
+
+    @staticmethod
+    def scan(thermal_dir):
+        '''build a catalogue from one scandir pass or an archive index'''
+        with profiler.stage('catalogue_scan') as st:
+            if is_archive(thermal_dir):
+                arc = open_archive(thermal_dir)
+                ret = FrameCatalogue(thermal_dir, arc.names, arc.index['raw_size'], arc.mtimes)
+            else:
+                entries = scan_dir(thermal_dir)
+                ret = FrameCatalogue(thermal_dir, [e[0] for e in entries], [e[1] for e in entries],
+                                     [e[2] for e in entries])
+            st.count = len(ret.names)
+        ret.stamp = source_stamp(thermal_dir)
+        return ret
+
+    def paths(self):
+        '''frame paths in time order'''
+        return [os.path.join(self.thermal_dir, n) for n in self.names]
+
+    def valid_paths(self):
+        return [os.path.join(self.thermal_dir, self.names[i]) for i in np.flatnonzero(self.valid)]
+
+    def align(self, flight_log):
+        '''fit the valid frame times to the camera trigger or SITR records of a FlightLog'''
+        mtimes = self.mtimes[self.valid]
+        for etype in ['CAM', 'TRIG', 'SITR']:
+            events = np.sort(np.array(flight_log.frame_events.get(etype, []), dtype=np.float64))
+            fit = fit_clock(mtimes, events)
+            if fit is not None:
+                (self.scale, self.offset, self.ref, self.matches) = fit
+                self.events = etype
+                break
+        else:
+            (self.scale, self.offset, self.ref, self.matches, self.events) = (1.0, 0.0, 0.0, 0, None)
+        self.times = self.log_time(self.mtimes)
+        self.log_stamp = source_stamp(flight_log.binlog)
+        return self.events is not None
+
+    def log_time(self, mtime):
+        '''a time or array of times on the camera clock moved onto the log clock'''
+        return self.ref + self.offset + self.scale * (mtime - self.ref)
+
+    def register(self):
+        '''record the aligned times for getmtime()'''
+        set_frame_times(self.paths(), self.times)
+
+    def save(self, filename):
+        np.savez(filename, version=CATALOGUE_VERSION, names=np.array(self.names), sizes=self.sizes,
+                 mtimes=self.mtimes, times=self.times, scale=self.scale, offset=self.offset, ref=self.ref,
+                 matches=self.matches, events=str(self.events or ''),
+                 stamp=np.array(self.stamp or (0, 0), dtype=np.int64),
+                 log_stamp=np.array(self.log_stamp or (0, 0), dtype=np.int64))
+
+    @staticmethod
+    def load(filename, thermal_dir):
+        d = np.load(filename)
+        if int(d['version']) != CATALOGUE_VERSION:
+            return None
+        ret = FrameCatalogue(thermal_dir, d['names'].tolist(), d['sizes'], d['mtimes'])
+        ret.times = d['times']
+        ret.scale = float(d['scale'])
+        ret.offset = float(d['offset'])
+        ret.ref = float(d['ref'])
+        ret.matches = int(d['matches'])
+        ret.events = str(d['events']) or None
+        ret.stamp = stamp_or_none(d['stamp'])
+        ret.log_stamp = stamp_or_none(d['log_stamp'])
+        return ret
+
+    def describe(self):
+        if self.events is None:
+            return "%u frames %u valid, mtimes not aligned" % (len(self.names), self.valid.sum())
+        return "%u frames %u valid, aligned to %u %s records offset %.3fs drift %.1fppm" % (
+            len(self.names), self.valid.sum(), self.matches, self.events, self.offset, (self.scale - 1) * 1e6)
+
+def open_catalogue(thermal_dir, session=None, rebuild=False):
+    '''
+    load the saved catalogue of a thermal directory if it is up to date,
+    otherwise scan the frames, align them to the flight log of a
+    FlightSession if there is one and save the catalogue. The aligned
+    times are recorded for getmtime()
+    '''
+    fname = catalogue_file(thermal_dir)
+    binlog = session.binlog if session is not None else None
+    cat = None
+    if not rebuild and os.path.exists(fname):
+        try:
+            cat = FrameCatalogue.load(fname, thermal_dir)
+        except (OSError, ValueError, KeyError):
+            cat = None
+        if cat is not None and (cat.stamp != source_stamp(thermal_dir) or
+                                (binlog is not None and cat.log_stamp != source_stamp(binlog))):
+            cat = None
+    if cat is None:
+        cat = FrameCatalogue.scan(thermal_dir)
+        if binlog is not None and os.path.exists(binlog):
+            with profiler.stage('catalogue_align', count=len(cat.names)):
+                cat.align(session.flight_log())
+        print("Catalogue %s: %s" % (thermal_dir, cat.describe()))
+        try:
+            cat.save(fname)
+        except OSError as ex:
+            # eg. a read-only flight disk, the catalogue is rebuilt next time
+            print("Unable to save catalogue %s: %s" % (fname, ex))
+    cat.register()
+    return cat
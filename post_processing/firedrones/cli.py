@@ -0,0 +1,427 @@
+'''
+firedrones post-processing command line
+
+each product has its own subcommand, with the same arguments as the
+original scripts. The "all" subcommand makes several products from one
+flight directory, sharing the thermal file list, temperature range and
+parsed flight log between them
+'''
+
+import os
+import sys
+import argparse
+
+from .profiling import profiler
+from .products import PRODUCTS, DEFAULT_PRODUCTS
+
+def cmd_map(args):
+    from .session import FlightSession
+    from .mapping import create_map
+    from .terrain import open_terrain
+    from .redundancy import redundancy_from_options
+    from .products import product_ranging
+    session = FlightSession(binlog=args.binlog, thermal_dir=args.thermal_dir, time_delta=args.time_delta)
+    try:
+        terrain = open_terrain(args.terrain)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    create_map(session, args.output, min_temp=args.min_temp, videos=args.video, kml=args.kml,
+               local_server=args.local_server, thumbnails=args.thumbnails,
+               ranging=product_ranging(args),
+               terrain=terrain, coverage=args.coverage, redundancy=redundancy_from_options(args))
+
+def cmd_combined_video(args):
+    from .session import FlightSession
+    from .products import make_product
+    session = FlightSession(args.flight_dir)
+    make_product(session, 'combined-video', None, args, output=args.output)
+
+def cmd_fused_video(args):
+    from .session import FlightSession
+    from .products import make_product
+    session = FlightSession(args.flight_dir)
+    make_product(session, 'fused-video', None, args, output=args.output)
+
+def cmd_thermal_video(args):
+    from .archive import sorted_files
+    from .products import product_ranging
+    from .video import create_thermal_video, encode_profile_from_options
+    from .redundancy import redundancy_from_options
+    create_thermal_video(sorted_files(args.dir), args.output, product_ranging(args), fps=args.fps,
+                         profile=encode_profile_from_options(args), redundancy=redundancy_from_options(args))
+
+def cmd_csv(args):
+    from .thermal_csv import thermal_to_csv, parse_basepos
+    from .stats import statistics_from_options
+    try:
+        stats = statistics_from_options(args)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    thermal_to_csv(args.thermaldata, args.SIYI, parse_basepos(args.basepos),
+                   min_temp=args.min_temp, first_temp=args.first_temp,
+                   summary_file=args.summary, stats=stats, frame_csv=not args.no_frame_csv,
+                   out_dir=args.outdir)
+
+def cmd_coverage(args):
+    from .session import FlightSession
+    from .coverage import create_coverage
+    from .terrain import open_terrain
+    session = FlightSession(binlog=args.binlog, time_delta=args.time_delta)
+    try:
+        terrain = open_terrain(args.terrain)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    create_coverage(session, args.output, resolution=args.coverage_resolution, revisit_gap=args.revisit_gap,
+                    terrain=terrain)
+
+def cmd_merge(args):
+    from .logmerge import merge_logs
+    merge_logs(args.alog, args.slog, args.logout)
+
+def cmd_archive(args):
+    from .archive import create_archive, extract_archive, sorted_files, ThermalArchive, ARCHIVE_EXTENSION
+    if args.action == 'create':
+        dest = args.dest
+        if dest is None:
+            dest = args.source.rstrip('/') + ARCHIVE_EXTENSION
+        count = create_archive(args.source, dest, level=args.level)
+        raw_size = sum(os.path.getsize(f) for f in sorted_files(args.source))
+        print("Archived %u frames to %s ratio %.2f" % (count, dest, raw_size / float(max(os.path.getsize(dest), 1))))
+    elif args.action == 'extract':
+        if args.dest is None:
+            args.parser.error("extract needs an output directory")
+        count = extract_archive(args.source, args.dest)
+        print("Extracted %u frames to %s" % (count, args.dest))
+    else:
+        arc = ThermalArchive(args.source)
+        print("%s: %u frames" % (args.source, arc.count()))
+        if arc.count() > 0:
+            print("time range %.3f to %.3f" % (arc.mtimes[0], arc.mtimes[-1]))
+            print("compressed %u bytes raw %u bytes" % (arc.index['length'].sum(), arc.index['raw_size'].sum()))
+
+def cmd_catalogue(args):
+    from .session import FlightSession
+    from .catalogue import open_catalogue
+    session = FlightSession(args.flight_dir)
+    cat = open_catalogue(session.thermal_dir, session, rebuild=args.rebuild)
+    print("%s: %s" % (session.thermal_dir, cat.describe()))
+
+def cmd_clip(args):
+    from .session import FlightSession
+    from .clip import open_log_index, parse_window, event_windows, create_clips
+    session = FlightSession(args.flight_dir)
+    product_dir = args.product_dir if args.product_dir is not None else args.flight_dir
+    log_index = open_log_index(session.binlog)
+    try:
+        windows = [parse_window(w, log_index.start_time) for w in args.window]
+        if args.event:
+            windows += event_windows(args.event.split(','), log_index, product_dir,
+                                     before=args.before, after=args.after)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    if not windows:
+        args.parser.error("no clip windows, give --window or --event")
+    clips = create_clips(session, args.outdir, windows, product_dir=product_dir, codec=args.codec)
+    print("Created %u clips in %s" % (len(clips), args.outdir))
+
+def cmd_survey(args):
+    from .survey import SurveyGrid, add_flight
+    if args.action == 'add':
+        from .session import FlightSession
+        from .terrain import open_terrain
+        if args.flight_dir is None:
+            args.parser.error("add needs a flight directory")
+        session = FlightSession(args.flight_dir, time_delta=args.time_delta)
+        try:
+            add_flight(args.store, session, resolution=args.resolution, block=args.block,
+                       frame_interval=args.frame_interval, terrain=open_terrain(args.terrain))
+        except ValueError as ex:
+            args.parser.error(str(ex))
+        return
+    try:
+        grid = SurveyGrid(args.store)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    if args.action == 'info':
+        print("%s: %u flights %u tiles %u cells of %.1fm" % (args.store, len(grid.flights), len(grid.tile_info),
+                                                             grid.cell_count(), grid.resolution))
+        for f in grid.flights:
+            print("  %s %u observations" % (f['name'], f['observations']))
+        return
+    if args.action == 'hot':
+        cells = grid.hot_cells(args.min_temp, since=args.since)
+    else:
+        cells = grid.cooled_cells(args.min_temp, cool_temp=args.cool_temp)
+    if args.output is None:
+        cells.write_csv(sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            cells.write_csv(f)
+        print("Wrote %u %s cells to %s" % (len(cells), args.action, args.output))
+
+def cmd_serve(args):
+    from .viewer_server import run_server
+    live = None
+    if args.live is not None:
+        from .live import LiveTelemetry
+        live = LiveTelemetry(args.live, capacity=args.live_buffer, sample_rate=args.live_rate,
+                             push_rate=args.push_rate, speed=args.replay_speed)
+    run_server(args.flight_dir, args.port, args.kml, args.kml_cache, live=live)
+
+def cmd_all(args):
+    from .session import FlightSession
+    from .products import parse_products, make_products
+    try:
+        products = parse_products(args.products)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    outdir = args.outdir
+    if outdir is None:
+        outdir = args.flight_dir
+    os.makedirs(outdir, exist_ok=True)
+    session = FlightSession(args.flight_dir, time_delta=args.time_delta)
+    make_products(session, products, outdir, args)
+
+def cmd_batch(args):
+    from .products import parse_products
+    from .batch import BatchScheduler
+    try:
+        products = parse_products(args.products)
+    except ValueError as ex:
+        args.parser.error(str(ex))
+    scheduler = BatchScheduler(args.roots, products, args, outdir=args.outdir, workers=args.workers,
+                               max_encodes=args.max_encodes, max_memory=args.max_memory)
+    if args.dry_run:
+        scheduler.print_jobs()
+        return
+    if not scheduler.run():
+        sys.exit(1)
+
+def add_map_options(parser):
+    from .mapping import DEFAULT_KML
+    parser.add_argument('--min-temp', type=float, default=150.0, help='min temperature for display')
+    parser.add_argument('--time-delta', type=float, default=1.0, help='time resolution')
+    parser.add_argument('--kml', type=str, default=DEFAULT_KML, help='KML overlay URL')
+    parser.add_argument('--local-server', action='store_true', help='load the KML through the serve command local cache')
+    parser.add_argument('--thumbnails', action='store_true', help='create thermal thumbnail sprite sheets for the viewer')
+    parser.add_argument('--terrain', type=str, default=None, help='directory of SRTM .hgt tiles to project hotspots and footprints onto the terrain')
+
+def add_product_options(parser):
+    parser.add_argument('--products', type=str, default=DEFAULT_PRODUCTS, help='comma separated products from %s' % ','.join(PRODUCTS))
+    parser.add_argument('--fps', type=int, default=1, help='thermal video frame rate')
+    parser.add_argument('--basepos', type=str, default="-35.28251139,149.00575706,594.0", help='base position for csv')
+    add_map_options(parser)
+    add_combined_video_options(parser)
+    add_fused_options(parser)
+    add_csv_options(parser)
+    add_coverage_options(parser)
+    add_redundancy_options(parser)
+
+def add_redundancy_options(parser):
+    from .redundancy import DEFAULT_TOLERANCE
+    parser.add_argument('--skip-redundant', action='store_true', help='reuse the work for runs of near identical thermal frames, eg. while loitering')
+    parser.add_argument('--redundant-tolerance', type=float, default=DEFAULT_TOLERANCE, help='largest block temperature change in C for a frame to be redundant')
+
+def add_range_options(parser):
+    from .ranging import RANGE_MODES
+    parser.add_argument('--range', type=str, choices=RANGE_MODES, default='minmax', help='colormap range from the min/max of all frames, percentiles of all frames or per frame automatic gain control')
+    parser.add_argument('--range-low', type=float, default=0.5, help='low percentile for the colormap range')
+    parser.add_argument('--range-high', type=float, default=99.9, help='high percentile for the colormap range')
+    parser.add_argument('--agc-window', type=float, default=30.0, help='time constant in seconds for automatic gain control')
+
+def add_encode_options(parser):
+    from .video import ENCODE_PROFILES, DEFAULT_KEYFRAME_INTERVAL
+    parser.add_argument('--encode-profile', type=str, choices=ENCODE_PROFILES, default='default', help='video encoding, web gives wall clock aligned keyframes and a keyframe sidecar for seeking in the map viewer')
+    parser.add_argument('--keyframe-interval', type=float, default=DEFAULT_KEYFRAME_INTERVAL, help='seconds between keyframes for the web encode profile')
+
+def add_fused_options(parser):
+    parser.add_argument('--alpha', type=float, default=0.8, help='opacity of hot thermal pixels in the fused video')
+    parser.add_argument('--alpha-ramp', type=float, default=20.0, help='temperature rise above the threshold to reach full opacity')
+    parser.add_argument('--thermal-offset', type=str, default="0,0", help='thermal boresight offset from RGB as x,y degrees')
+
+def add_csv_options(parser):
+    from .stats import DEFAULT_PERCENTILES, DEFAULT_THRESHOLDS
+    parser.add_argument('--stats', action='store_true', help='add per frame mean, percentile and threshold count columns to the csv summary')
+    parser.add_argument('--percentiles', type=str, default=DEFAULT_PERCENTILES, help='comma separated percentiles for --stats')
+    parser.add_argument('--thresholds', type=str, default=DEFAULT_THRESHOLDS, help='comma separated temperatures to count pixels above for --stats')
+    parser.add_argument('--roi', type=str, action='append', default=[], help='region for --stats as NAME=x,y;x,y;... pixel polygon or NAME=MASKFILE')
+    parser.add_argument('--no-frame-csv', action='store_true', help='only write the csv summary, not a csv per frame')
+
+def add_coverage_options(parser):
+    from .coverage import DEFAULT_RESOLUTION, DEFAULT_REVISIT_GAP
+    parser.add_argument('--coverage-resolution', type=float, default=DEFAULT_RESOLUTION, help='coverage grid cell size in metres')
+    parser.add_argument('--revisit-gap', type=float, default=DEFAULT_REVISIT_GAP, help='seconds a cell must be out of view for the next view to count as a revisit')
+
+def add_combined_video_options(parser):
+    parser.add_argument('--temp-min', type=float, default=0, help='min temperature')
+    parser.add_argument('--temp-max', type=float, default=188, help='max temperature')
+    parser.add_argument('--threshold', type=float, default=80, help='color threshold')
+    parser.add_argument('--duration', type=float, default=None, help='duration in seconds')
+    parser.add_argument('--codec', type=str, default='h264', help='output codec')
+    add_range_options(parser)
+    add_encode_options(parser)
+
+def make_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--profile', type=str, default=None, help='write a Chrome trace profile to this file')
+    from .readahead import DEFAULT_DEPTH, DEFAULT_IO_WORKERS, DEFAULT_COMPUTE_WORKERS
+    common.add_argument('--readahead', type=int, default=DEFAULT_DEPTH, help='thermal frames read ahead of processing with --io-workers')
+    common.add_argument('--io-workers', type=int, default=DEFAULT_IO_WORKERS, help='threads reading thermal frames ahead, 0 reads in the main thread, default 0 on local disk and 2 on network file systems')
+    common.add_argument('--compute-workers', type=int, default=DEFAULT_COMPUTE_WORKERS, help='threads processing frames as they are read, 0 to process in the reading threads')
+
+    parser = argparse.ArgumentParser(prog='firedrones', description='firedrones flight post-processing')
+    sub = parser.add_subparsers(dest='command', metavar='COMMAND')
+    sub.required = True
+
+    p = sub.add_parser('map', parents=[common], help='create map html with flight path and heatmap')
+    p.add_argument('binlog', default=None, help='ArduPilot bin log')
+    p.add_argument('thermal_dir', default=None, help='thermal directory or archive')
+    p.add_argument('output', default=None, help='output html')
+    add_map_options(p)
+    p.add_argument('--video', type=str, action='append', default=[], help='video files')
+    p.add_argument('--coverage', type=str, default=None, help='coverage npz to show on the map')
+    p.add_argument('--temp-min', type=float, default=0, help='min temperature for the thumbnail colormap')
+    p.add_argument('--temp-max', type=float, default=188, help='max temperature for the thumbnail colormap')
+    add_range_options(p)
+    add_redundancy_options(p)
+    p.set_defaults(func=cmd_map)
+
+    p = sub.add_parser('combined-video', parents=[common], help='create RGB video with thermal PIP and flight state')
+    p.add_argument('flight_dir', default=None, help='flight data directory')
+    p.add_argument('output', default=None, help='output video')
+    p.add_argument('--fps', type=int, default=1, help='output frame rate')
+    add_combined_video_options(p)
+    add_redundancy_options(p)
+    p.set_defaults(func=cmd_combined_video)
+
+    p = sub.add_parser('fused-video', parents=[common], help='create RGB video with hot thermal pixels blended on')
+    p.add_argument('flight_dir', default=None, help='flight data directory')
+    p.add_argument('output', default=None, help='output video')
+    add_combined_video_options(p)
+    add_fused_options(p)
+    add_redundancy_options(p)
+    p.set_defaults(func=cmd_fused_video)
+
+    p = sub.add_parser('thermal-video', parents=[common], help='create colormapped thermal video')
+    p.add_argument('dir', default=None, help='thermal directory or archive')
+    p.add_argument('output', default=None, help='output video')
+    p.add_argument('--fps', type=int, default=1, help='frame rate')
+    p.add_argument('--temp-min', type=float, default=10, help='min temperature')
+    p.add_argument('--temp-max', type=float, default=150, help='max temperature')
+    add_range_options(p)
+    add_encode_options(p)
+    add_redundancy_options(p)
+    p.set_defaults(func=cmd_thermal_video)
+
+    p = sub.add_parser('csv', parents=[common], help='convert thermal images to CSV')
+    p.add_argument('thermaldata', nargs="+", default=[], help='thermal bin files')
+    p.add_argument('--SIYI', default=None, help='SIYI bin log')
+    p.add_argument('--min-temp', type=float, default=-100, help='min temperature for convert')
+    p.add_argument('--first-temp', type=float, default=200, help='min first temperature for convert')
+    p.add_argument('--basepos', type=str, default="-35.28251139,149.00575706,594.0", help='base position')
+    p.add_argument('--summary', type=str, default="summary.csv", help='summary output file')
+    p.add_argument('--outdir', type=str, default=None, help='directory for the frame CSVs, default that of the summary')
+    add_csv_options(p)
+    add_redundancy_options(p)
+    p.set_defaults(func=cmd_csv)
+
+    p = sub.add_parser('coverage', parents=[common], help='create a thermal camera coverage and revisit raster')
+    p.add_argument('binlog', help='ArduPilot bin log')
+    p.add_argument('output', help='output npz, a png and kml overlay are written alongside')
+    p.add_argument('--time-delta', type=float, default=1.0, help='time resolution')
+    p.add_argument('--terrain', type=str, default=None, help='directory of SRTM .hgt tiles to project footprints onto the terrain')
+    add_coverage_options(p)
+    p.set_defaults(func=cmd_coverage)
+
+    p = sub.add_parser('merge', parents=[common], help='merge a SIYI log into an ArduPilot bin log')
+    p.add_argument("alog", metavar="ALOG")
+    p.add_argument("slog", metavar="SLOG")
+    p.add_argument("logout", metavar="LOGOUT")
+    p.set_defaults(func=cmd_merge)
+
+    p = sub.add_parser('archive', parents=[common], help='thermal frame archive tool')
+    p.add_argument('action', choices=['create', 'extract', 'info'], help='action')
+    p.add_argument('source', help='thermal directory for create, archive otherwise')
+    p.add_argument('dest', nargs='?', default=None, help='output archive or directory')
+    p.add_argument('--level', type=int, default=1, help='zlib compression level')
+    p.set_defaults(func=cmd_archive)
+
+    p = sub.add_parser('catalogue', parents=[common], help='catalogue thermal frames with times aligned to the flight log')
+    p.add_argument('flight_dir', help='flight data directory')
+    p.add_argument('--rebuild', action='store_true', help='rebuild the catalogue even if it is up to date')
+    p.set_defaults(func=cmd_catalogue)
+
+    from .clip import DEFAULT_BEFORE, DEFAULT_AFTER, EVENT_TYPES
+    p = sub.add_parser('clip', parents=[common], help='extract clip flight directories around events')
+    p.add_argument('flight_dir', help='flight data directory')
+    p.add_argument('outdir', help='directory to create the clips in')
+    p.add_argument('--window', type=str, action='append', default=[], help='clip window as START:END seconds from the start of the log')
+    p.add_argument('--event', type=str, default=None, help='comma separated events to clip around from %s' % ','.join(EVENT_TYPES))
+    p.add_argument('--before', type=float, default=DEFAULT_BEFORE, help='seconds of clip before an event')
+    p.add_argument('--after', type=float, default=DEFAULT_AFTER, help='seconds of clip after an event')
+    p.add_argument('--product-dir', type=str, default=None, help='directory of the products to clip, default the flight directory')
+    p.add_argument('--codec', type=str, default='h264', help='codec for the re-encoded edges of video cuts')
+    p.set_defaults(func=cmd_clip)
+
+    from .survey import DEFAULT_RESOLUTION as SURVEY_RESOLUTION, DEFAULT_BLOCK, DEFAULT_FRAME_INTERVAL, DEFAULT_HOT_TEMP
+    p = sub.add_parser('survey', parents=[common], help='multi-flight survey grid of observed temperatures')
+    p.add_argument('action', choices=['add', 'hot', 'cooled', 'info'], help='action')
+    p.add_argument('store', help='survey store directory')
+    p.add_argument('flight_dir', nargs='?', default=None, help='flight data directory for add')
+    p.add_argument('--resolution', type=float, default=SURVEY_RESOLUTION, help='cell size in metres when creating the store')
+    p.add_argument('--block', type=int, default=DEFAULT_BLOCK, help='thermal pixels per observation block side')
+    p.add_argument('--frame-interval', type=float, default=DEFAULT_FRAME_INTERVAL, help='minimum seconds between frames added')
+    p.add_argument('--time-delta', type=float, default=1.0, help='time resolution')
+    p.add_argument('--terrain', type=str, default=None, help='directory of SRTM .hgt tiles to project observations onto the terrain')
+    p.add_argument('--min-temp', type=float, default=DEFAULT_HOT_TEMP, help='temperature of a hot cell')
+    p.add_argument('--cool-temp', type=float, default=None, help='temperature below which a hot cell has cooled, default min-temp')
+    p.add_argument('--since', type=float, default=None, help='only hot cells last seen after this unix time')
+    p.add_argument('--output', type=str, default=None, help='output CSV, default stdout')
+    p.set_defaults(func=cmd_survey)
+
+    from .live import DEFAULT_CAPACITY, DEFAULT_SAMPLE_RATE, DEFAULT_PUSH_RATE
+    p = sub.add_parser('serve', parents=[common], help='local viewer server for a flight directory')
+    p.add_argument('flight_dir', help='directory containing the map output')
+    p.add_argument('--port', type=int, default=8000, help='HTTP port')
+    p.add_argument('--kml', type=str, action='append', default=["http://uav.tridgell.net/.Angel/FB810-Bullen.kml"], help='KML URLs to cache')
+    p.add_argument('--kml-cache', type=str, default=os.path.join(os.getenv('HOME', '.'), ".firedrones_kml"), help='KML cache directory')
+    p.add_argument('--live', type=str, default=None, help='live telemetry MAVLink connection, or a .bin log to replay')
+    p.add_argument('--replay-speed', type=float, default=1.0, help='speed up factor when replaying a log')
+    p.add_argument('--live-rate', type=float, default=DEFAULT_SAMPLE_RATE, help='live telemetry samples per second')
+    p.add_argument('--push-rate', type=float, default=DEFAULT_PUSH_RATE, help='live updates sent to viewers per second')
+    p.add_argument('--live-buffer', type=int, default=DEFAULT_CAPACITY, help='live telemetry samples kept for new viewers')
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('all', parents=[common], help='create several products from one flight directory')
+    p.add_argument('flight_dir', default=None, help='flight data directory')
+    p.add_argument('--outdir', type=str, default=None, help='output directory, default the flight directory')
+    add_product_options(p)
+    p.set_defaults(func=cmd_all)
+
+    p = sub.add_parser('batch', parents=[common], help='create products for all flight directories under some directories')
+    p.add_argument('roots', nargs='+', help='directories to search for flight directories')
+    p.add_argument('--outdir', type=str, default=None, help='output directory, default each flight directory')
+    p.add_argument('--workers', type=int, default=None, help='max worker processes, default the number of CPUs')
+    p.add_argument('--max-encodes', type=int, default=2, help='max concurrent video encodes')
+    p.add_argument('--max-memory', type=float, default=None, help='memory budget in MB, default half of physical memory')
+    p.add_argument('--dry-run', action='store_true', help='list the jobs without running them')
+    add_product_options(p)
+    p.set_defaults(func=cmd_batch)
+
+    return parser
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    args.parser = parser
+    if args.profile:
+        profiler.enable(args.profile)
+    from .readahead import readahead_from_options
+    try:
+        readahead_from_options(args)
+    except ValueError as ex:
+        parser.error(str(ex))
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
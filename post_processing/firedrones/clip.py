@@ -0,0 +1,456 @@
+'''
+extraction of short clips of a flight around events
+
+a clip is a flight directory of its own covering a time window, with
+the log records, thermal frames, flight samples, hotspots and videos
+of the window, so every other tool can be run on it
+
+the bin logs are sliced with a time index saved alongside each log,
+mapping a grid of times every INDEX_INTERVAL seconds to the file offset
+of the first record at or after that time. The index is built from the
+record offsets pymavlink finds when opening the log, reading the TimeUS
+field of every timed record with one numpy gather rather than parsing
+the records. A slice is the format, unit and parameter records, the
+last MODE record before the window and then a plain byte copy of the
+records in the window, so records within INDEX_INTERVAL of the window
+edges may be included. Thermal frames are selected from the frame
+catalogue times and hard linked where possible, and the flight samples
+and hotspots are selected with the viewer's TimeIndex
+
+videos are cut without re-encoding the whole window. The keyframes come
+from the keyframe sidecar of the web encode profile when there is one,
+otherwise from decoding only the keyframes. The GOPs between the first
+and last keyframe in the window are stream copied, and only the partial
+GOPs at the edges are re-encoded, with all the pieces joined by the
+concat demuxer. The videos are assumed to have closed GOPs, as the
+videos made here do, and only the video stream is kept
+'''
+
+import os
+import json
+import shutil
+import tempfile
+from datetime import datetime
+import numpy as np
+
+from .archive import is_archive, open_archive
+from .catalogue import source_stamp
+from .profiling import profiler
+from .video import (RGB_DIR, THERMAL_DIR, LOG_NAME, SIYI_LOG_NAME, probe_keyframes, keyframe_map_file,
+                    write_keyframe_map)
+
+INDEX_SUFFIX = ".timeindex.npz"
+INDEX_VERSION = 1
+
+# seconds between time index entries
+INDEX_INTERVAL = 0.1
+
+# resolution of TimeUS, records this close to a window edge are in the window
+TIME_RESOLUTION = 1.0e-6
+
+# records copied into every slice however early they are in the log
+HEADER_TYPES = ['FMT', 'FMTU', 'UNIT', 'MULT', 'PARM', 'VER']
+
+# records of which the last one before a window is copied into the slice
+STATE_TYPES = ['MODE']
+
+# default seconds of a clip before and after an event
+DEFAULT_BEFORE = 10.0
+DEFAULT_AFTER = 20.0
+
+EVENT_TYPES = ['mode', 'hotspot']
+
+# a cut closer than this to a keyframe is taken as on the keyframe
+KEYFRAME_TOLERANCE = 0.01
+
+# stream copies seek this far after their first keyframe so the seek
+# lands on it, and read this far past their last keyframe so the copy is
+# closed there
+SEEK_MARGIN = 0.001
+COPY_OVERRUN = 1.0
+
+# product videos which are clipped along with the RGB videos
+CLIP_VIDEOS = ['thermal.mp4', 'combined.mp4', 'fused.mp4']
+
+# flight sample files of the map product which are clipped
+CLIP_JSON = ['flight.json', 'hotspots.json']
+
+COPY_CHUNK = 256*1024
+
+def index_file(logfile):
+    '''the time index file saved alongside a bin log'''
+    return logfile + INDEX_SUFFIX
+
+def gather_timeus(data, offsets):
+    '''TimeUS of the records at offsets, the first field after the 3 byte header'''
+    idx = np.asarray(offsets, dtype=np.int64)[:,None] + 3 + np.arange(8)
+    return data[idx].copy().view('<u8')[:,0]
+
+class LogIndex(object):
+    '''time index of a DataFlash bin log'''
+    def __init__(self, start_time, grid_offsets, data_len, headers, states):
+        self.start_time = start_time
+        self.grid_offsets = grid_offsets
+        self.data_len = data_len
+        # (offset, length) of the header records
+        self.headers = headers
+        # (time, offset, length) of the state records
+        self.states = states
+        self.stamp = None
+
+    @staticmethod
+    def build(logfile):
+        '''index a bin log from the record offsets found by pymavlink'''
+        from pymavlink import mavutil
+
+        mlog = mavutil.mavlink_connection(logfile)
+        data = np.memmap(logfile, dtype=np.uint8, mode='r')
+        timed = []
+        headers = []
+        states = []
+        for i in range(256):
+            if mlog.counts[i] <= 0 or not i in mlog.formats:
+                continue
+            fmt = mlog.formats[i]
+            offsets = np.array(mlog.offsets[i], dtype=np.int64)
+            lengths = np.full(len(offsets), fmt.len, dtype=np.int64)
+            if fmt.name in HEADER_TYPES:
+                headers.append(np.stack((offsets, lengths), axis=1))
+            if fmt.columns[:1] != ['TimeUS'] or fmt.format[:1] != 'Q':
+                continue
+            us = gather_timeus(data, offsets)
+            timed.append(np.stack((offsets, us.astype(np.int64)), axis=1))
+            if fmt.name in STATE_TYPES:
+                states.append(np.stack((us.astype(np.int64), offsets, lengths), axis=1))
+        if not timed:
+            raise ValueError("%s has no timed records" % logfile)
+        timed = np.concatenate(timed)
+        timed = timed[np.argsort(timed[:,0], kind='stable')]
+        base = log_timebase(mlog)
+        # the log is written in time order, make small reorderings monotonic
+        times = base + 1.0e-6 * np.maximum.accumulate(timed[:,1])
+        start_time = np.floor(times[0] / INDEX_INTERVAL) * INDEX_INTERVAL
+        grid = start_time + INDEX_INTERVAL * np.arange(int(np.ceil((times[-1] - start_time) / INDEX_INTERVAL)) + 1)
+        i = np.searchsorted(times, grid, side='left')
+        grid_offsets = np.append(timed[:,0], data.shape[0])[i]
+        headers = np.concatenate(headers) if headers else np.zeros((0,2), dtype=np.int64)
+        headers = headers[np.argsort(headers[:,0])]
+        if states:
+            states = np.concatenate(states).astype(np.float64)
+            states[:,0] = base + 1.0e-6 * states[:,0]
+            states = states[np.argsort(states[:,1])]
+        else:
+            states = np.zeros((0,3))
+        ret = LogIndex(float(start_time), grid_offsets, int(data.shape[0]), headers, states)
+        ret.stamp = source_stamp(logfile)
+        return ret
+
+    def grid_times(self):
+        '''times of the index entries, as computed when the index was built'''
+        return self.start_time + INDEX_INTERVAL * np.arange(len(self.grid_offsets))
+
+    def offset_at(self, t):
+        '''offset of the first record at or after the index entry at or before t'''
+        i = int(np.searchsorted(self.grid_times(), t + TIME_RESOLUTION, side='right')) - 1
+        return int(self.grid_offsets[max(i, 0)])
+
+    def offset_after(self, t):
+        '''offset of the first record at or after the first index entry after t, so records at t are before it'''
+        i = int(np.searchsorted(self.grid_times(), t + TIME_RESOLUTION, side='right'))
+        if i >= len(self.grid_offsets):
+            return self.data_len
+        return int(self.grid_offsets[i])
+
+    def state_times(self):
+        return self.states[:,0]
+
+    def slice(self, logfile, output, t0, t1):
+        '''write the records of logfile between times t0 and t1 to output, returning the bytes of records copied'''
+        start = self.offset_at(t0)
+        end = self.offset_after(t1)
+        if end <= start:
+            return 0
+        records = [(int(o), int(n)) for (o, n) in self.headers[self.headers[:,0] < start]]
+        before = self.states[(self.states[:,0] < t0) & (self.states[:,1] < start)]
+        if len(before) > 0:
+            records.append((int(before[-1,1]), int(before[-1,2])))
+        records.sort()
+        with open(logfile, 'rb') as f, open(output, 'wb') as out:
+            for (ofs, length) in records:
+                f.seek(ofs)
+                out.write(f.read(length))
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                buf = f.read(min(COPY_CHUNK, remaining))
+                if not buf:
+                    break
+                out.write(buf)
+                remaining -= len(buf)
+        return end - start - remaining
+
+    def save(self, filename):
+        np.savez(filename, version=INDEX_VERSION, start_time=self.start_time, grid_offsets=self.grid_offsets,
+                 data_len=self.data_len, headers=self.headers, states=self.states,
+                 stamp=np.array(self.stamp or (0, 0), dtype=np.int64))
+
+    @staticmethod
+    def load(filename):
+        d = np.load(filename)
+        if int(d['version']) != INDEX_VERSION:
+            return None
+        ret = LogIndex(float(d['start_time']), d['grid_offsets'], int(d['data_len']), d['headers'], d['states'])
+        ret.stamp = tuple(int(v) for v in d['stamp'])
+        return ret
+
+def log_timebase(mlog):
+    '''unix time of TimeUS zero, from the first timed records pymavlink gives a timestamp'''
+    bases = []
+    while len(bases) < 10:
+        m = mlog.recv_msg()
+        if m is None:
+            break
+        if hasattr(m, 'TimeUS'):
+            bases.append(m._timestamp - m.TimeUS * 1.0e-6)
+    if not bases:
+        return 0.0
+    return float(np.median(bases))
+
+def open_log_index(logfile, rebuild=False):
+    '''load the saved time index of a bin log if it is up to date, otherwise build and save it'''
+    fname = index_file(logfile)
+    if not rebuild and os.path.exists(fname):
+        try:
+            idx = LogIndex.load(fname)
+        except (OSError, ValueError, KeyError):
+            idx = None
+        if idx is not None and idx.stamp == source_stamp(logfile):
+            return idx
+    with profiler.stage('log_index'):
+        idx = LogIndex.build(logfile)
+    try:
+        idx.save(fname)
+    except OSError as ex:
+        print("Unable to save log index %s: %s" % (fname, ex))
+    return idx
+
+def parse_window(spec, start_time):
+    '''(t0, t1) from START:END in seconds from start_time'''
+    try:
+        (a, b) = [float(v) for v in spec.split(':')]
+    except ValueError:
+        raise ValueError("bad clip window %s, expected START:END seconds" % spec)
+    if b <= a:
+        raise ValueError("clip window %s ends before it starts" % spec)
+    return (start_time + a, start_time + b)
+
+def merge_windows(windows):
+    '''sorted list of windows with overlapping windows merged'''
+    ret = []
+    for (t0, t1) in sorted(windows):
+        if ret and t0 <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], t1))
+        else:
+            ret.append((t0, t1))
+    return ret
+
+def hotspot_times(product_dir):
+    '''times of the hotspots of a map product, empty if there is none'''
+    fname = os.path.join(product_dir, 'hotspots.json')
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return [h['timestamp'] for h in json.load(f)]
+
+def event_windows(events, log_index, product_dir, before=DEFAULT_BEFORE, after=DEFAULT_AFTER):
+    '''windows around each mode change and hotspot'''
+    times = []
+    for e in events:
+        if e == 'mode':
+            times += log_index.state_times().tolist()
+        elif e == 'hotspot':
+            times += hotspot_times(product_dir)
+        else:
+            raise ValueError("unknown clip event %s, choose from %s" % (e, ','.join(EVENT_TYPES)))
+    return [(t - before, t + after) for t in times]
+
+def clip_frames(cat, out_dir, t0, t1):
+    '''hard link or copy the frames of a FrameCatalogue between t0 and t1, returning the number of frames'''
+    thermal_dir = cat.thermal_dir
+    i0 = np.searchsorted(cat.times, t0, side='left')
+    i1 = np.searchsorted(cat.times, t1, side='right')
+    if i1 <= i0:
+        return 0
+    os.makedirs(out_dir, exist_ok=True)
+    if is_archive(thermal_dir):
+        arc = open_archive(thermal_dir)
+        for i in range(i0, i1):
+            fname = os.path.join(out_dir, arc.names[i])
+            with open(fname, 'wb') as f:
+                f.write(arc.read_bytes(i))
+            os.utime(fname, (arc.mtimes[i], arc.mtimes[i]))
+        return i1 - i0
+    for i in range(i0, i1):
+        src = os.path.join(thermal_dir, cat.names[i])
+        dst = os.path.join(out_dir, cat.names[i])
+        try:
+            os.link(src, dst)
+        except OSError:
+            # eg. the clip on another file system, the copy keeps the mtime
+            shutil.copy2(src, dst)
+    return i1 - i0
+
+def clip_json(fname, output, t0, t1):
+    '''write the records of a flight.json style file between t0 and t1, returning the number of records'''
+    from .viewer_server import TimeIndex
+    with open(fname) as f:
+        index = TimeIndex(json.load(f))
+    records = index.get(index.query(t0, t1))
+    with open(output, 'w') as f:
+        json.dump(records, f, indent=1)
+    return len(records)
+
+def video_keyframes(video):
+    '''(start_time, duration, keyframe times in the video) from the keyframe sidecar if any, otherwise probed'''
+    sidecar = keyframe_map_file(video)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(video):
+        with open(sidecar) as f:
+            j = json.load(f)
+        start_time = j['start_time']
+        return (start_time, os.path.getmtime(video) - start_time, [k[1] for k in j['keyframes']])
+    (duration, keyframes) = probe_keyframes(video)
+    return (os.path.getmtime(video) - duration, duration, keyframes)
+
+def cut_segments(keyframes, a, b):
+    '''
+    list of (start, end, copy) pieces of a cut from a to b seconds into a
+    video, copying whole GOPs between the first and last keyframes in the
+    cut and re-encoding the rest
+    '''
+    k = [t for t in keyframes if a - KEYFRAME_TOLERANCE <= t <= b + KEYFRAME_TOLERANCE]
+    if len(k) < 2:
+        return [(a, b, False)]
+    ret = []
+    if k[0] > a + KEYFRAME_TOLERANCE:
+        ret.append((a, k[0], False))
+    ret.append((k[0], k[-1], True))
+    if b > k[-1] + KEYFRAME_TOLERANCE:
+        ret.append((k[-1], b, False))
+    return ret
+
+def cut_video(video, output, t0, t1, codec='h264', log_time=None):
+    '''
+    cut the part of a video between log clock times t0 and t1, with its
+    mtime set to the end of the cut as for the other videos. A video timed
+    on the camera clock is given the log_time function to move its times
+    onto the log clock, its mtime stays on the camera clock. Returns the
+    (start, end, copy) pieces, or None if the video is outside the window
+    '''
+    (start_time, duration, keyframes) = video_keyframes(video)
+    log_start = log_time(start_time) if log_time is not None else start_time
+    a = max(t0 - log_start, 0.0)
+    b = min(t1 - log_start, duration)
+    if b <= a:
+        return None
+    segments = cut_segments(keyframes, a, b)
+    tmpdir = tempfile.mkdtemp(prefix='clip', dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        flist = os.path.join(tmpdir, 'segments.txt')
+        with open(flist, 'w') as f:
+            for (i, (s, e, copy)) in enumerate(segments):
+                seg = os.path.join(tmpdir, 'seg%u.mkv' % i)
+                args = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+                if copy:
+                    # a stream copy starts at the keyframe at or before the
+                    # seek. The -t limit of a copy is on decode times so can
+                    # take frames past the last keyframe, instead the segment
+                    # muxer closes the first piece at the last keyframe
+                    args += ['-ss', '%.6f' % (s + SEEK_MARGIN), '-i', video, '-t', '%.6f' % (e - s + COPY_OVERRUN),
+                             '-map', '0:v:0', '-an', '-c:v', 'copy',
+                             '-f', 'segment', '-segment_format', 'matroska',
+                             '-segment_times', '%.6f' % (e - s - 2 * SEEK_MARGIN),
+                             os.path.join(tmpdir, 'copy%u_%%d.mkv' % i)]
+                    profiler.run(args, name='ffmpeg clip copy', check=True)
+                    os.rename(os.path.join(tmpdir, 'copy%u_0.mkv' % i), seg)
+                else:
+                    args += ['-ss', '%.6f' % s, '-i', video, '-t', '%.6f' % (e - s),
+                             '-map', '0:v:0', '-an', '-c:v', codec, '-pix_fmt', 'yuv420p', seg]
+                    profiler.run(args, name='ffmpeg clip encode', check=True)
+                # the piece durations as cut, a copied piece's container
+                # duration includes its reordering delay
+                f.write("file '%s'\nduration %.6f\n" % (seg, e - s))
+        profiler.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                      '-i', flist, '-c', 'copy', '-movflags', 'faststart', output],
+                     name='ffmpeg clip concat', check=True)
+    finally:
+        shutil.rmtree(tmpdir)
+    end_time = start_time + b
+    os.utime(output, (end_time, end_time))
+    if os.path.exists(keyframe_map_file(video)):
+        with open(keyframe_map_file(video)) as f:
+            interval = json.load(f)['interval']
+        write_keyframe_map(output, interval)
+    return segments
+
+def clip_name(t0, t1):
+    return "clip_%s_%us" % (datetime.fromtimestamp(t0).strftime('%Y%m%d_%H%M%S'), int(round(t1 - t0)))
+
+def create_clip(session, out_dir, t0, t1, product_dir=None, codec='h264', log_index=None):
+    '''
+    create a clip flight directory in out_dir for a FlightSession between
+    t0 and t1, with the products in product_dir clipped too
+    '''
+    if product_dir is None:
+        product_dir = session.flight_dir
+    os.makedirs(out_dir, exist_ok=True)
+    print("Clip %s from %s to %s" % (out_dir, datetime.fromtimestamp(t0), datetime.fromtimestamp(t1)))
+
+    with profiler.stage('clip_logs'):
+        for (logfile, name, idx) in [(session.binlog, LOG_NAME, log_index), (session.siyi_log, SIYI_LOG_NAME, None)]:
+            if logfile is None or not os.path.exists(logfile):
+                continue
+            if idx is None:
+                idx = open_log_index(logfile)
+            n = idx.slice(logfile, os.path.join(out_dir, name), t0, t1)
+            print("Sliced %u bytes of %s" % (n, logfile))
+
+    if session.thermal_dir is not None and os.path.exists(session.thermal_dir):
+        with profiler.stage('clip_frames') as st:
+            st.count = clip_frames(session.catalogue(), os.path.join(out_dir, THERMAL_DIR), t0, t1)
+        print("Clipped %u thermal frames" % st.count)
+
+    if product_dir is not None:
+        for name in CLIP_JSON:
+            fname = os.path.join(product_dir, name)
+            if os.path.exists(fname):
+                n = clip_json(fname, os.path.join(out_dir, name), t0, t1)
+                print("Clipped %u records of %s" % (n, name))
+
+    # the raw RGB videos are on the camera clock, the products on the log clock
+    videos = []
+    if session.rgb_dir is not None and os.path.isdir(session.rgb_dir):
+        videos += [(v, os.path.join(out_dir, RGB_DIR, os.path.basename(v)), session.log_time)
+                   for v in session.rgb_videos()]
+    if product_dir is not None:
+        videos += [(os.path.join(product_dir, v), os.path.join(out_dir, v), None) for v in CLIP_VIDEOS
+                   if os.path.exists(os.path.join(product_dir, v))]
+    for (video, output, log_time) in videos:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with profiler.stage('clip_video'):
+            segments = cut_video(video, output, t0, t1, codec=codec, log_time=log_time)
+        if segments is not None:
+            copied = sum(e - s for (s, e, copy) in segments if copy)
+            print("Cut %s, %.1fs copied %.1fs re-encoded" % (output, copied,
+                                                              sum(e - s for (s, e, copy) in segments) - copied))
+
+def create_clips(session, out_dir, windows, product_dir=None, codec='h264'):
+    '''create a clip under out_dir for each of a list of (t0, t1) windows, merging overlapping windows'''
+    log_index = None
+    if session.binlog is not None and os.path.exists(session.binlog):
+        log_index = open_log_index(session.binlog)
+    ret = []
+    for (t0, t1) in merge_windows(windows):
+        clip_dir = os.path.join(out_dir, clip_name(t0, t1))
+        create_clip(session, clip_dir, t0, t1, product_dir=product_dir, codec=codec, log_index=log_index)
+        ret.append(clip_dir)
+    return ret
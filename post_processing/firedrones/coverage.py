@@ -0,0 +1,247 @@
+'''
+thermal camera coverage and revisit counts on a ground grid
+
+the thermal footprint of every flight position is projected to the
+ground as a quadrilateral, with the terrain if a TerrainModel is given.
+The grid is a north-up raster of square cells around the footprints.
+Each footprint is cut into scanline spans, one half-open range of cells
+per grid row crossed, with the spans of all footprints computed together
+from the edge crossings of each row. The spans are expanded to flat cell
+indexes, then sample counts come from a bincount, and distinct visits
+and last-seen times from a stable sort of the covered cells by time.
+
+a visit is a run of samples covering a cell with no gap longer than
+revisit_gap seconds, so the slow drift of consecutive footprints over a
+cell counts once while coming back on a later pass counts again
+
+the grid is saved as a compressed npz, with a PNG of the visit counts
+and a KML GroundOverlay for showing it on a map
+'''
+
+import os
+import math
+import numpy as np
+
+from .flight import footprint_corners, thermal_FOV, thermal_width, thermal_height
+from .terrain import RADIUS_OF_EARTH
+from .profiling import profiler
+
+COVERAGE_NAME = "coverage.npz"
+DEFAULT_RESOLUTION = 2.0
+DEFAULT_REVISIT_GAP = 30.0
+
+# refuse grids larger than this, eg. from a footprint at the horizon
+MAX_CELLS = 100000000
+
+# footprints accumulated at a time
+CHUNK = 1024
+
+# visit counts at or above this get the last colour of the overlay
+OVERLAY_MAX_VISITS = 5
+
+def polygon_spans(px, py, width, height):
+    '''
+    scanline spans of (F,K) convex polygon vertices in cell coordinates,
+    covering the cells with centres inside each polygon. Returns arrays
+    of (polygon, row, x0, x1) for the half-open span x0 to x1 of each row
+    '''
+    F = px.shape[0]
+    # rows with centres between the top and bottom of each polygon
+    ymin = np.clip(np.ceil(py.min(axis=1) - 0.5), 0, height).astype(np.intp)
+    ymax = np.clip(np.floor(py.max(axis=1) - 0.5) + 1, 0, height).astype(np.intp)
+    nrows = np.maximum(ymax - ymin, 0)
+    total = int(nrows.sum())
+    poly = np.repeat(np.arange(F), nrows)
+    row = ymin[poly] + np.arange(total) - np.repeat(np.cumsum(nrows) - nrows, nrows)
+    yc = (row + 0.5)[:,None]
+
+    # crossing of each edge of the polygon with the row centre line
+    (xa, ya) = (px[poly], py[poly])
+    (xb, yb) = (np.roll(px, -1, axis=1)[poly], np.roll(py, -1, axis=1)[poly])
+    crosses = (ya <= yc) != (yb <= yc)
+    dy = np.where(crosses, yb - ya, 1.0)
+    xc = xa + (yc - ya) / dy * (xb - xa)
+    xl = np.where(crosses, xc, np.inf).min(axis=1)
+    xr = np.where(crosses, xc, -np.inf).max(axis=1)
+
+    ok = np.isfinite(xl) & np.isfinite(xr)
+    x0 = np.zeros(total, dtype=np.intp)
+    x1 = np.zeros(total, dtype=np.intp)
+    x0[ok] = np.clip(np.ceil(xl[ok] - 0.5), 0, width)
+    x1[ok] = np.clip(np.floor(xr[ok] - 0.5) + 1, 0, width)
+    keep = x1 > x0
+    return (poly[keep], row[keep], x0[keep], x1[keep])
+
+class CoverageGrid(object):
+    '''
+    sample counts, visit counts and last seen times on a north-up grid of
+    resolution metre cells with its north west corner at lat,lon
+    '''
+    def __init__(self, lat, lon, resolution, width, height, revisit_gap=DEFAULT_REVISIT_GAP, start_time=0.0):
+        if width * height > MAX_CELLS:
+            raise ValueError("coverage grid of %ux%u cells is too large, use a coarser resolution" % (width, height))
+        self.lat = lat
+        self.lon = lon
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+        self.revisit_gap = revisit_gap
+        self.start_time = start_time
+        self.dlat = math.degrees(resolution / RADIUS_OF_EARTH)
+        self.dlon = self.dlat / math.cos(math.radians(lat))
+        self.samples = np.zeros(width * height, dtype=np.uint32)
+        self.visits = np.zeros(width * height, dtype=np.uint32)
+        # seconds after start_time, NaN for never seen
+        self.last_seen = np.full(width * height, np.nan)
+
+    @staticmethod
+    def around(lats, lons, resolution, revisit_gap=DEFAULT_REVISIT_GAP, start_time=0.0, margin=2):
+        '''a grid covering arrays of lat,lon with a margin of cells'''
+        dlat = math.degrees(resolution / RADIUS_OF_EARTH)
+        north = float(np.max(lats)) + margin * dlat
+        south = float(np.min(lats)) - margin * dlat
+        dlon = dlat / math.cos(math.radians(north))
+        west = float(np.min(lons)) - margin * dlon
+        east = float(np.max(lons)) + margin * dlon
+        width = int(math.ceil((east - west) / dlon))
+        height = int(math.ceil((north - south) / dlat))
+        return CoverageGrid(north, west, resolution, width, height, revisit_gap=revisit_gap, start_time=start_time)
+
+    def to_cells(self, lat, lon):
+        '''cell coordinates of lat,lon, x east and y south from the north west corner'''
+        return ((lon - self.lon) / self.dlon, (self.lat - lat) / self.dlat)
+
+    def bounds(self):
+        '''bounds as used by a Google Maps GroundOverlay'''
+        return { 'north' : self.lat, 'south' : self.lat - self.height * self.dlat,
+                 'west' : self.lon, 'east' : self.lon + self.width * self.dlon }
+
+    def add_footprints(self, times, lats, lons):
+        '''
+        add (F,K) polygon footprints seen at times, which must be in time
+        order and after any footprints already added
+        '''
+        (px, py) = self.to_cells(lats, lons)
+        (poly, row, x0, x1) = polygon_spans(px, py, self.width, self.height)
+        lengths = x1 - x0
+        total = int(lengths.sum())
+        if total == 0:
+            return
+        # flat cell index of every covered cell, in footprint order
+        cells = (np.repeat(row * self.width + x0, lengths) +
+                 np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        t = np.repeat(times[poly] - self.start_time, lengths)
+
+        self.samples += np.bincount(cells, minlength=len(self.samples)).astype(np.uint32)
+
+        # group by cell keeping time order within each cell
+        order = np.argsort(cells, kind='stable')
+        cells = cells[order]
+        t = t[order]
+        first = np.ones(total, dtype=bool)
+        first[1:] = cells[1:] != cells[:-1]
+        new_visit = np.empty(total, dtype=bool)
+        new_visit[1:] = (t[1:] - t[:-1]) > self.revisit_gap
+        # the first sample of a cell in this batch follows on from earlier batches
+        prev = self.last_seen[cells[first]]
+        new_visit[first] = np.isnan(prev) | (t[first] - prev > self.revisit_gap)
+        self.visits += np.bincount(cells[new_visit], minlength=len(self.visits)).astype(np.uint32)
+        last = np.ones(total, dtype=bool)
+        last[:-1] = first[1:]
+        self.last_seen[cells[last]] = t[last]
+
+    def covered_area(self, min_visits=1):
+        '''area in square metres seen on at least min_visits visits'''
+        return int((self.visits >= min_visits).sum()) * self.resolution**2
+
+    def save(self, filename):
+        '''save as a compressed npz, counts as uint16 and last seen as float32 seconds after start_time'''
+        shape = (self.height, self.width)
+        np.savez_compressed(filename,
+                            samples=np.minimum(self.samples, 65535).astype(np.uint16).reshape(shape),
+                            visits=np.minimum(self.visits, 65535).astype(np.uint16).reshape(shape),
+                            last_seen=self.last_seen.astype(np.float32).reshape(shape),
+                            lat=self.lat, lon=self.lon, resolution=self.resolution,
+                            revisit_gap=self.revisit_gap, start_time=self.start_time)
+
+    @staticmethod
+    def load(filename):
+        d = np.load(filename)
+        (height, width) = d['visits'].shape
+        ret = CoverageGrid(float(d['lat']), float(d['lon']), float(d['resolution']), width, height,
+                           revisit_gap=float(d['revisit_gap']), start_time=float(d['start_time']))
+        ret.samples = d['samples'].ravel().astype(np.uint32)
+        ret.visits = d['visits'].ravel().astype(np.uint32)
+        ret.last_seen = d['last_seen'].ravel().astype(float)
+        return ret
+
+    def write_overlay(self, filename):
+        '''write an RGBA PNG of the visit counts, transparent where never seen'''
+        import matplotlib.pyplot as plt
+        visits = self.visits.reshape(self.height, self.width)
+        colours = plt.get_cmap('viridis')(np.linspace(0, 1, OVERLAY_MAX_VISITS))
+        rgba = np.zeros((self.height, self.width, 4))
+        seen = visits > 0
+        rgba[seen] = colours[np.minimum(visits[seen], OVERLAY_MAX_VISITS) - 1]
+        rgba[...,3] = seen * 0.6
+        plt.imsave(filename, rgba)
+
+    def write_kml(self, filename, image):
+        '''write a KML GroundOverlay of the overlay image'''
+        b = self.bounds()
+        with open(filename, 'w') as f:
+            f.write(f'''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<GroundOverlay>
+ <name>thermal coverage</name>
+ <Icon><href>{os.path.basename(image)}</href></Icon>
+ <LatLonBox>
+  <north>{b['north']}</north>
+  <south>{b['south']}</south>
+  <east>{b['east']}</east>
+  <west>{b['west']}</west>
+ </LatLonBox>
+</GroundOverlay>
+</kml>
+''')
+
+def overlay_files(output):
+    '''the PNG and KML overlay files written with a coverage npz'''
+    base = output[:-4] if output.endswith('.npz') else output
+    return (base + ".png", base + ".kml")
+
+def compute_coverage(flight_pos, resolution=DEFAULT_RESOLUTION, revisit_gap=DEFAULT_REVISIT_GAP, terrain=None):
+    '''CoverageGrid of the thermal footprints of all flight positions'''
+    with profiler.stage('coverage_footprints', count=flight_pos.count()):
+        corners = footprint_corners(flight_pos, thermal_FOV, thermal_width/float(thermal_height), terrain)
+    times = np.array([flight_pos.get(i).timestamp for i in range(flight_pos.count())], dtype=float)
+    # no footprint without a slant range or terrain intersection
+    valid = np.isfinite(corners).all(axis=(1,2))
+    corners = corners[valid]
+    times = times[valid]
+    if len(times) == 0:
+        raise ValueError("no camera footprints in the flight log")
+    (lats, lons) = (corners[...,0], corners[...,1])
+    grid = CoverageGrid.around(lats, lons, resolution, revisit_gap=revisit_gap, start_time=times[0])
+    with profiler.stage('coverage_raster', count=len(times)):
+        for i in range(0, len(times), CHUNK):
+            grid.add_footprints(times[i:i+CHUNK], lats[i:i+CHUNK], lons[i:i+CHUNK])
+    return grid
+
+def create_coverage(session, output, resolution=DEFAULT_RESOLUTION, revisit_gap=DEFAULT_REVISIT_GAP, terrain=None):
+    '''write the coverage npz with its PNG and KML overlay for a FlightSession'''
+    grid = compute_coverage(session.flight_log().flight_pos, resolution=resolution,
+                            revisit_gap=revisit_gap, terrain=terrain)
+    grid.save(output)
+    (image, kml) = overlay_files(output)
+    grid.write_overlay(image)
+    grid.write_kml(kml, image)
+    print("Coverage %ux%u cells of %.1fm: %.0f m^2 seen, %.0f m^2 seen on 2 or more visits, max %u visits" % (
+        grid.width, grid.height, resolution, grid.covered_area(), grid.covered_area(2), grid.visits.max()))
+    return grid
+
+def add_coverage_overlay(gmap, coverage, out_dir='.', opacity=0.8):
+    '''show the overlay image of a coverage npz on the map, with its url relative to out_dir'''
+    grid = CoverageGrid.load(coverage)
+    (image, kml) = overlay_files(coverage)
+    gmap.ground_overlay(os.path.relpath(image, out_dir), grid.bounds(), opacity=opacity)
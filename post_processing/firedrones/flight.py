@@ -0,0 +1,276 @@
+'''
+flight log parsing and camera projection
+
+the flight log is read in a single pass, collecting the flight
+positions, mission and flight state needed by all of the products
+
+camera pixels are projected to the ground either by scaling the view
+vector by the gimbal slant range, or when a TerrainModel is given by
+intersecting the view rays with the terrain, falling back to the slant
+range where the terrain gives no intersection
+'''
+
+import math
+import numpy as np
+
+from .archive import thermal_width, thermal_height
+
+thermal_FOV = 22.8
+
+# log records which may mark thermal frames, for aligning frame times to the log clock
+FRAME_EVENT_TYPES = ['SITR', 'CAM', 'TRIG']
+
+class FlightPos(object):
+    def __init__(self, timestamp, lat, lon, theight, yaw, SIGA, SITR, SIRF, alt=None):
+        self.timestamp = timestamp
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.theight = theight
+        self.yaw = yaw
+        self.GRoll = SIGA.R
+        self.GPitch = SIGA.P
+        self.GYaw = SIGA.Y
+        self.SR = SIRF.SR
+        self.TMin = SITR.TMin
+        self.TMax = SITR.TMax
+
+class FlightPositions(object):
+    '''object for set of flight positions with time lookup'''
+    def __init__(self):
+        self.flight_pos = []
+        self.last_timestamp = None
+        self.last_idx = None
+
+    def count(self):
+        return len(self.flight_pos)
+
+    def get(self, idx):
+        return self.flight_pos[idx]
+
+    def add(self, pos):
+        self.flight_pos.append(pos)
+
+    def find_by_timestamp(self, timestamp):
+        if self.last_timestamp is None or timestamp < self.last_timestamp:
+            idx = 0
+        else:
+            idx = self.last_idx
+        N = self.count()
+        while idx < N:
+            if timestamp <= self.flight_pos[idx].timestamp:
+                return self.flight_pos[idx]
+            idx += 1
+        return None
+
+class FlightState(object):
+    '''flight mode and height above terrain at a MODE or TERR message'''
+    def __init__(self, timestamp, mode, CHeight):
+        self.timestamp = timestamp
+        self.mode = mode
+        self.CHeight = CHeight
+
+class FlightLog(object):
+    '''data from an ArduPilot bin log, parsed in one pass'''
+    def __init__(self, binlog, time_delta=1.0):
+        from pymavlink import mavutil
+
+        self.binlog = binlog
+        self.flight_pos = FlightPositions()
+        self.states = []
+        self.cmds = []
+        self.wp = None
+        # timestamps of each of FRAME_EVENT_TYPES
+        self.frame_events = { t : [] for t in FRAME_EVENT_TYPES }
+
+        mlog = mavutil.mavlink_connection(binlog)
+        last_time = None
+        state_types = set(['MODE','TERR'])
+        have_state_types = set()
+        while True:
+            m = mlog.recv_match(type=['POS','TERR','ATT','SIGA','SIRF','SITR','MODE','CMD','CAM','TRIG'])
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype in self.frame_events:
+                self.frame_events[mtype].append(m._timestamp)
+                if mtype != 'SITR':
+                    continue
+            if mtype == 'CMD':
+                self.cmds.append(m)
+                continue
+            if mtype in state_types:
+                have_state_types.add(mtype)
+                if have_state_types == state_types:
+                    TERR = mlog.messages.get('TERR')
+                    self.states.append(FlightState(m._timestamp, mlog.flightmode, TERR.CHeight))
+                continue
+            if mtype != 'POS':
+                continue
+            TERR = mlog.messages.get('TERR',None)
+            ATT = mlog.messages.get('ATT',None)
+            if TERR is None or ATT is None:
+                continue
+            SIRF = mlog.messages.get('SIRF', None)
+            SITR = mlog.messages.get('SITR', None)
+            SIGA = mlog.messages.get('SIGA', None)
+            if SIRF is None or SITR is None or SIGA is None:
+                continue
+            timestamp = m._timestamp
+            if last_time is None or timestamp - last_time > time_delta:
+                self.flight_pos.add(FlightPos(timestamp, m.Lat, m.Lng, TERR.CHeight, ATT.Yaw, SIGA, SITR, SIRF,
+                                                 alt=m.Alt))
+                last_time = timestamp
+
+    def waypoints(self):
+        '''get the mission as a mavwp object'''
+        if self.wp is None:
+            self.wp = cmds_to_waypoints(self.cmds)
+        return self.wp
+
+def cmds_to_waypoints(cmds):
+    '''convert a list of CMD log messages to a mavwp object'''
+    from pymavlink import mavutil, mavwp
+
+    wp = mavwp.MAVWPLoader()
+    for m in cmds:
+        m = mavutil.mavlink.MAVLink_mission_item_message(0,
+                                                         0,
+                                                         m.CNum,
+                                                         m.Frame,
+                                                         m.CId,
+                                                         0, 1,
+                                                         m.Prm1, m.Prm2, m.Prm3, m.Prm4,
+                                                         m.Lat, m.Lng, m.Alt)
+        try:
+            while m.seq > wp.count():
+                print("Adding dummy WP %u" % wp.count())
+                wp.set(m, wp.count())
+            wp.set(m, m.seq)
+        except Exception:
+            pass
+    return wp
+
+def get_waypoints(binlog):
+    '''get a set of waypoints for the ArduPilot bin log, return as a mavwp object'''
+    from pymavlink import mavutil
+
+    mlog = mavutil.mavlink_connection(binlog)
+    cmds = []
+    while True:
+        m = mlog.recv_match(type=['CMD'])
+        if m is None:
+            break
+        cmds.append(m)
+    return cmds_to_waypoints(cmds)
+
+def get_flight_positions(binlog, time_delta=1.0):
+    '''extract list of flight positions'''
+    return FlightLog(binlog, time_delta=time_delta).flight_pos
+
+def get_view_vector(fpos, x, y, FOV, aspect_ratio):
+    '''
+    get ground lat/lon given vehicle orientation, camera orientation and slant range
+    x and y are from -1 to 1, relative to center of camera view
+    positive x is to the right
+    positive y is down
+    '''
+    from pymavlink.rotmat import Matrix3, Vector3
+
+    v = Vector3(1, 0, 0)
+    m = Matrix3()
+    (roll,pitch,yaw) = (math.radians(fpos.GRoll),math.radians(fpos.GPitch),math.radians(fpos.GYaw))
+    yaw += math.radians(fpos.yaw)
+    FOV_half = math.radians(0.5*FOV)
+    yaw += FOV_half*x
+    pitch -= y*FOV_half/aspect_ratio
+    m.from_euler(roll, pitch, yaw)
+    v = m * v
+    return v
+
+def get_latlon(fpos, x, y, FOV, aspect_ratio, terrain=None):
+    '''
+    get ground lat/lon given vehicle orientation, camera orientation and slant range
+    x and y are from -1 to 1, relative to center of camera view
+    with a TerrainModel the view ray is intersected with the terrain
+    '''
+    if terrain is not None:
+        (lat, lon) = project_pixels([fpos], [x], [y], FOV, aspect_ratio, terrain)
+        return (float(lat[0,0]), float(lon[0,0]))
+
+    from MAVProxy.modules.lib import mp_util
+
+    v = get_view_vector(fpos, x,y,FOV,aspect_ratio)
+    if v is None:
+        return None
+    v *= fpos.SR
+    (lat,lon) = (fpos.lat,fpos.lon)
+    (lat,lon) = mp_util.gps_offset(lat,lon,v.y,v.x)
+    return (lat, lon)
+
+def view_vectors(fposes, x, y, FOV, aspect_ratio):
+    '''
+    (F,P,3) north,east,down unit view vectors for F flight positions and
+    P pixels with x and y from -1 to 1, as get_view_vector() gives for one
+    '''
+    x = np.asarray(x, dtype=float)[None,:]
+    y = np.asarray(y, dtype=float)[None,:]
+    gpitch = np.radians([p.GPitch for p in fposes])[:,None]
+    yaw = np.radians([p.GYaw + p.yaw for p in fposes])[:,None]
+    FOV_half = math.radians(0.5*FOV)
+    yaw = yaw + FOV_half*x
+    pitch = gpitch - y*FOV_half/aspect_ratio
+    # the first column of the rotation matrix, roll doesn't change it
+    cp = np.cos(pitch)
+    return np.stack((cp*np.cos(yaw), cp*np.sin(yaw), -np.sin(pitch)), axis=-1)
+
+def project_pixels(fposes, x, y, FOV, aspect_ratio, terrain=None):
+    '''
+    ground (lat,lon) arrays of shape (F,P) for P pixels with x and y from
+    -1 to 1 seen from each of F flight positions. All rays are intersected
+    with the terrain in one batch, rays without an intersection and all
+    rays without a TerrainModel use the slant range
+    '''
+    from .terrain import offset_latlon
+
+    v = view_vectors(fposes, x, y, FOV, aspect_ratio)
+    (F, P) = v.shape[:2]
+    lat = np.repeat([p.lat for p in fposes], P).astype(float)
+    lon = np.repeat([p.lon for p in fposes], P).astype(float)
+    v = v.reshape(F*P, 3)
+    # distance along each ray, the slant range unless the ray meets the terrain
+    dist = np.repeat([p.SR for p in fposes], P).astype(float)
+    if terrain is not None:
+        alts = [p.alt for p in fposes]
+        have_alt = np.repeat([a is not None for a in alts], P)
+        alt = np.repeat([a if a is not None else np.nan for a in alts], P).astype(float)
+        d = np.full(F*P, np.nan)
+        d[have_alt] = terrain.intersect(lat[have_alt], lon[have_alt], alt[have_alt], v[have_alt])
+        hit = ~np.isnan(d)
+        dist[hit] = d[hit]
+    # offsets as in get_latlon(), the horizontal components scaled by the distance
+    (plat, plon) = offset_latlon(lat, lon, v[:,0] * dist, v[:,1] * dist)
+    return (plat.reshape(F, P), plon.reshape(F, P))
+
+def footprint_corners(flight_pos, FOV, aspect_ratio, terrain=None):
+    '''(F,4,2) lat,lon of the view corners for every flight position, in the order of get_viewport_corners()'''
+    fposes = [flight_pos.get(i) for i in range(flight_pos.count())]
+    (lat, lon) = project_pixels(fposes, [-1, 1, 1, -1], [-1, -1, 1, 1], FOV, aspect_ratio, terrain)
+    return np.stack((lat, lon), axis=-1)
+
+def xy_to_latlon(fpos, x, y, terrain=None):
+    '''convert x,y pixel coordinates to a latlon tuple'''
+    (yres, xres, depth) = (thermal_height, thermal_width, 1)
+    x = (2 * x / float(xres)) - 1.0
+    y = (2 * y / float(yres)) - 1.0
+    aspect_ratio = float(xres) / yres
+    FOV = thermal_FOV
+    return get_latlon(fpos, x, y, FOV, aspect_ratio, terrain=terrain)
+
+def find_projection_by_timestamp(flight_pos, timestamp, x, y, terrain=None):
+    '''find lat/lon of a pixel in the thermal image by timestamp'''
+    fpos = flight_pos.find_by_timestamp(timestamp)
+    if fpos is None:
+        return None
+    latlon = xy_to_latlon(fpos, x, y, terrain=terrain)
+    return latlon
@@ -0,0 +1,245 @@
+'''
+fused RGB and thermal video
+
+the thermal camera is on the same gimbal as the RGB camera, looking
+along the same axis with a narrower field of view. As in timeline.js
+the angle from the view centre is taken as linear in pixel position, so
+each RGB pixel inside the thermal footprint maps to one thermal pixel.
+That mapping is computed once per calibration as a table of flat
+thermal pixel indexes. Each frame is then a gather through the table,
+a colormap and alpha lookup on the raw counts and an integer alpha
+blend of the hot pixels onto the RGB frame
+
+RGB frames are decoded and encoded by ffmpeg through pipes, the thermal
+layer is only rebuilt when the thermal frame changes
+'''
+
+import os
+import subprocess
+import numpy as np
+
+from .archive import getmtime, thermal_width, thermal_height
+from .thermal import colormap_lut
+from .ranging import RAW_BINS, raw_to_temperature, raw_level_lut
+from .video import make_rgb_video, EncodeProfile, ThermalFrameSource
+from .profiling import profiler
+
+RGB_FOV = 88.0
+RGB_WIDTH = 2560
+RGB_HEIGHT = 1440
+THERMAL_FOV = 22.8
+
+# thermal frames older than this at an RGB frame time are not shown
+MAX_THERMAL_AGE = 2.0
+
+class CameraCalibration(object):
+    '''
+    relative geometry of the RGB and thermal cameras, FOVs are horizontal
+    in degrees, the offset is the thermal boresight relative to the RGB
+    boresight in degrees, positive right and down
+    '''
+    def __init__(self, rgb_fov=RGB_FOV, rgb_aspect=RGB_WIDTH/float(RGB_HEIGHT),
+                 thermal_fov=THERMAL_FOV, thermal_aspect=thermal_width/float(thermal_height),
+                 offset_x=0.0, offset_y=0.0):
+        self.rgb_fov = rgb_fov
+        self.rgb_aspect = rgb_aspect
+        self.thermal_fov = thermal_fov
+        self.thermal_aspect = thermal_aspect
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+
+def thermal_pixels(n_rgb, rgb_fov_half, thermal_fov_half, n_thermal, offset):
+    '''map RGB pixel centres along one axis to thermal pixel indexes, -1 outside the thermal view'''
+    angle = (2.0 * (np.arange(n_rgb) + 0.5) / n_rgb - 1.0) * rgb_fov_half - offset
+    t = (angle / thermal_fov_half + 1.0) * 0.5 * n_thermal
+    idx = np.floor(t).astype(np.int64)
+    idx[(idx < 0) | (idx >= n_thermal)] = -1
+    return idx
+
+class RemapTable(object):
+    '''thermal pixel for each pixel of the thermal footprint in an RGB frame of the given size'''
+    def __init__(self, calibration, width, height):
+        c = calibration
+        cols = thermal_pixels(width, 0.5*c.rgb_fov, 0.5*c.thermal_fov, thermal_width, c.offset_x)
+        rows = thermal_pixels(height, 0.5*c.rgb_fov/c.rgb_aspect, 0.5*c.thermal_fov/c.thermal_aspect,
+                              thermal_height, c.offset_y)
+        # the footprint is a rectangle as the mapping is separable
+        xs = np.nonzero(cols >= 0)[0]
+        ys = np.nonzero(rows >= 0)[0]
+        if len(xs) == 0 or len(ys) == 0:
+            raise ValueError("thermal view is outside the RGB frame")
+        (self.x0, self.x1) = (xs[0], xs[-1]+1)
+        (self.y0, self.y1) = (ys[0], ys[-1]+1)
+        self.index = (rows[self.y0:self.y1,None] * thermal_width + cols[None,self.x0:self.x1]).astype(np.intp)
+
+class BlendLUT(object):
+    '''colour and alpha for every raw thermal count, the range may be set later'''
+    def __init__(self, tmin, tmax, threshold, alpha=0.8, ramp=20.0):
+        temps = raw_to_temperature(np.arange(RAW_BINS))
+        a = np.clip((temps - threshold) / max(ramp, 1.0e-3), 0, 1) * alpha * 255
+        self.alpha = np.round(a).astype(np.uint16)
+        self.colours = colormap_lut()
+        self.colour = None
+        if tmin is not None:
+            self.set_range(tmin, tmax)
+
+    def set_range(self, tmin, tmax):
+        '''change the colormap range, the alpha is unchanged'''
+        self.colour = self.colours[raw_level_lut(tmin, tmax)]
+
+class FusedRenderer(object):
+    '''blend thermal frames onto RGB frames using a RemapTable and BlendLUT'''
+    def __init__(self, table, lut):
+        self.table = table
+        self.lut = lut
+        (h, w) = table.index.shape
+        self.tmp = np.empty((h, w, 3), dtype=np.uint16)
+
+    def thermal_layer(self, raw):
+        '''
+        make the layer for a flat raw thermal frame as premultiplied colour
+        and inverse alpha, or None if no pixel is hot enough to show
+        '''
+        counts = raw.take(self.table.index)
+        alpha = self.lut.alpha[counts]
+        if not alpha.any():
+            return None
+        colour = self.lut.colour[counts] * alpha[...,None]
+        inv_alpha = (255 - alpha)[...,None]
+        return (colour, inv_alpha)
+
+    def blend(self, frame, layer):
+        '''blend a layer onto a (H,W,3) uint8 RGB frame in place'''
+        if layer is None:
+            return
+        (colour, inv_alpha) = layer
+        t = self.table
+        region = frame[t.y0:t.y1, t.x0:t.x1]
+        tmp = self.tmp
+        np.multiply(region, inv_alpha, out=tmp)
+        tmp += colour
+        tmp += 127
+        tmp //= 255
+        region[...] = tmp
+
+def read_frame(pipe, buf):
+    '''read one frame into buf, returning False at end of stream'''
+    view = memoryview(buf)
+    n = 0
+    while n < len(buf):
+        r = pipe.readinto(view[n:])
+        if not r:
+            return False
+        n += r
+    return True
+
+def fuse_video(rgb_file, start_time, images, output, renderer, size, fps, codec='h264', duration=None, ranging=None,
+               profile=None, redundancy=None):
+    '''
+    decode rgb_file, blend the thermal frame current at each RGB frame and
+    encode to output with an EncodeProfile. With an agc ThermalRanging the
+    colormap range is updated as each thermal frame is loaded. With a
+    RedundancyDetector the layer of the frame before a redundant frame is kept
+    '''
+    if profile is None:
+        profile = EncodeProfile()
+    (width, height) = size
+    mtimes = np.array([getmtime(f) for f in images])
+    limit = []
+    if duration is not None:
+        limit = ['-t', "%.2f" % duration]
+    decoder = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', rgb_file] + limit +
+                               ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+                               stdout=subprocess.PIPE)
+    encoder = subprocess.Popen(['ffmpeg', '-y', '-v', 'error',
+                                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%ux%u' % (width, height),
+                                '-r', str(fps), '-i', '-',
+                                '-i', rgb_file, '-map', '0:v', '-map', '1:a?', '-shortest',
+                                '-c:v', codec, '-movflags', 'faststart', '-pix_fmt', 'yuv420p'] +
+                               profile.ffmpeg_params(start_time, fps) + [output],
+                               stdin=subprocess.PIPE)
+    buf = bytearray(width * height * 3)
+    frame = np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+    # thermal frames are read ahead while RGB frames are blended
+    source = ThermalFrameSource(images)
+    last_idx = None
+    layer = None
+    count = 0
+    with profiler.stage('fuse_frames') as st:
+        while read_frame(decoder.stdout, buf):
+            t = start_time + count / float(fps)
+            idx = np.searchsorted(mtimes, t, side='right') - 1
+            if idx < 0 or t - mtimes[idx] > MAX_THERMAL_AGE:
+                idx = None
+            if idx != last_idx:
+                raw = None
+                if idx is not None:
+                    raw = source.get(idx)
+                if raw is None:
+                    layer = None
+                    if redundancy is not None:
+                        redundancy.reset()
+                elif redundancy is None or not redundancy.check(raw) or layer is None:
+                    r = ranging.add_frame(mtimes[idx], raw) if ranging is not None else None
+                    if r is not None:
+                        renderer.lut.set_range(*r)
+                    layer = renderer.thermal_layer(raw)
+                last_idx = idx
+            renderer.blend(frame, layer)
+            encoder.stdin.write(buf)
+            count += 1
+            st.count = count
+        encoder.stdin.close()
+        decoder.wait()
+        encoder.wait()
+    source.close()
+    if encoder.returncode != 0:
+        raise RuntimeError("ffmpeg encode of %s failed" % output)
+    return count
+
+def create_fused_video(session, output, ranging, codec='h264', duration=None,
+                       threshold=80, alpha=0.8, ramp=20.0, calibration=None, profile=None, redundancy=None):
+    '''create an RGB video with hot thermal pixels blended on for a FlightSession'''
+    from moviepy.editor import VideoFileClip
+
+    if calibration is None:
+        calibration = CameraCalibration()
+    if profile is None:
+        profile = EncodeProfile()
+
+    output_base = output[:-4]
+    with profiler.stage('rgb_concat'):
+        rgb_file = make_rgb_video(session.rgb_videos(), output_base, codec=codec, duration=duration)
+
+    clip = VideoFileClip(rgb_file)
+    # on the log clock, as are the thermal frame times
+    start_time = session.log_time(os.path.getmtime(rgb_file) - clip.duration)
+    (width, height) = clip.size
+    fps = clip.fps
+    clip.close()
+    print("Opened RGB video %ux%u at %.2ffps of length %.2fs" % (width, height, fps, clip.duration))
+
+    if ranging.mode == 'agc':
+        # the range is set from each thermal frame as it is loaded
+        agc = ranging
+        (min_temp, max_temp) = (None, None)
+    else:
+        # the flight histogram is shared with the other products of the session
+        agc = None
+        (min_temp, max_temp) = ranging.global_range(session.histogram())
+
+    with profiler.stage('fuse_tables'):
+        table = RemapTable(calibration, width, height)
+        lut = BlendLUT(min_temp, max_temp, threshold, alpha=alpha, ramp=ramp)
+    print("Thermal footprint x=%u:%u y=%u:%u" % (table.x0, table.x1, table.y0, table.y1))
+
+    count = fuse_video(rgb_file, start_time, session.thermal_files(), output,
+                       FusedRenderer(table, lut), (width, height), fps, codec=codec, duration=duration,
+                       ranging=agc, profile=profile, redundancy=redundancy)
+    print("Created fused video of %u frames" % count)
+    if redundancy is not None:
+        print("Fused thermal: %s" % redundancy.summary())
+
+    mtime = start_time + count / float(fps)
+    os.utime(output, (mtime, mtime))
+    profile.finish(output)
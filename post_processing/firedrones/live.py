@@ -0,0 +1,409 @@
+'''
+live telemetry for the map viewer
+
+one decoder thread reads MAVLink from the aircraft or a SITL, or replays
+a DataFlash .bin log at a chosen speed, decoding only the position,
+attitude, gimbal, rangefinder and thermal range messages. Samples with
+the fields of flight.json records are kept in a fixed size ring buffer.
+
+a broadcaster thread pushes the samples added since each client last
+heard to all connected browsers over WebSocket at a fixed rate. Clients
+which are up to date share one JSON encode and one WebSocket frame, so
+many viewers cost little more than one. Each client sends from a thread
+of its own, so a slow viewer misses pushes and catches up rather than
+delaying the others, and one stalled for SEND_TIMEOUT is disconnected. A
+client which falls behind by more than the ring buffer gets the oldest
+samples still buffered
+
+the WebSocket support is the minimum the viewer needs, server to client
+text frames plus close and ping handling, on top of the viewer server
+'''
+
+import os
+import time
+import json
+import math
+import struct
+import base64
+import socket
+import hashlib
+import threading
+
+import numpy as np
+
+from .profiling import profiler
+
+LIVE_FIELDS = ['timestamp', 'lat', 'lon', 'theight', 'yaw', 'GRoll', 'GPitch', 'GYaw', 'SR', 'TMin', 'TMax']
+
+# DataFlash messages for replay, POS makes a sample
+DATAFLASH_TYPES = ['POS', 'ATT', 'TERR', 'SIGA', 'SIRF', 'SITR']
+
+# MAVLink messages from the aircraft, GLOBAL_POSITION_INT makes a sample
+MAVLINK_TYPES = ['GLOBAL_POSITION_INT', 'ATTITUDE', 'GIMBAL_DEVICE_ATTITUDE_STATUS', 'DISTANCE_SENSOR',
+                 'CAMERA_THERMAL_RANGE']
+
+# fields which stay NaN until a message gives them, and are left out of records until then
+OPTIONAL_FIELDS = ['TMin', 'TMax']
+
+DEFAULT_CAPACITY = 3600
+DEFAULT_SAMPLE_RATE = 5.0
+DEFAULT_PUSH_RATE = 2.0
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT = 0x1
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+
+# drop a client which can't take a frame within this time
+SEND_TIMEOUT = 2.0
+
+class TelemetryRing(object):
+    '''fixed size ring buffer of samples, each numbered by a sequence number from 1'''
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=[(f, np.float64) for f in LIVE_FIELDS])
+        # number of samples ever added, the sequence number of the newest
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        '''add a sample as a dict or tuple of LIVE_FIELDS'''
+        if isinstance(sample, dict):
+            sample = tuple(sample[f] for f in LIVE_FIELDS)
+        with self.lock:
+            self.data[self.seq % self.capacity] = sample
+            self.seq += 1
+
+    def count(self):
+        return min(self.seq, self.capacity)
+
+    def since(self, seq):
+        '''(newest seq, samples after seq) limited to the samples still in the buffer'''
+        with self.lock:
+            end = self.seq
+            start = max(seq, end - self.capacity)
+            if start >= end:
+                return (end, self.data[:0].copy())
+            idx = np.arange(start, end) % self.capacity
+            return (end, self.data[idx])
+
+    def summary(self):
+        '''summary for the viewer api, as for a flight directory with a live flag'''
+        (seq, samples) = self.since(0)
+        ret = { "live" : True, "count" : len(samples), "capacity" : self.capacity }
+        if len(samples) > 0:
+            ret["start"] = float(samples['timestamp'][0])
+            ret["end"] = float(samples['timestamp'][-1])
+        else:
+            ret["start"] = ret["end"] = time.time()
+        return ret
+
+def samples_to_records(samples):
+    '''flight.json style records for an array of samples, without the optional fields not yet known'''
+    ret = []
+    for s in samples.tolist():
+        r = dict(zip(LIVE_FIELDS, s))
+        for f in OPTIONAL_FIELDS:
+            if math.isnan(r[f]):
+                del r[f]
+        ret.append(r)
+    return ret
+
+class TelemetryDecoder(threading.Thread):
+    '''
+    decode a MAVLink connection or replay a DataFlash log into a
+    TelemetryRing, at most sample_rate samples a second of flight time.
+    Logs are replayed at speed times real time
+    '''
+    def __init__(self, source, ring, speed=1.0, sample_rate=DEFAULT_SAMPLE_RATE):
+        threading.Thread.__init__(self, name='telemetry decoder', daemon=True)
+        self.source = source
+        self.ring = ring
+        self.speed = speed
+        self.sample_interval = 1.0 / sample_rate
+        self.replay = os.path.isfile(source)
+        self.state = { f : 0.0 for f in LIVE_FIELDS }
+        for f in OPTIONAL_FIELDS:
+            self.state[f] = math.nan
+        self.running = True
+        self.messages = 0
+
+    def run(self):
+        from pymavlink import mavutil
+        mlog = mavutil.mavlink_connection(self.source)
+        types = DATAFLASH_TYPES if self.replay else MAVLINK_TYPES
+        first = None
+        last_sample = None
+        print("Live telemetry from %s" % self.source)
+        while self.running:
+            if self.replay:
+                m = mlog.recv_match(type=types)
+                if m is None:
+                    print("Replay of %s finished" % self.source)
+                    break
+            else:
+                m = mlog.recv_match(type=types, blocking=True, timeout=1.0)
+                if m is None:
+                    continue
+            self.messages += 1
+            if not self.update(m):
+                continue
+            t = m._timestamp
+            if last_sample is not None and t - last_sample < self.sample_interval:
+                continue
+            if self.replay:
+                # pace the replay against the wall clock
+                if first is None:
+                    first = (t, time.time())
+                delay = first[1] + (t - first[0]) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            last_sample = t
+            self.state['timestamp'] = t
+            self.ring.add(self.state)
+
+    def update(self, m):
+        '''update the state from a message, returning True for a position'''
+        s = self.state
+        mtype = m.get_type()
+        if mtype == 'POS':
+            (s['lat'], s['lon']) = (m.Lat, m.Lng)
+            return True
+        if mtype == 'GLOBAL_POSITION_INT':
+            (s['lat'], s['lon']) = (m.lat * 1.0e-7, m.lon * 1.0e-7)
+            # no terrain data on the link, height above home instead
+            s['theight'] = m.relative_alt * 1.0e-3
+            return True
+        if mtype == 'TERR':
+            s['theight'] = m.CHeight
+        elif mtype == 'ATT':
+            s['yaw'] = m.Yaw
+        elif mtype == 'ATTITUDE':
+            s['yaw'] = math.degrees(m.yaw)
+        elif mtype == 'SIGA':
+            (s['GRoll'], s['GPitch'], s['GYaw']) = (m.R, m.P, m.Y)
+        elif mtype == 'GIMBAL_DEVICE_ATTITUDE_STATUS':
+            from pymavlink.quaternion import QuaternionBase
+            (r, p, y) = QuaternionBase(list(m.q)).euler
+            (s['GRoll'], s['GPitch'], s['GYaw']) = (math.degrees(r), math.degrees(p), math.degrees(y))
+        elif mtype == 'SIRF':
+            s['SR'] = m.SR
+        elif mtype == 'DISTANCE_SENSOR':
+            s['SR'] = m.current_distance * 0.01
+        elif mtype == 'SITR':
+            (s['TMin'], s['TMax']) = (m.TMin, m.TMax)
+        elif mtype == 'CAMERA_THERMAL_RANGE':
+            # sent by the autopilot for a SIYI camera, already in degrees C
+            (s['TMin'], s['TMax']) = (m.min, m.max)
+        return False
+
+def ws_accept_key(key):
+    '''Sec-WebSocket-Accept for a Sec-WebSocket-Key'''
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+
+def ws_frame(payload, opcode=WS_TEXT):
+    '''an unmasked server to client frame'''
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+def ws_read_frame(rfile):
+    '''(opcode, payload) of a masked client to server frame, or None at end of stream'''
+    header = rfile.read(2)
+    if len(header) < 2:
+        return None
+    (b1, b2) = struct.unpack('!BB', header)
+    n = b2 & 0x7F
+    if n == 126:
+        n = struct.unpack('!H', rfile.read(2))[0]
+    elif n == 127:
+        n = struct.unpack('!Q', rfile.read(8))[0]
+    mask = rfile.read(4) if b2 & 0x80 else None
+    payload = rfile.read(n)
+    if len(payload) < n:
+        return None
+    if mask is not None:
+        m = np.frombuffer(mask * (n // 4 + 1), dtype=np.uint8)[:n]
+        payload = (np.frombuffer(payload, dtype=np.uint8) ^ m).tobytes()
+    return (b1 & 0x0F, payload)
+
+class LiveClient(object):
+    '''
+    a connected viewer and the sequence number of the last sample it was
+    sent. Pushed frames are sent by a thread of its own, so a stalled
+    viewer only holds up itself. A viewer still sending is skipped by a
+    push and catches up from its sequence number at the next
+    '''
+    def __init__(self, sock, seq=0, on_close=None):
+        self.sock = sock
+        self.seq = seq
+        self.on_close = on_close
+        # one writer of the socket at a time
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.pending = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='live viewer', daemon=True)
+        self.thread.start()
+
+    def send(self, frame):
+        '''send a frame from the calling thread'''
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def busy(self):
+        return self.pending is not None or self.closed
+
+    def offer(self, frame, seq):
+        '''queue a frame of the samples up to seq unless the last is still being sent, returning True if queued'''
+        with self.cond:
+            if self.busy():
+                return False
+            self.pending = (frame, seq)
+            self.cond.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                (frame, seq) = self.pending
+            try:
+                self.send(frame)
+            except OSError:
+                # a closed viewer, or one stalled past SEND_TIMEOUT
+                self.close()
+                return
+            with self.cond:
+                self.seq = seq
+                self.pending = None
+
+    def close(self):
+        '''stop sending and shut the socket down, so the handler thread reading it finishes'''
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.on_close is not None:
+            self.on_close(self)
+
+class LiveBroadcaster(threading.Thread):
+    '''
+    push new samples to all clients at push_rate, one encode per group of
+    clients at the same point, handing the frame to each client's sender
+    '''
+    def __init__(self, ring, push_rate=DEFAULT_PUSH_RATE):
+        threading.Thread.__init__(self, name='telemetry broadcaster', daemon=True)
+        self.ring = ring
+        self.period = 1.0 / push_rate
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.running = True
+        self.frames = 0
+        self.sent = 0
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+        print("Live viewer connected, %u viewers" % len(self.clients))
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def push(self):
+        '''queue the new samples for each client not still sending the last push'''
+        with self.lock:
+            clients = [c for c in self.clients if not c.busy()]
+        groups = {}
+        for c in clients:
+            groups.setdefault(c.seq, []).append(c)
+        for (seq, group) in groups.items():
+            (new_seq, samples) = self.ring.since(seq)
+            if len(samples) == 0:
+                continue
+            msg = { "seq" : new_seq, "records" : samples_to_records(samples) }
+            frame = ws_frame(json.dumps(msg).encode('utf-8'))
+            self.frames += 1
+            for c in group:
+                if c.offer(frame, new_seq):
+                    self.sent += 1
+
+    def run(self):
+        next_push = time.time()
+        while self.running:
+            next_push += self.period
+            with profiler.stage('live push') as st:
+                self.push()
+                st.count = len(self.clients)
+            time.sleep(max(next_push - time.time(), 0))
+
+class LiveTelemetry(object):
+    '''a decoder, ring buffer and broadcaster for one telemetry source'''
+    def __init__(self, source, capacity=DEFAULT_CAPACITY, sample_rate=DEFAULT_SAMPLE_RATE,
+                 push_rate=DEFAULT_PUSH_RATE, speed=1.0):
+        self.ring = TelemetryRing(capacity)
+        self.decoder = TelemetryDecoder(source, self.ring, speed=speed, sample_rate=sample_rate)
+        self.broadcaster = LiveBroadcaster(self.ring, push_rate=push_rate)
+
+    def start(self):
+        self.decoder.start()
+        self.broadcaster.start()
+
+    def summary(self):
+        return self.ring.summary()
+
+    def serve_client(self, handler):
+        '''
+        upgrade a viewer server request to a WebSocket and serve it until
+        the viewer closes, the broadcaster sends the samples
+        '''
+        key = handler.headers.get('Sec-WebSocket-Key')
+        if key is None or handler.headers.get('Upgrade', '').lower() != 'websocket':
+            handler.send_error(400, "WebSocket upgrade expected")
+            return
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', ws_accept_key(key))
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        sock = handler.connection
+        # a send timeout only, a read timeout would break the buffered rfile
+        sec = int(SEND_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                        struct.pack('ll', sec, int((SEND_TIMEOUT - sec) * 1e6)))
+        client = LiveClient(sock, on_close=self.broadcaster.remove_client)
+        self.broadcaster.add_client(client)
+        try:
+            # viewers only send pings and close
+            while True:
+                frame = ws_read_frame(handler.rfile)
+                if frame is None:
+                    break
+                (opcode, payload) = frame
+                if opcode == WS_CLOSE:
+                    client.send(ws_frame(payload[:2], WS_CLOSE))
+                    break
+                if opcode == WS_PING:
+                    client.send(ws_frame(payload, WS_PONG))
+        except OSError:
+            pass
+        finally:
+            client.close()
@@ -0,0 +1,116 @@
+'''
+merge a SIYI_log.bin into a ArduPilot onboard bin log to create a new merged log
+'''
+
+from .profiling import profiler
+
+class LogMerger(object):
+    '''merge SIYI log messages into an ArduPilot log in timestamp order'''
+    def __init__(self, alog_name, slog_name, logout):
+        from pymavlink import mavutil
+        self.alog = mavutil.mavlink_connection(alog_name)
+        self.slog = mavutil.mavlink_connection(slog_name)
+        self.output = open(logout, mode='wb')
+        self.siyi_format = {}
+        self.used_ids = set()
+
+    def allocate_id(self):
+        '''
+        allocate an unused id from the ardupilot bin log
+        '''
+        for id in range(100, 254):
+            if not id in self.alog.id_to_name and not id in self.used_ids:
+                self.used_ids.add(id)
+                return id
+        return None
+
+    def write_message(self, m):
+        from pymavlink import DFReader
+        mtype = m.get_type()
+        if mtype == "FMT":
+            if m.Name in self.siyi_format or m.Name in self.alog.name_to_id:
+                return
+            id = self.allocate_id()
+            if id is None:
+                return
+            fmt = DFReader.DFFormat(id, m.Name, m.Length, m.Format, m.Columns)
+            self.siyi_format[m.Name] = fmt
+            buf = bytearray(m.get_msgbuf())
+            buf[3] = id
+            self.output.write(buf)
+            print("Added %s with id %u" % (m.Name, id))
+            return
+        if mtype in self.alog.name_to_id:
+            return
+        if not mtype in self.siyi_format:
+            print("Unknown %s" % mtype)
+            return
+        buf = bytearray(m.get_msgbuf())
+        buf[2] = self.siyi_format[mtype].type
+        self.output.write(buf)
+
+    def merge(self):
+        '''merge the two logs, closing the output when done, returns message count'''
+        from progress.bar import Bar
+        alog = self.alog
+        slog = self.slog
+        output = self.output
+        m1 = None
+        m2 = None
+        pct = 0
+        time_offset = 0
+        count = 0
+
+        bar = Bar('Merging logs', max=100)
+
+        while True:
+            if m1 is None:
+                m1 = alog.recv_msg()
+            if m2 is None:
+                m2 = slog.recv_msg()
+
+            new_pct = (alog.offset * 100) // alog.data_len
+            if new_pct != pct:
+                bar.next()
+                pct = new_pct
+
+            if m1 is None and m2 is None:
+                # all done
+                break
+            count += 1
+
+            if m2 is None and m1 is not None:
+                # pass-thru m1
+                output.write(m1.get_msgbuf())
+                m1 = None
+                continue
+
+            if m1 is None and m2 is not None:
+                # pass-thru m1
+                self.write_message(m2)
+                m2 = None
+                continue
+
+            if m2._timestamp > m1._timestamp + 10*3600:
+                # we have the 18 hour issue
+                time_offset = 18*3600
+
+            if m1._timestamp < m2._timestamp - time_offset:
+                # m1 is older, pass-thru m1
+                output.write(m1.get_msgbuf())
+                m1 = None
+                continue
+
+            # m2 is older
+            self.write_message(m2)
+            m2 = None
+
+        output.close()
+        return count
+
+def merge_logs(alog_name, slog_name, logout):
+    '''merge a SIYI log into an ArduPilot log, writing logout'''
+    with profiler.stage('open_logs'):
+        merger = LogMerger(alog_name, slog_name, logout)
+    with profiler.stage('merge') as st:
+        st.count = merger.merge()
@@ -0,0 +1,437 @@
+'''
+map product: a Google map of the mission, flight path and thermal
+heatmap, with the flight.json, hotspots.json and thumbnail files used
+by timeline.js and the viewer server
+'''
+
+import os
+import math
+import json
+import numpy as np
+
+from .archive import load_thermal_to_temperatures, getmtime, thermal_width, thermal_height
+from .flight import find_projection_by_timestamp, project_pixels, footprint_corners, thermal_FOV
+from .thermal import colormap_lut
+from .ranging import raw_to_temperature, ThermalRanging
+from .readahead import FrameReader
+from .profiling import profiler
+
+# thumbnail pyramid, each level is a block reduction of the thermal frame
+THUMB_DIR = "thumbnails"
+THUMB_FACTORS = [4, 8, 16]
+THUMB_SHEET_SIZE = 4096
+
+DEFAULT_KML = "http://uav.tridgell.net/.Angel/FB810-Bullen.kml"
+
+# map centre when there is no flight path
+DEFAULT_CENTRE = (-35.42274099, 149.00443460)
+
+def get_API_key():
+    home = os.getenv('HOME')
+    try:
+        key = open(os.path.join(home, ".gmap_api_key.txt"),"r").read()
+    except Exception as ex:
+        print(ex)
+    return key.strip()
+
+def plot_mission(gmap, wp):
+    '''display mission on the map'''
+    from pymavlink import mavutil
+    lats = []
+    lons = []
+    wpcount = wp.count()
+    for i in range(wpcount):
+        w = wp.wp(i)
+        if w.command != mavutil.mavlink.MAV_CMD_NAV_WAYPOINT:
+            continue
+        lats.append(w.x)
+        lons.append(w.y)
+    gmap.plot(lats, lons, color="white")
+
+def plot_flightpath(gmap, flight_pos):
+    '''display mission on the map'''
+    lats = []
+    lons = []
+    for i in range(flight_pos.count()):
+        p = flight_pos.get(i)
+        lats.append(p.lat)
+        lons.append(p.lon)
+    gmap.plot(lats, lons, color="red")
+    print("Plotted %u positions" % len(lats))
+
+def heatmap_value(t, min_temp):
+    '''heatmap value of a temperature array'''
+    count = (t > min_temp).sum()
+    return math.log(count+1)
+
+def get_heatmap_value(fname, min_temp):
+    '''get a value from a thermal image for heatmap display'''
+    t = load_thermal_to_temperatures(fname)
+    if t is None:
+        return 0
+    return heatmap_value(t, min_temp)
+
+def plot_heatmap(gmap, images, flight_pos, min_temp=150.0, out_dir='.', terrain=None, redundancy=None):
+    '''
+    plot a heatmap from density of hot pixels in the thermal images, with a
+    TerrainModel the frame centres are projected onto the terrain in one batch.
+    With a RedundancyDetector redundant frames are skipped, so a loiter
+    over a hotspot doesn't outweigh a single pass. The heatmap values are
+    made as the frames are read ahead
+    '''
+    def work(raw):
+        return (heatmap_value(raw_to_temperature(raw), min_temp),
+                redundancy.signature(raw) if redundancy is not None else None)
+
+    lats = []
+    lons = []
+    heat = []
+    timestamps = []
+    fposes = []
+    for (i, raw, result) in FrameReader(images, work):
+        if raw is None:
+            continue
+        (h, signature) = result
+        if redundancy is not None and redundancy.check_signature(signature):
+            continue
+        if h <= 0:
+            continue
+        f = images[i]
+        mtime = getmtime(f)
+        if terrain is not None:
+            fpos = flight_pos.find_by_timestamp(mtime)
+            if fpos is None:
+                continue
+            fposes.append(fpos)
+        else:
+            latlon = find_projection_by_timestamp(flight_pos, mtime, thermal_width//2, thermal_height//2)
+            if latlon is None:
+                continue
+            lats.append(latlon[0])
+            lons.append(latlon[1])
+        heat.append(h)
+        timestamps.append(mtime)
+    if fposes:
+        (plat, plon) = project_pixels(fposes, [0.0], [0.0], thermal_FOV, thermal_width/float(thermal_height), terrain)
+        lats = plat[:,0].tolist()
+        lons = plon[:,0].tolist()
+    if redundancy is not None:
+        print("Heatmap: %s" % redundancy.summary())
+    gmap.heatmap(lats, lons, weights=heat)
+    create_hotspots_json(timestamps, lats, lons, heat, out_dir)
+
+def create_hotspots_json(timestamps, lats, lons, heat, out_dir='.'):
+    '''create a hotspots.json file with the hotspot events used for the heatmap'''
+    hotspots = []
+    for i in range(len(timestamps)):
+        hotspots.append({ "timestamp" : timestamps[i], "lat" : lats[i], "lon" : lons[i], "weight" : heat[i] })
+    with open(os.path.join(out_dir, 'hotspots.json'), 'w') as f:
+        json.dump(hotspots, f, indent=1)
+
+def block_reduce(a, factor):
+    '''reduce a stack of frames of shape (N,H,W) by averaging factor x factor blocks'''
+    (n, h, w) = a.shape
+    return a.reshape(n, h//factor, factor, w//factor, factor).mean(axis=(2,4), dtype=np.float32)
+
+class SpriteSheetWriter(object):
+    '''
+    pack the colormap levels of same size thumbnails into sprite sheets,
+    writing each sheet as soon as it is full
+    '''
+    def __init__(self, level, width, height, lut, out_dir='.'):
+        self.level = level
+        self.width = width
+        self.height = height
+        self.lut = lut
+        self.out_dir = out_dir
+        self.cols = THUMB_SHEET_SIZE // width
+        self.per_sheet = self.cols * (THUMB_SHEET_SIZE // height)
+        self.sheet = np.zeros((THUMB_SHEET_SIZE // height * height, self.cols * width), dtype=np.uint8)
+        self.count = 0
+        self.sheets = []
+
+    def add(self, tile):
+        '''add a (height,width) tile of colormap levels'''
+        n = self.count % self.per_sheet
+        (y, x) = ((n // self.cols) * self.height, (n % self.cols) * self.width)
+        self.sheet[y:y+self.height, x:x+self.width] = tile
+        self.count += 1
+        if self.count % self.per_sheet == 0:
+            self.write(self.per_sheet)
+
+    def write(self, n):
+        '''write the sheet holding n tiles, trimmed to whole rows'''
+        import matplotlib.pyplot as plt
+        rows = (n + self.cols - 1) // self.cols
+        fname = os.path.join(THUMB_DIR, "thermal_L%u_%u.png" % (self.level, len(self.sheets)))
+        plt.imsave(os.path.join(self.out_dir, fname), self.lut[self.sheet[:rows*self.height]])
+        self.sheet[:] = 0
+        self.sheets.append(fname)
+
+    def finish(self):
+        '''write the last partial sheet, returning the level info for thumbnails.json'''
+        if self.count % self.per_sheet != 0:
+            self.write(self.count % self.per_sheet)
+        return { "width" : self.width, "height" : self.height, "cols" : self.cols,
+                 "per_sheet" : self.per_sheet, "sheets" : self.sheets }
+
+def create_thumbnails(images, tmin, tmax, out_dir='.'):
+    '''
+    create a multi-resolution pyramid of thermal thumbnails packed into
+    sprite sheets, with an index keyed by timestamp for the viewer. The
+    thumbnails are colormapped over tmin to tmax, the range of the thermal
+    video, as each frame is read so memory doesn't grow with the flight
+    '''
+    scale = 256.0 / (tmax - tmin)
+
+    def work(raw):
+        t = raw_to_temperature(raw).reshape(1, thermal_height, thermal_width)
+        base = block_reduce(t, THUMB_FACTORS[0])
+        ret = []
+        for factor in THUMB_FACTORS:
+            thumb = base if factor == THUMB_FACTORS[0] else block_reduce(base, factor // THUMB_FACTORS[0])
+            # the same levels as raw_level_lut gives the thermal video
+            ret.append(np.clip((thumb[0] - tmin) * scale, 0, 255).astype(np.uint8))
+        return ret
+
+    lut = colormap_lut()
+    os.makedirs(os.path.join(out_dir, THUMB_DIR), exist_ok=True)
+    writers = [SpriteSheetWriter(level, thermal_width // factor, thermal_height // factor, lut, out_dir)
+               for (level, factor) in enumerate(THUMB_FACTORS)]
+    timestamps = []
+    for (i, raw, tiles) in FrameReader(images, work):
+        if raw is None:
+            continue
+        for (w, tile) in zip(writers, tiles):
+            w.add(tile)
+        timestamps.append(getmtime(images[i]))
+    if len(timestamps) == 0:
+        print("No thermal frames for thumbnails")
+        return
+    levels = [w.finish() for w in writers]
+    index = { "tmin" : float(tmin), "tmax" : float(tmax), "timestamps" : timestamps, "levels" : levels }
+    with open(os.path.join(out_dir, THUMB_DIR, "thumbnails.json"), "w") as f:
+        json.dump(index, f)
+    print("Created %u thermal thumbnails in %u levels, range %.1f to %.1f" % (len(timestamps), len(levels), tmin, tmax))
+
+def create_flight_json(flight_pos, out_dir='.', terrain=None):
+    '''
+    create a flight.json file containing meta data for the flight. With a
+    TerrainModel the camera footprints projected onto the terrain are
+    included, for timeline.js to draw instead of its slant range footprints
+    '''
+    corners = None
+    if terrain is not None and flight_pos.count() > 0:
+        from .fusion import RGB_FOV, RGB_WIDTH, RGB_HEIGHT
+        corners = { 'thermal_corners' : footprint_corners(flight_pos, thermal_FOV, thermal_width/float(thermal_height), terrain),
+                    'rgb_corners' : footprint_corners(flight_pos, RGB_FOV, RGB_WIDTH/float(RGB_HEIGHT), terrain) }
+    j = open(os.path.join(out_dir, 'flight.json'), 'w')
+    j.write('''
+[
+''')
+    count = flight_pos.count()
+    for idx in range(count):
+        p = flight_pos.get(idx)
+        footprints = ''
+        if corners is not None:
+            for (k, c) in corners.items():
+                footprints += ',\n "%s" : %s' % (k, json.dumps(c[idx].tolist()))
+        j.write(f'''{{
+ "timestamp" : {p.timestamp},
+ "lat" : {p.lat},
+ "lon" : {p.lon},
+ "theight" : {p.theight},
+ "yaw" : {p.yaw},
+ "GRoll" : {p.GRoll},
+ "GPitch" : {p.GPitch},
+ "GYaw" : {p.GYaw},
+ "SR" : {p.SR},
+ "TMin" : {p.TMin},
+ "TMax" : {p.TMax}{footprints}
+}}''')
+        if idx < count-1:
+            j.write(',\n')
+        else:
+            j.write('\n')
+    j.write('''
+]
+''')
+    j.close()
+
+def get_video_start_time(video):
+    '''get start time of a video file'''
+    from moviepy.editor import VideoFileClip
+    duration = VideoFileClip(video).duration
+    mtime = os.path.getmtime(video)
+    start_time = mtime - duration
+    return start_time
+
+
+def add_videos(gmap, videos, thumbnails=False, out_dir='.'):
+    '''add in videos to the page, video urls are relative to out_dir'''
+    from .video import keyframe_map_file
+    print('Videos: ', videos)
+    urls = videos
+    if out_dir != '.':
+        urls = [os.path.relpath(v, out_dir) for v in videos]
+
+    videos_json = '''video_list = [
+'''
+    for i in range(len(videos)):
+        video = videos[i]
+        start_time = get_video_start_time(video)
+        # keyframe map from the web encode profile, for seeking
+        keyframes = ''
+        if os.path.exists(keyframe_map_file(video)):
+            keyframes = f'''
+ "keyframes" : "{keyframe_map_file(urls[i])}",'''
+        videos_json += f'''{{
+ "video_id" : "Video_{i}",
+ "name" : "{urls[i]}",
+ "start_time" : new Date({start_time}*1000),{keyframes}
+}}'''
+        if i < len(videos)-1:
+            videos_json += ','
+        videos_json += '\n'
+    videos_json += '''
+]
+'''
+    gmap.add_custom('js', videos_json)
+
+    gmap.add_custom('html_top','''
+<div id="videoContainer">
+<table>
+<tr>
+''')
+    for i in range(len(videos)):
+        gmap.add_custom('html_top',f'''
+<td>
+    <video id="Video_{i}" width="320" height="240" controls>
+        <source src="{urls[i]}" type="video/mp4">
+    </video>
+</td>
+''')
+    if thumbnails:
+        level = THUMB_FACTORS[0]
+        gmap.add_custom('html_top',f'''
+<td>
+    <div id="thermal_thumb" style="width:min({thermal_width//level}px,12vw);aspect-ratio:{thermal_width}/{thermal_height}"></div>
+</td>
+''')
+    gmap.add_custom('html_top','''
+<td>
+<div id="status_text">Initialising</div>
+</td>
+</tr>
+</table>
+</div>
+<script>
+    function playVideo() {
+        var video = document.getElementById("RGBvideoPlayer");
+        video.play();
+    }
+
+    function seekVideo(time) {
+        var video = document.getElementById("ThermalvideoPlayer");
+        video.currentTime = time;
+    }
+</script>
+''')
+
+def map_centre(flight_pos):
+    '''centre of the flight path, or the default map centre for an empty log'''
+    if flight_pos.count() == 0:
+        return DEFAULT_CENTRE
+    lats = [flight_pos.get(i).lat for i in range(flight_pos.count())]
+    lons = [flight_pos.get(i).lon for i in range(flight_pos.count())]
+    return (0.5 * (min(lats) + max(lats)), 0.5 * (min(lons) + max(lons)))
+
+def create_map(session, output, min_temp=150.0, videos=[], kml=DEFAULT_KML, local_server=False,
+               thumbnails=False, ranging=None, out_dir='.', terrain=None, coverage=None,
+               redundancy=None):
+    '''
+    create the map html for a FlightSession, with its json files in out_dir.
+    With a TerrainModel hotspots and footprints are projected onto the terrain,
+    and the overlay of a coverage npz is shown if one is given. Thumbnails
+    use the range a ThermalRanging gives the thermal video of the session
+    '''
+    import gmplot
+
+    with profiler.stage('get_flight_log') as st:
+        flight_log = session.flight_log()
+        st.count = flight_log.flight_pos.count()
+
+    apikey = get_API_key()
+    (lat, lon) = map_centre(flight_log.flight_pos)
+    gmap = gmplot.GoogleMapPlotter(lat, lon, 12, apikey=apikey, map_type='satellite', title='FireMap')
+
+    kml_url = kml
+    if local_server:
+        # served from the KML cache of the viewer server
+        kml_url = "kml/" + os.path.basename(kml_url)
+
+    gmap.display_KML(kml_url)
+
+    with profiler.stage('get_waypoints') as st:
+        wp = flight_log.waypoints()
+        st.count = wp.count()
+    print("Loaded %u waypoints" % wp.count())
+
+    flight_pos = flight_log.flight_pos
+
+    plot_mission(gmap, wp)
+    if coverage is not None:
+        from .coverage import add_coverage_overlay
+        add_coverage_overlay(gmap, coverage, out_dir)
+    plot_flightpath(gmap, flight_pos)
+    with profiler.stage('plot_heatmap'):
+        plot_heatmap(gmap, session.thermal_files(), flight_pos, min_temp, out_dir, terrain=terrain,
+                     redundancy=redundancy)
+
+    gmap.add_custom('html_head', '''
+<script src="https://cdnjs.cloudflare.com/ajax/libs/vis/4.21.0/vis.min.js"></script>
+<link href="https://cdnjs.cloudflare.com/ajax/libs/vis/4.21.0/vis.min.css" rel="stylesheet" type="text/css" />
+<style>
+#videoContainer {
+  bottom: 1000px; /* Adjust based on your layout */
+  left: 0;
+  width: 100%;
+  background-color: #f3f3f3;
+  text-align: left;
+  vertical-align: text-top;
+  z-index: 1000; /* Ensure controls are on top of the page */
+}
+</style>
+''')
+    gmap.add_custom('html_top', '''
+  <div id="timeline"></div>
+  <script src="rotmat.js"></script>
+  <script src="projection.js"></script>
+  <script src="timeline.js"></script>
+''')
+    gmap.add_custom('js','''
+  global_map = map;
+
+  map.addListener("click", (mapsMouseEvent) => {
+    handle_map_click(mapsMouseEvent);
+  });
+''')
+
+
+    gmap.set_option('map_height', '800px')
+
+    with profiler.stage('create_flight_json', count=flight_pos.count()):
+        create_flight_json(flight_pos, out_dir, terrain=terrain)
+
+    if thumbnails:
+        with profiler.stage('create_thumbnails'):
+            if ranging is None:
+                ranging = ThermalRanging()
+            (tmin, tmax) = ranging.global_range(session.histogram())
+            create_thumbnails(session.thermal_files(), tmin, tmax, out_dir)
+
+    with profiler.stage('add_videos', count=len(videos)):
+        add_videos(gmap, videos, thumbnails, out_dir)
+
+    with profiler.stage('draw'):
+        gmap.draw(output)
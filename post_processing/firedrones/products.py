@@ -0,0 +1,140 @@
+'''
+the products made from a flight directory by the all and batch commands
+
+each product is made by make_product() from a FlightSession into an
+output directory, using option names from the command line
+'''
+
+import os
+
+from .profiling import profiler
+from .redundancy import redundancy_from_options
+
+PRODUCTS = ['merge', 'map', 'thermal-video', 'combined-video', 'fused-video', 'csv', 'coverage']
+DEFAULT_PRODUCTS = 'merge,map,thermal-video,combined-video'
+
+# the main output of each product
+PRODUCT_OUTPUTS = {
+    'merge' : 'log_merged.bin',
+    'map' : 'map.html',
+    'thermal-video' : 'thermal.mp4',
+    'combined-video' : 'combined.mp4',
+    'fused-video' : 'fused.mp4',
+    'csv' : 'summary.csv',
+    'coverage' : 'coverage.npz',
+}
+
+# videos made by these products are shown on the map
+VIDEO_PRODUCTS = ['thermal-video', 'combined-video', 'fused-video']
+
+def parse_products(products):
+    '''parse a comma separated product list, raising ValueError on an unknown product'''
+    ret = products.split(',')
+    for p in ret:
+        if not p in PRODUCTS:
+            raise ValueError("unknown product %s, choose from %s" % (p, ','.join(PRODUCTS)))
+    return ret
+
+def product_dependencies(product, products):
+    '''products in the list which must be made before product'''
+    if product == 'map':
+        # the map uses the merged log and shows the videos and coverage
+        return [p for p in products if p in ['merge', 'coverage'] or p in VIDEO_PRODUCTS]
+    if product == 'coverage':
+        return [p for p in products if p == 'merge']
+    return []
+
+def product_output(product, outdir):
+    return os.path.join(outdir, PRODUCT_OUTPUTS[product])
+
+def use_merged_log(session, outdir):
+    '''use the merged log in outdir for the session if it has been made'''
+    merged = product_output('merge', outdir)
+    if os.path.exists(merged):
+        session.set_binlog(merged)
+
+def product_ranging(opts):
+    '''ThermalRanging for a product from the --range and --temp-min/--temp-max options'''
+    from .ranging import ranging_from_options
+    return ranging_from_options(opts, temp_min=opts.temp_min, temp_max=opts.temp_max)
+
+def make_product(session, product, outdir, opts, output=None):
+    '''make one product for a FlightSession, opts holds the command line options'''
+    if output is None:
+        output = product_output(product, outdir)
+
+    if product == 'merge':
+        if not os.path.exists(session.siyi_log):
+            return
+        from .logmerge import merge_logs
+        # merged via a temporary file so an interrupted merge is never used as the log
+        tmp = output + ".tmp"
+        with profiler.stage('product merge'):
+            merge_logs(session.binlog, session.siyi_log, tmp)
+        os.replace(tmp, output)
+        session.set_binlog(output)
+
+    elif product == 'thermal-video':
+        from .video import create_thermal_video, encode_profile_from_options
+        with profiler.stage('product thermal-video'):
+            create_thermal_video(session.thermal_files(), output, product_ranging(opts), fps=opts.fps,
+                                 profile=encode_profile_from_options(opts), redundancy=redundancy_from_options(opts))
+
+    elif product == 'combined-video':
+        from .video import create_combined_video, encode_profile_from_options
+        with profiler.stage('product combined-video'):
+            create_combined_video(session, output, product_ranging(opts), codec=opts.codec, duration=opts.duration,
+                                  profile=encode_profile_from_options(opts), redundancy=redundancy_from_options(opts))
+
+    elif product == 'fused-video':
+        from .fusion import create_fused_video, CameraCalibration
+        from .video import encode_profile_from_options
+        (offset_x, offset_y) = [float(v) for v in opts.thermal_offset.split(',')]
+        with profiler.stage('product fused-video'):
+            create_fused_video(session, output, product_ranging(opts), codec=opts.codec, duration=opts.duration,
+                               threshold=opts.threshold,
+                               alpha=opts.alpha, ramp=opts.alpha_ramp,
+                               calibration=CameraCalibration(offset_x=offset_x, offset_y=offset_y),
+                               profile=encode_profile_from_options(opts),
+                               redundancy=redundancy_from_options(opts))
+
+    elif product == 'csv':
+        from .thermal_csv import thermal_to_csv, parse_basepos
+        from .stats import statistics_from_options
+        with profiler.stage('product csv'):
+            thermal_to_csv(session.thermal_files(), session.siyi_log, parse_basepos(opts.basepos),
+                           summary_file=output, stats=statistics_from_options(opts),
+                           frame_csv=not opts.no_frame_csv, out_dir=outdir)
+
+    elif product == 'coverage':
+        from .coverage import create_coverage
+        from .terrain import open_terrain
+        with profiler.stage('product coverage'):
+            create_coverage(session, output, resolution=opts.coverage_resolution, revisit_gap=opts.revisit_gap,
+                            terrain=open_terrain(opts.terrain))
+
+    elif product == 'map':
+        from .mapping import create_map
+        from .terrain import open_terrain
+        videos = [product_output(p, outdir) for p in VIDEO_PRODUCTS]
+        videos = [v for v in videos if os.path.exists(v)]
+        coverage = product_output('coverage', outdir)
+        if not os.path.exists(coverage):
+            coverage = None
+        with profiler.stage('product map'):
+            create_map(session, output, min_temp=opts.min_temp, videos=videos,
+                       kml=opts.kml, local_server=opts.local_server, thumbnails=opts.thumbnails,
+                       ranging=product_ranging(opts),
+                       out_dir=outdir, terrain=open_terrain(opts.terrain), coverage=coverage,
+                       redundancy=redundancy_from_options(opts))
+
+def make_products(session, products, outdir, opts):
+    '''make a list of products in dependency order'''
+    done = set()
+    while len(done) < len(products):
+        for p in products:
+            if p in done:
+                continue
+            if all(d in done for d in product_dependencies(p, products)):
+                make_product(session, p, outdir, opts)
+                done.add(p)
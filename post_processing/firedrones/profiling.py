@@ -0,0 +1,312 @@
+'''
+per-stage profiling shared by the post-processing tools
+
+tools wrap named stages with profiler.stage() and run child processes
+through profiler.run(). When enabled with --profile the wall time, CPU
+time, child CPU time, peak RSS and item count of every stage and child
+process is recorded, a Chrome trace-event JSON file is written (open it
+in chrome://tracing or https://ui.perfetto.dev) and a summary table is
+printed. When not enabled stage() returns a shared no-op object
+
+the peak RSS of a stage is the highest RSS of the process while it ran.
+On Linux the kernel's RSS high water mark is read and reset whenever a
+stage starts or ends, and folded into every stage open at the time, so
+nested stages and stages after a bigger one each get their own peak.
+The reset also resets ru_maxrss, so the process peak is kept from the
+same readings. Elsewhere only the peak of the whole process so far is
+known, which is recorded as the process peak with no stage peak
+
+stages run in batch worker processes are profiled in the worker, on the
+clock of the parent, and their events merged into the parent's trace
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import subprocess
+
+def maxrss_bytes(ru):
+    '''ru_maxrss is in kB on Linux and bytes on macOS'''
+    if sys.platform == 'darwin':
+        return ru.ru_maxrss
+    return ru.ru_maxrss * 1024
+
+class NullStage(object):
+    '''stage used when profiling is disabled'''
+    count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+CLEAR_REFS = '/proc/self/clear_refs'
+
+def read_rss():
+    '''(high water mark, current) RSS in bytes from /proc/self/status'''
+    (hwm, rss) = (0, 0)
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                hwm = int(line.split()[1]) * 1024
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+    return (hwm, rss)
+
+def reset_rss_peak():
+    '''reset the RSS high water mark to the current RSS'''
+    with open(CLEAR_REFS, 'w') as f:
+        f.write('5')
+
+class Stage(object):
+    '''a named stage being timed'''
+    def __init__(self, profiler, name, count):
+        self.profiler = profiler
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.peak_rss = self.profiler.open_stage(self)
+        self.ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.t0
+        cpu = time.process_time() - self.cpu0
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        child_cpu = (ru_children.ru_utime + ru_children.ru_stime) - (self.ru_children.ru_utime + self.ru_children.ru_stime)
+        self.profiler.close_stage(self)
+        self.profiler.record('stage', self.name, self.t0, wall, {
+            'cpu' : cpu,
+            'child_cpu' : child_cpu,
+            'peak_rss' : self.peak_rss,
+            'process_peak_rss' : self.profiler.process_peak_rss(),
+            'count' : self.count })
+        return False
+
+class Profiler(object):
+    '''collects stage timings and writes them as a Chrome trace'''
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.t_origin = time.perf_counter()
+        # stages open in this process, for their peak RSS
+        self.open_stages = set()
+        self.stage_peaks = False
+        self.process_peak = 0
+
+    def enable(self, trace_file):
+        '''enable profiling, writing trace_file and a summary on exit'''
+        if self.enabled:
+            return
+        self.enable_stages(time.perf_counter())
+        self.trace_file = trace_file
+        atexit.register(self.finish)
+
+    def enable_worker(self, t_origin):
+        '''
+        profile a batch worker process with the time origin of the parent,
+        perf_counter being system wide, leaving take_events() to hand the
+        events to the parent
+        '''
+        self.enable_stages(t_origin)
+
+    def enable_stages(self, t_origin):
+        self.enabled = True
+        self.t_origin = t_origin
+        try:
+            self.process_peak = max(read_rss()[0], maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF)))
+            reset_rss_peak()
+            self.stage_peaks = True
+        except (OSError, ValueError):
+            self.stage_peaks = False
+
+    def take_events(self):
+        '''remove and return the events recorded so far'''
+        with self.lock:
+            ret = self.events
+            self.events = []
+        return ret
+
+    def merge(self, events):
+        '''add the events of a worker process'''
+        with self.lock:
+            self.events.extend(events)
+
+    def rss_checkpoint(self):
+        '''fold the RSS high water mark into the open stages and reset it, returning the current RSS'''
+        (hwm, rss) = read_rss()
+        self.process_peak = max(self.process_peak, hwm)
+        for s in self.open_stages:
+            s.peak_rss = max(s.peak_rss, hwm)
+        reset_rss_peak()
+        return rss
+
+    def open_stage(self, stage):
+        '''start tracking the peak RSS of a stage, returning its starting peak or None if unknown'''
+        if not self.stage_peaks:
+            return None
+        with self.lock:
+            rss = self.rss_checkpoint()
+            self.open_stages.add(stage)
+        return rss
+
+    def process_peak_rss(self):
+        '''peak RSS in bytes of this process so far'''
+        if not self.stage_peaks:
+            return maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF))
+        with self.lock:
+            self.process_peak = max(self.process_peak, read_rss()[0])
+            return self.process_peak
+
+    def close_stage(self, stage):
+        if not self.stage_peaks:
+            return
+        with self.lock:
+            self.rss_checkpoint()
+            self.open_stages.discard(stage)
+
+    def stage(self, name, count=0):
+        '''return a context manager timing a named stage'''
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, count)
+
+    def record(self, cat, name, t0, wall, stats, pid=None):
+        with self.lock:
+            self.events.append({ 'cat' : cat,
+                                 'name' : name,
+                                 'ts' : t0 - self.t_origin,
+                                 'wall' : wall,
+                                 'pid' : pid or os.getpid(),
+                                 'tid' : threading.get_ident(),
+                                 'stats' : stats })
+
+    def run(self, args, name=None, **kwargs):
+        '''subprocess.run() equivalent recording the resources used by the child'''
+        if not self.enabled:
+            return subprocess.run(args, **kwargs)
+        if name is None:
+            name = os.path.basename(args[0])
+        input = kwargs.pop('input', None)
+        check = kwargs.pop('check', False)
+        if kwargs.pop('capture_output', False):
+            kwargs['stdout'] = subprocess.PIPE
+            kwargs['stderr'] = subprocess.PIPE
+        if input is not None:
+            kwargs['stdin'] = subprocess.PIPE
+        t0 = time.perf_counter()
+        p = subprocess.Popen(args, **kwargs)
+        (out, err) = (None, None)
+        if p.stdin or p.stdout or p.stderr:
+            # communicate() reaps the child itself, so fall back to the
+            # change in usage of all children
+            ru0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            (out, err) = p.communicate(input)
+            ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (ru.ru_utime + ru.ru_stime) - (ru0.ru_utime + ru0.ru_stime)
+            # the largest of all children so far, not this child's own
+            peak = None
+        else:
+            (pid, status, ru) = os.wait4(p.pid, 0)
+            # the child is reaped, so give Popen the exit code
+            p.returncode = os.waitstatus_to_exitcode(status)
+            cpu = ru.ru_utime + ru.ru_stime
+            peak = maxrss_bytes(ru)
+        wall = time.perf_counter() - t0
+        self.record('process', name, t0, wall, {
+            'cpu' : cpu,
+            'child_cpu' : 0.0,
+            'peak_rss' : peak,
+            'process_peak_rss' : peak,
+            'count' : 1,
+            'args' : ' '.join(args) }, pid=p.pid)
+        ret = subprocess.CompletedProcess(args, p.returncode, out, err)
+        if check:
+            ret.check_returncode()
+        return ret
+
+    def write_trace(self, filename):
+        '''write events in Chrome trace-event format'''
+        trace = []
+        for e in self.events:
+            args = dict(e['stats'])
+            trace.append({ 'name' : e['name'],
+                           'cat' : e['cat'],
+                           'ph' : 'X',
+                           'ts' : e['ts'] * 1.0e6,
+                           'dur' : e['wall'] * 1.0e6,
+                           'pid' : e['pid'],
+                           'tid' : e['tid'],
+                           'args' : args })
+            if e['cat'] == 'process':
+                trace.append({ 'name' : 'process_name', 'ph' : 'M', 'pid' : e['pid'],
+                               'args' : { 'name' : '%s %u' % (e['name'], e['pid']) } })
+        for pid in sorted(set(e['pid'] for e in self.events if e['cat'] == 'stage' and e['pid'] != os.getpid())):
+            trace.append({ 'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+                           'args' : { 'name' : 'batch worker %u' % pid } })
+        trace.append({ 'name' : 'process_name', 'ph' : 'M', 'pid' : os.getpid(),
+                       'args' : { 'name' : os.path.basename(sys.argv[0]) } })
+        with open(filename, 'w') as f:
+            json.dump({ 'traceEvents' : trace, 'displayTimeUnit' : 'ms' }, f)
+
+    def summary(self):
+        '''return summary rows aggregated by stage name, in order of first use'''
+        rows = {}
+        for e in sorted(self.events, key=lambda e: e['ts']):
+            key = (e['cat'], e['name'])
+            if not key in rows:
+                rows[key] = { 'cat' : e['cat'], 'name' : e['name'], 'calls' : 0, 'wall' : 0.0,
+                              'cpu' : 0.0, 'child_cpu' : 0.0, 'peak_rss' : None, 'process_peak_rss' : None,
+                              'count' : 0 }
+            r = rows[key]
+            s = e['stats']
+            r['calls'] += 1
+            r['wall'] += e['wall']
+            r['cpu'] += s['cpu']
+            r['child_cpu'] += s['child_cpu']
+            for k in ['peak_rss', 'process_peak_rss']:
+                if s[k] is not None:
+                    r[k] = s[k] if r[k] is None else max(r[k], s[k])
+            r['count'] += s['count']
+        return list(rows.values())
+
+    def print_summary(self):
+        print("%-28s %6s %9s %9s %9s %8s %8s %8s %9s" % ("Stage", "Calls", "Wall(s)", "CPU(s)", "Child(s)", "RSS(MB)",
+                                                       "ProcRSS", "Items", "Items/s"))
+        for r in self.summary():
+            name = r['name']
+            if r['cat'] == 'process':
+                name = "[%s]" % name
+            rate = ""
+            if r['count'] > 0 and r['wall'] > 0:
+                rate = "%.1f" % (r['count'] / r['wall'])
+            (peak, process_peak) = ["%.1f" % (r[k] / 1.0e6) if r[k] is not None else "-"
+                                    for k in ['peak_rss', 'process_peak_rss']]
+            print("%-28s %6u %9.3f %9.3f %9.3f %8s %8s %8u %9s" % (name[:28], r['calls'], r['wall'], r['cpu'],
+                                                                   r['child_cpu'], peak, process_peak, r['count'], rate))
+
+    def finish(self):
+        '''write the trace and print the summary, only once'''
+        if not self.enabled or self.trace_file is None:
+            return
+        trace_file = self.trace_file
+        self.trace_file = None
+        self.write_trace(trace_file)
+        self.print_summary()
+        print("Wrote profile trace %s" % trace_file)
+
+# profiler shared by all the tools in a process
+profiler = Profiler()
@@ -0,0 +1,172 @@
+'''
+temperature ranging for colormapping thermal frames
+
+every frame is reduced to a 65536 bin histogram of raw counts with
+bincount. Histograms add, so they can be accumulated while frames are
+being rendered and merged between worker processes, and any percentile
+of the whole flight comes from a cumulative sum over the bins, in
+constant memory however long the flight is. An agc range only depends
+on the frames before, so the videos range each frame as it is read for
+encoding. A global range is needed before the first frame is drawn, so
+it takes a pass over the frames of its own.
+
+ranging modes:
+  minmax     - min and max of all frames, as find_temp_range has always
+               done, the default so existing outputs look the same
+  percentile - low and high percentiles of all frames, so a few hot or
+               cold pixels don't set the range
+  agc        - automatic gain control, the percentile range of each frame
+               smoothed with a time constant, so the range follows the flight
+'''
+
+import math
+import numpy as np
+
+from .archive import C_TO_KELVIN
+from .readahead import FrameReader
+
+RAW_BINS = 65536
+
+RANGE_MODES = ['minmax', 'percentile', 'agc']
+
+def raw_to_temperature(raw):
+    '''convert raw counts in 1/64 K to degrees C'''
+    return raw / 64.0 - C_TO_KELVIN
+
+def frame_histogram(raw):
+    '''histogram of a flat uint16 raw frame'''
+    return np.bincount(raw, minlength=RAW_BINS)
+
+def histogram_percentile(counts, pct):
+    '''raw count at a percentile of a histogram'''
+    c = np.cumsum(counts)
+    target = pct * 0.01 * (c[-1] - 1)
+    return min(int(np.searchsorted(c, target, side='right')), RAW_BINS-1)
+
+class RawHistogram(object):
+    '''histogram of raw thermal counts over many frames'''
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = np.zeros(RAW_BINS, dtype=np.int64)
+        self.counts = counts
+        self.frames = 0
+
+    def add(self, raw, counts=None):
+        '''add a flat uint16 raw frame or its histogram, returning the histogram of the frame'''
+        h = frame_histogram(raw) if counts is None else counts
+        self.counts += h
+        self.frames += 1
+        return h
+
+    def merge(self, other):
+        '''add in the counts of another histogram'''
+        self.counts += other.counts
+        self.frames += other.frames
+        return self
+
+    def empty(self):
+        return self.frames == 0
+
+    def percentile(self, pct):
+        '''temperature in degrees C at a percentile'''
+        return raw_to_temperature(histogram_percentile(self.counts, pct))
+
+    def temp_range(self, low=0, high=100):
+        '''(tmin,tmax) in degrees C between two percentiles, 0 and 100 give the min and max'''
+        return (self.percentile(low), self.percentile(high))
+
+def histogram_of_files(images):
+    '''histogram of a list of thermal files, the frame histograms made as the frames are read ahead'''
+    h = RawHistogram()
+    for (i, raw, counts) in FrameReader(images, frame_histogram):
+        if raw is not None:
+            h.add(raw, counts)
+    return h
+
+class AutoGain(object):
+    '''
+    percentile range of each frame smoothed exponentially with a time
+    constant of window seconds
+    '''
+    def __init__(self, window=30.0, low=0.5, high=99.9):
+        self.window = window
+        self.low = low
+        self.high = high
+        self.tmin = None
+        self.tmax = None
+        self.last_timestamp = None
+
+    def update(self, timestamp, counts):
+        '''update with the histogram of a frame, returning the smoothed (tmin,tmax)'''
+        t1 = raw_to_temperature(histogram_percentile(counts, self.low))
+        t2 = raw_to_temperature(histogram_percentile(counts, self.high))
+        if self.tmin is None:
+            (self.tmin, self.tmax) = (t1, t2)
+        else:
+            dt = max(timestamp - self.last_timestamp, 0)
+            a = 1.0 - math.exp(-dt / self.window) if self.window > 0 else 1.0
+            self.tmin += a * (t1 - self.tmin)
+            self.tmax += a * (t2 - self.tmax)
+        self.last_timestamp = timestamp
+        return (self.tmin, self.tmax)
+
+class ThermalRanging(object):
+    '''
+    choose the colormap range while frames are loaded for rendering.
+    add_frame() returns the range for the frame in agc mode, otherwise
+    global_range() gives the range once all frames are added. Ranges are
+    limited to temp_min and temp_max
+    '''
+    def __init__(self, mode='minmax', low=0.5, high=99.9, window=30.0, temp_min=None, temp_max=None):
+        if not mode in RANGE_MODES:
+            raise ValueError("unknown range mode %s" % mode)
+        self.mode = mode
+        self.low = low
+        self.high = high
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.histogram = RawHistogram()
+        self.agc = None
+        if mode == 'agc':
+            self.agc = AutoGain(window, low, high)
+
+    def limit(self, r):
+        (tmin, tmax) = r
+        if self.temp_min is not None:
+            tmin = max(tmin, self.temp_min)
+        if self.temp_max is not None:
+            tmax = min(tmax, self.temp_max)
+        if tmax <= tmin:
+            tmax = tmin + 1.0
+        return (tmin, tmax)
+
+    def add_frame(self, timestamp, raw, counts=None):
+        '''
+        add a flat uint16 raw frame, with its histogram if already made,
+        returning its range in agc mode, otherwise None
+        '''
+        counts = self.histogram.add(raw, counts)
+        if self.agc is None:
+            return None
+        return self.limit(self.agc.update(timestamp, counts))
+
+    def global_range(self, histogram=None):
+        '''range of all added frames, or of the given histogram'''
+        if histogram is None:
+            histogram = self.histogram
+        if self.mode == 'minmax':
+            return self.limit(histogram.temp_range(0, 100))
+        return self.limit(histogram.temp_range(self.low, self.high))
+
+def ranging_from_options(opts, temp_min=None, temp_max=None):
+    '''ThermalRanging from the --range command line options'''
+    return ThermalRanging(opts.range, low=opts.range_low, high=opts.range_high, window=opts.agc_window,
+                          temp_min=temp_min, temp_max=temp_max)
+
+def raw_level_lut(tmin, tmax):
+    '''
+    lookup table from raw count to a 0 to 255 colormap level, giving the
+    same level as matplotlib does for the clipped and scaled temperature
+    '''
+    a = (raw_to_temperature(np.arange(RAW_BINS)) - tmin) / float(tmax - tmin)
+    return np.clip(a * 256, 0, 255).astype(np.uint8)
@@ -0,0 +1,192 @@
+'''
+readahead pipeline over a list of thermal frames
+
+a pool of I/O threads reads and byteswaps frames into a ring of depth
+preallocated frame buffers, and a pool of compute threads runs a per
+frame work function on each frame as soon as it is loaded. Frames are
+given back in order with the result of the work function, so I/O on
+slow or networked storage overlaps with rendering or reducing earlier
+frames.
+
+at most depth frames are in flight, the slot of a frame is only reused
+once the consumer has moved on to the next frame, so a slow consumer
+holds back the readers and the memory used is fixed however many frames
+there are. The frame given to the consumer is a view of its ring slot,
+so must be copied if kept. With no compute threads the work function
+runs in the I/O thread after the frame is read, and with no I/O threads
+frames are read and worked on in the calling thread.
+
+the number of I/O threads is chosen from the file system holding the
+frames unless set with --io-workers. On local disk, cached or not,
+handing each frame between threads costs more than the overlap saves,
+so frames there are read in the calling thread. On network file systems
+and any file system which can't be identified a small I/O pool hides
+the latency of each read
+
+file reads, zlib and most numpy operations on whole frames release the
+GIL, so threads give real overlap without the pickling of worker
+processes
+'''
+
+import os
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+from .archive import read_raw_into, FRAME_PIXELS
+
+DEFAULT_DEPTH = 8
+# None chooses from the file system of the frames
+DEFAULT_IO_WORKERS = None
+DEFAULT_COMPUTE_WORKERS = 1
+
+# I/O threads for frames on network or unknown file systems
+NETWORK_IO_WORKERS = 2
+
+# file system types with long latency reads, as named in /proc/mounts
+NETWORK_FILESYSTEMS = set(['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', '9p', 'afs', 'ceph', 'glusterfs',
+                           'lustre', 'gpfs', 'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs', 'fuse.gcsfuse'])
+
+# I/O threads by directory, so the mount table is read once per directory
+io_workers_cache = {}
+
+def filesystem_type(path):
+    '''the type of the file system holding path from /proc/mounts, None if unknown'''
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best = None
+    for m in mounts:
+        if len(m) < 3:
+            continue
+        # spaces in mount points are octal escaped
+        mnt = m[1].replace('\\040', ' ')
+        if path == mnt or path.startswith(mnt.rstrip('/') + '/'):
+            if best is None or len(mnt) > len(best[0]):
+                best = (mnt, m[2])
+    return best[1] if best is not None else None
+
+def default_io_workers(fname):
+    '''I/O threads for reading the frames in the directory or archive holding fname'''
+    dname = os.path.dirname(fname)
+    ret = io_workers_cache.get(dname)
+    if ret is None:
+        fstype = filesystem_type(dname or '.')
+        ret = 0 if fstype is not None and not fstype in NETWORK_FILESYSTEMS else NETWORK_IO_WORKERS
+        io_workers_cache[dname] = ret
+    return ret
+
+class ReadaheadSettings(object):
+    '''ring depth and pool sizes used by every FrameReader, set from the command line'''
+    def __init__(self, depth=DEFAULT_DEPTH, io_workers=DEFAULT_IO_WORKERS, compute_workers=DEFAULT_COMPUTE_WORKERS):
+        self.set(depth, io_workers, compute_workers)
+
+    def set(self, depth, io_workers, compute_workers):
+        if depth < 1 or (io_workers is not None and io_workers < 0) or compute_workers < 0:
+            raise ValueError("bad readahead depth %d with %s I/O and %d compute workers" % (depth, io_workers, compute_workers))
+        self.depth = depth
+        self.io_workers = io_workers
+        self.compute_workers = compute_workers
+
+settings = ReadaheadSettings()
+
+class FrameReader(object):
+    '''
+    iterate over a list of thermal frames giving (index, raw, result)
+    in order. raw is the flat native uint16 frame, valid until the next
+    frame, and result is work(raw), both are None for an invalid frame
+    '''
+    def __init__(self, images, work=None, depth=None, io_workers=None, compute_workers=None):
+        self.images = images
+        self.work = work
+        self.depth = depth if depth is not None else settings.depth
+        self.io_workers = io_workers if io_workers is not None else settings.io_workers
+        if self.io_workers is None and len(images) > 0:
+            self.io_workers = default_io_workers(images[0])
+        self.compute_workers = compute_workers if compute_workers is not None else settings.compute_workers
+
+    def __len__(self):
+        return len(self.images)
+
+    def load(self, idx, slot, work):
+        '''read a frame into its slot in an I/O thread, returning (valid, result)'''
+        if not read_raw_into(self.images[idx], slot):
+            return (False, None)
+        return (True, work(slot) if work is not None else None)
+
+    def compute(self, pool, slot, loaded, out):
+        '''run the work function on a loaded frame in the compute pool, completing out'''
+        try:
+            (valid, result) = loaded.result()
+            if not valid:
+                out.set_result((False, None))
+                return
+            done = pool.submit(self.work, slot)
+        except Exception as ex:
+            out.set_exception(ex)
+            return
+
+        def finish(f):
+            try:
+                out.set_result((True, f.result()))
+            except Exception as ex:
+                out.set_exception(ex)
+        done.add_done_callback(finish)
+
+    def submit(self, io, pool, idx, slot):
+        '''start loading a frame, returning a future of (valid, result)'''
+        if pool is None:
+            return io.submit(self.load, idx, slot, self.work)
+        out = Future()
+        loaded = io.submit(self.load, idx, slot, None)
+        loaded.add_done_callback(lambda f: self.compute(pool, slot, f, out))
+        return out
+
+    def inline(self):
+        '''read and work on each frame in the calling thread'''
+        slot = np.empty(FRAME_PIXELS, dtype=np.uint16)
+        for i in range(len(self.images)):
+            (valid, result) = self.load(i, slot, self.work)
+            if valid:
+                yield (i, slot, result)
+            else:
+                yield (i, None, None)
+
+    def __iter__(self):
+        n = len(self.images)
+        if n == 0:
+            return
+        if not self.io_workers:
+            yield from self.inline()
+            return
+        depth = min(self.depth, n)
+        ring = np.empty((depth, FRAME_PIXELS), dtype=np.uint16)
+        io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='readahead-io')
+        pool = None
+        if self.work is not None and self.compute_workers > 0:
+            pool = ThreadPoolExecutor(max_workers=self.compute_workers, thread_name_prefix='readahead-compute')
+        pending = collections.deque()
+        submitted = 0
+        try:
+            for i in range(n):
+                # the slot of the frame before i is free again
+                while submitted < n and submitted < i + depth:
+                    pending.append(self.submit(io, pool, submitted, ring[submitted % depth]))
+                    submitted += 1
+                (valid, result) = pending.popleft().result()
+                if valid:
+                    yield (i, ring[i % depth], result)
+                else:
+                    yield (i, None, None)
+        finally:
+            # an early exit waits for the frames in flight so the ring is no longer written
+            io.shutdown(wait=True, cancel_futures=True)
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+def readahead_from_options(opts):
+    '''set the readahead settings from the --readahead, --io-workers and --compute-workers options'''
+    settings.set(opts.readahead, opts.io_workers, opts.compute_workers)
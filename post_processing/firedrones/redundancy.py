@@ -0,0 +1,90 @@
+'''
+detection of runs of near identical thermal frames
+
+when the aircraft loiters or sits on the ground consecutive frames are
+nearly the same. Each frame is reduced to a signature of the mean and
+max temperature of blocks of factor x factor pixels, and a frame whose
+signature is within tolerance degrees of the first frame of the current
+run at every block is redundant. Comparing against the first frame of
+the run rather than the previous frame stops slow changes accumulating
+unnoticed. The block max keeps a small hot spot appearing from being
+averaged away.
+
+the videos show the first frame of a run for the whole run, and the
+heatmap and statistics reuse the work done for it
+'''
+
+import numpy as np
+
+from .archive import thermal_width, thermal_height
+
+DEFAULT_TOLERANCE = 0.5
+SIGNATURE_FACTOR = 16
+
+def stack_signatures(stack, factor=SIGNATURE_FACTOR):
+    '''(N,2,h,w) block mean and max signatures in degrees of a (N,pixels) stack of raw counts'''
+    n = stack.shape[0]
+    (bh, bw) = (thermal_height // factor, thermal_width // factor)
+    blocks = stack.reshape(n, bh, factor, bw, factor)
+    ret = np.empty((n, 2, bh, bw), dtype=np.float32)
+    ret[:,0] = blocks.mean(axis=(2,4), dtype=np.float32)
+    ret[:,1] = blocks.max(axis=(2,4))
+    # raw counts are 1/64 K, differences are the same in C
+    ret *= 1.0 / 64
+    return ret
+
+class RedundancyDetector(object):
+    '''tracks the current run of near identical frames over a sequence of frames'''
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, factor=SIGNATURE_FACTOR):
+        if thermal_width % factor or thermal_height % factor:
+            raise ValueError("signature factor %u does not divide the %ux%u thermal frame" % (factor, thermal_width, thermal_height))
+        self.tolerance = tolerance
+        self.factor = factor
+        self.anchor = None
+        self.frames = 0
+        self.redundant = 0
+
+    def reset(self):
+        '''start a new run at the next frame, eg. after a gap'''
+        self.anchor = None
+
+    def check_signature(self, sig):
+        '''return True if a frame signature is within tolerance of the run, otherwise start a new run'''
+        self.frames += 1
+        if self.anchor is not None and np.abs(sig - self.anchor).max() <= self.tolerance:
+            self.redundant += 1
+            return True
+        self.anchor = sig
+        return False
+
+    def signature(self, raw):
+        '''signature of a flat raw frame, it doesn't change the run so can be made in any thread'''
+        return stack_signatures(raw.reshape(1, -1), self.factor)[0]
+
+    def check(self, raw):
+        '''return True if a flat raw frame is redundant'''
+        return self.check_signature(self.signature(raw))
+
+    def check_stack(self, stack, valid=None):
+        '''
+        bool array of the redundant frames of a (N,pixels) stack, invalid
+        frames are never redundant and don't change the run
+        '''
+        n = stack.shape[0]
+        ret = np.zeros(n, dtype=bool)
+        if n == 0:
+            return ret
+        sigs = stack_signatures(stack, self.factor)
+        for i in range(n):
+            if valid is None or valid[i]:
+                ret[i] = self.check_signature(sigs[i])
+        return ret
+
+    def summary(self):
+        return "%u of %u frames redundant at %.2fC tolerance" % (self.redundant, self.frames, self.tolerance)
+
+def redundancy_from_options(opts):
+    '''a new RedundancyDetector if --skip-redundant is set, otherwise None'''
+    if not getattr(opts, 'skip_redundant', False):
+        return None
+    return RedundancyDetector(opts.redundant_tolerance)
@@ -0,0 +1,89 @@
+'''
+a flight session, the inputs for one flight shared between products
+
+the thermal file list, raw histogram and parsed flight log are
+each computed once on first use, so generating several products from
+one flight does not repeat the work. The thermal file list comes from
+the frame catalogue, which aligns the frame times to the flight log
+'''
+
+import os
+
+from .archive import sorted_files
+from .catalogue import open_catalogue
+from .flight import FlightLog
+from .ranging import histogram_of_files
+from .profiling import profiler
+from .video import RGB_DIR, THERMAL_DIR, LOG_NAME, SIYI_LOG_NAME
+
+class FlightSession(object):
+    '''inputs for one flight, either from a flight directory or given explicitly'''
+    def __init__(self, flight_dir=None, binlog=None, thermal_dir=None, rgb_dir=None, siyi_log=None, time_delta=1.0):
+        self.flight_dir = flight_dir
+        if flight_dir is not None:
+            if binlog is None:
+                binlog = os.path.join(flight_dir, LOG_NAME)
+            if thermal_dir is None:
+                thermal_dir = os.path.join(flight_dir, THERMAL_DIR)
+            if rgb_dir is None:
+                rgb_dir = os.path.join(flight_dir, RGB_DIR)
+            if siyi_log is None:
+                siyi_log = os.path.join(flight_dir, SIYI_LOG_NAME)
+        self.binlog = binlog
+        self.thermal_dir = thermal_dir
+        self.rgb_dir = rgb_dir
+        self.siyi_log = siyi_log
+        self.time_delta = time_delta
+        self._thermal_files = None
+        self._catalogue = None
+        self._histogram = None
+        self._flight_log = None
+
+    def catalogue(self):
+        '''FrameCatalogue of the thermal frames, aligned to the flight log if there is one'''
+        if self._catalogue is None:
+            self._catalogue = open_catalogue(self.thermal_dir, self)
+        return self._catalogue
+
+    def log_time(self, mtime):
+        '''
+        a time on the camera clock, such as an RGB video mtime, on the log
+        clock of the thermal frames, unchanged if there are no frames
+        '''
+        if self.thermal_dir is None or not os.path.exists(self.thermal_dir):
+            return mtime
+        return self.catalogue().log_time(mtime)
+
+    def thermal_files(self):
+        '''thermal frames sorted by time'''
+        if self._thermal_files is None:
+            self._thermal_files = self.catalogue().paths()
+        return self._thermal_files
+
+    def histogram(self):
+        '''RawHistogram over all thermal frames'''
+        if self._histogram is None:
+            with profiler.stage('histogram') as st:
+                self._histogram = histogram_of_files(self.thermal_files())
+                st.count = self._histogram.frames
+        return self._histogram
+
+    def temp_range(self):
+        '''(tmin,tmax) over all thermal frames'''
+        return self.histogram().temp_range()
+
+    def flight_log(self):
+        '''parsed FlightLog for the bin log'''
+        if self._flight_log is None:
+            self._flight_log = FlightLog(self.binlog, time_delta=self.time_delta)
+        return self._flight_log
+
+    def set_binlog(self, binlog):
+        '''use a different bin log, eg. after merging in the SIYI log'''
+        if binlog != self.binlog:
+            self.binlog = binlog
+            self._flight_log = None
+
+    def rgb_videos(self):
+        '''RGB video files sorted by mtime'''
+        return sorted_files(self.rgb_dir)
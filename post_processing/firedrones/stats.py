@@ -0,0 +1,255 @@
+'''
+per frame temperature statistics over stacks of thermal frames
+
+frames are loaded in chunks into a preallocated (N,pixels) stack of raw
+counts. Each region of a chunk is reduced to one 65536 bin histogram per
+frame with a single bincount over the stack, offsetting the counts of
+each frame into its own row of bins. The mean, min, max, percentiles and
+pixel counts above thresholds of every frame then come from vectorised
+sums over the rows, with percentiles at the 1/64 K resolution of the raw
+counts as for colormap ranging
+
+regions are a boolean mask of the thermal frame, either a polygon in
+pixel coordinates, filled by the even-odd rule on pixel centres, or a
+mask image where non-zero pixels are in the region
+'''
+
+import os
+import numpy as np
+
+from .archive import getmtime, thermal_width, thermal_height, FRAME_PIXELS
+from .ranging import RAW_BINS, raw_to_temperature
+from .redundancy import redundancy_from_options
+from .readahead import FrameReader
+
+DEFAULT_PERCENTILES = '5,50,95'
+DEFAULT_THRESHOLDS = '50,100,150'
+
+# frames per stack, the bincount index for a chunk is 8 bytes per pixel
+DEFAULT_CHUNK = 16
+
+def polygon_mask(points, width=thermal_width, height=thermal_height):
+    '''boolean (height,width) mask of the pixels with centres inside a polygon of (x,y) pixel coordinates'''
+    if len(points) < 3:
+        raise ValueError("a polygon needs at least 3 points")
+    px = np.arange(width) + 0.5
+    py = np.arange(height) + 0.5
+    mask = np.zeros((height, width), dtype=bool)
+    for i in range(len(points)):
+        (x1, y1) = points[i]
+        (x2, y2) = points[(i+1) % len(points)]
+        if y1 == y2:
+            continue
+        # rows crossed by this edge and where the edge crosses them
+        crosses = (y1 > py) != (y2 > py)
+        xcross = x1 + (py - y1) * (x2 - x1) / float(y2 - y1)
+        mask ^= crosses[:,None] & (px[None,:] < xcross[:,None])
+    return mask
+
+def load_mask(fname):
+    '''load a region mask from a .npy array or an image, non-zero pixels are in the region'''
+    if fname.endswith('.npy'):
+        mask = np.load(fname)
+    else:
+        import matplotlib.pyplot as plt
+        mask = plt.imread(fname)
+    if mask.ndim == 3:
+        # ignore an alpha channel
+        mask = mask[...,:3].any(axis=2)
+    if mask.shape != (thermal_height, thermal_width):
+        raise ValueError("mask %s is %s, expected %ux%u" % (fname, 'x'.join(str(s) for s in mask.shape[::-1]),
+                                                            thermal_width, thermal_height))
+    return mask != 0
+
+class Region(object):
+    '''a named region of the thermal frame, None for the whole frame'''
+    def __init__(self, name, mask=None):
+        self.name = name
+        self.index = None
+        if mask is not None:
+            self.index = np.flatnonzero(mask).astype(np.intp)
+            if len(self.index) == 0:
+                raise ValueError("region %s has no pixels" % name)
+
+    def prefix(self):
+        if self.name is None:
+            return ''
+        return self.name + '_'
+
+def parse_region(spec):
+    '''
+    parse a NAME=x,y;x,y;x,y polygon in pixel coordinates or a
+    NAME=MASKFILE region, raising ValueError on a bad region
+    '''
+    if not '=' in spec:
+        raise ValueError("bad region %s, expected NAME=x,y;x,y;... or NAME=MASKFILE" % spec)
+    (name, value) = spec.split('=', 1)
+    if not name or ',' in name:
+        raise ValueError("bad region name %s" % name)
+    if os.path.exists(value):
+        return Region(name, load_mask(value))
+    try:
+        points = [tuple(float(v) for v in p.split(',')) for p in value.split(';')]
+    except ValueError:
+        raise ValueError("bad region %s, expected NAME=x,y;x,y;... or NAME=MASKFILE" % spec)
+    if any(len(p) != 2 for p in points):
+        raise ValueError("bad region %s, polygon points are x,y" % spec)
+    return Region(name, polygon_mask(points))
+
+def parse_list(values):
+    '''parse a comma separated list of numbers'''
+    if not values:
+        return []
+    return [float(v) for v in values.split(',')]
+
+def stack_histograms(stack, index=None):
+    '''(N,RAW_BINS) histograms of each frame of a (N,pixels) stack over the pixels in index'''
+    sel = stack if index is None else stack.take(index, axis=1)
+    n = sel.shape[0]
+    offsets = (np.arange(n, dtype=np.intp) * RAW_BINS)[:,None]
+    counts = np.bincount((sel + offsets).ravel(), minlength=n*RAW_BINS)
+    return counts.reshape(n, RAW_BINS)
+
+def histogram_stats(counts, percentiles, thresholds, prefix=''):
+    '''per frame statistics columns from (N,RAW_BINS) histograms'''
+    c = np.cumsum(counts, axis=1)
+    total = c[:,-1]
+    nonzero = counts > 0
+    ret = {}
+    ret[prefix+'TMin'] = raw_to_temperature(np.argmax(nonzero, axis=1))
+    ret[prefix+'TMax'] = raw_to_temperature(RAW_BINS - 1 - np.argmax(nonzero[:,::-1], axis=1))
+    ret[prefix+'Mean'] = raw_to_temperature(counts.dot(np.arange(RAW_BINS)) / np.maximum(total, 1).astype(float))
+    for p in percentiles:
+        # the same percentile as histogram_percentile() for each row
+        target = p * 0.01 * (total - 1)
+        idx = (c <= target[:,None]).sum(axis=1)
+        ret[prefix+percentile_name(p)] = raw_to_temperature(np.minimum(idx, RAW_BINS-1))
+    temps = raw_to_temperature(np.arange(RAW_BINS))
+    for t in thresholds:
+        k = np.searchsorted(temps, t, side='right')
+        below = c[:,k-1] if k > 0 else 0
+        ret[prefix+threshold_name(t)] = total - below
+    return ret
+
+def percentile_name(p):
+    return 'P%g' % p
+
+def threshold_name(t):
+    return 'Above%g' % t
+
+class StatsChunk(object):
+    '''statistics of a chunk of frames starting at index start'''
+    def __init__(self, start, stack, valid, columns, redundant=None):
+        self.start = start
+        self.stack = stack
+        self.valid = valid
+        self.columns = columns
+        self.redundant = redundant if redundant is not None else np.zeros(len(valid), dtype=bool)
+
+class FrameStatistics(object):
+    '''
+    per frame statistics of the whole frame and of each region. The whole
+    frame always gets TMin and TMax, the other columns are only computed
+    when stats is set or there are regions. With a RedundancyDetector the
+    statistics are only computed for the first frame of each run of near
+    identical frames and copied to the rest of the run
+    '''
+    def __init__(self, percentiles=None, thresholds=None, regions=None, stats=True, chunk=DEFAULT_CHUNK,
+                 redundancy=None):
+        self.percentiles = percentiles or []
+        self.thresholds = thresholds or []
+        self.regions = regions or []
+        self.stats = stats or len(self.regions) > 0
+        self.chunk = chunk
+        self.redundancy = redundancy
+
+    def region_columns(self, prefix):
+        return ([prefix+'TMin', prefix+'TMax', prefix+'Mean'] +
+                [prefix+percentile_name(p) for p in self.percentiles] +
+                [prefix+threshold_name(t) for t in self.thresholds])
+
+    def extra_columns(self):
+        '''names of the columns after TMin and TMax'''
+        if not self.stats:
+            return []
+        ret = self.region_columns('')[2:]
+        for r in self.regions:
+            ret += self.region_columns(r.prefix())
+        return ret
+
+    def stack_columns(self, stack):
+        '''statistics columns of a (N,pixels) stack'''
+        columns = {}
+        if self.stats:
+            columns.update(histogram_stats(stack_histograms(stack), self.percentiles, self.thresholds))
+        else:
+            columns['TMin'] = raw_to_temperature(stack.min(axis=1))
+            columns['TMax'] = raw_to_temperature(stack.max(axis=1))
+        for r in self.regions:
+            columns.update(histogram_stats(stack_histograms(stack, r.index), self.percentiles,
+                                           self.thresholds, prefix=r.prefix()))
+        return columns
+
+    def chunks(self, images):
+        '''
+        generate a StatsChunk for each chunk of images, the stack is
+        reused so is only valid until the next chunk. Frames are read ahead
+        while the previous chunk is reduced
+        '''
+        buf = np.empty((self.chunk, FRAME_PIXELS), dtype=np.uint16)
+        frames = iter(FrameReader(images))
+        # statistics of the first frame of the current run, a run can span chunks
+        last = None
+        for start in range(0, len(images), self.chunk):
+            n = min(self.chunk, len(images) - start)
+            valid = np.zeros(n, dtype=bool)
+            for i in range(n):
+                (idx, raw, result) = next(frames)
+                if raw is not None:
+                    buf[i] = raw
+                    valid[i] = True
+            stack = buf[:n]
+            # invalid frames give a row of zero counts which is dropped by the caller
+            stack[~valid] = 0
+            if self.redundancy is None:
+                yield StatsChunk(start, stack, valid, self.stack_columns(stack))
+                continue
+            redundant = self.redundancy.check_stack(stack, valid)
+            computed = valid & ~redundant
+            sub = self.stack_columns(stack[computed])
+            # each row takes the statistics of the latest computed row, or of
+            # the run carried over from the previous chunk
+            pos = np.cumsum(computed) - 1
+            carried = pos < 0
+            columns = {}
+            for (k, v) in sub.items():
+                col = np.zeros(n, dtype=v.dtype)
+                col[~carried] = v[pos[~carried]]
+                if last is not None:
+                    col[carried] = last[k]
+                columns[k] = col
+            if computed.any():
+                last = { k : v[-1] for (k, v) in sub.items() }
+            yield StatsChunk(start, stack, valid, columns, redundant)
+
+    def compute(self, images):
+        '''(valid, columns) for all images, columns is a dict of per frame arrays'''
+        valid = []
+        columns = {}
+        for chunk in self.chunks(images):
+            valid.append(chunk.valid)
+            for (k, v) in chunk.columns.items():
+                columns.setdefault(k, []).append(v)
+        if not valid:
+            return (np.zeros(0, dtype=bool), {})
+        return (np.concatenate(valid), { k : np.concatenate(v) for (k, v) in columns.items() })
+
+def frame_times(images):
+    '''mtime of each image as an array'''
+    return np.array([getmtime(f) for f in images], dtype=float)
+
+def statistics_from_options(opts):
+    '''FrameStatistics from the --stats, --percentiles, --thresholds and --roi options'''
+    regions = [parse_region(r) for r in opts.roi]
+    return FrameStatistics(percentiles=parse_list(opts.percentiles), thresholds=parse_list(opts.thresholds),
+                           regions=regions, stats=opts.stats, redundancy=redundancy_from_options(opts))
@@ -0,0 +1,360 @@
+'''
+persistent multi-flight survey grid for repeat flights over the same area
+
+a survey store is a directory holding a survey.json index and tiles of
+TILE_SIZE x TILE_SIZE cells, each a memory-mapped .npy of a structured
+array with the max temperature, the temperature and time of the latest
+observation and the number of observations of each cell. Cells are on a
+fixed north-up grid from the origin chosen when the store is created, so
+every flight lands on the same cells. Tiles are only created where there
+are observations.
+
+each flight adds observations from its thermal frames, one per block of
+block x block pixels with the maximum temperature of the block, so cells
+seen cold are recorded as well as hot ones. The block centres of a batch
+of frames are projected to the ground together, onto the terrain if a
+TerrainModel is given. The observations are grouped by tile and cell
+with one sort, then merged into the tile with vectorised updates.
+
+the index keeps the flights added and the hottest and latest
+observation of each tile, so the hot and cooled queries only open the
+tiles which can hold matching cells and never read any flight data
+
+tiles are mapped copy on write, so adding a flight changes nothing on
+disk until it is saved. The changed tiles are written beside the old
+ones, then the index with the flight and the list of pending tiles, which
+commits the flight, then the tiles are moved into place. A store opened
+with pending tiles finishes the move, so a flight is either in the index
+with all its observations or not in the store at all, and adding it again
+after a crash never counts it twice
+'''
+
+import os
+import json
+import math
+import numpy as np
+
+from .archive import thermal_width, thermal_height
+from .flight import project_pixels, thermal_FOV
+from .ranging import raw_to_temperature
+from .stats import frame_times
+from .readahead import FrameReader
+from .terrain import RADIUS_OF_EARTH
+from .profiling import profiler
+
+SURVEY_INDEX = "survey.json"
+TILE_SIZE = 256
+DEFAULT_RESOLUTION = 5.0
+DEFAULT_BLOCK = 16
+DEFAULT_FRAME_INTERVAL = 1.0
+DEFAULT_HOT_TEMP = 150.0
+
+CELL_DTYPE = np.dtype([('max_temp', np.float32), ('last_temp', np.float32),
+                       ('count', np.uint32), ('last_seen', np.float64)])
+
+# frames projected at a time
+BATCH = 64
+
+def tile_file(tx, ty):
+    return "tile_%d_%d.npy" % (tx, ty)
+
+class SurveyCells(object):
+    '''arrays describing a set of cells returned by a query'''
+    def __init__(self, lat, lon, cells):
+        self.lat = lat
+        self.lon = lon
+        self.max_temp = cells['max_temp']
+        self.last_temp = cells['last_temp']
+        self.count = cells['count']
+        self.last_seen = cells['last_seen']
+
+    def __len__(self):
+        return len(self.lat)
+
+    def write_csv(self, f):
+        f.write("Lat,Lon,MaxTemp,LastTemp,Count,LastSeen\n")
+        for i in range(len(self.lat)):
+            f.write("%.8f,%.8f,%.2f,%.2f,%u,%.3f\n" % (self.lat[i], self.lon[i], self.max_temp[i],
+                                                       self.last_temp[i], self.count[i], self.last_seen[i]))
+
+class SurveyGrid(object):
+    '''
+    a survey store directory. Cell x runs east and y south from the origin
+    at lat,lon, with cells resolution metres on a side
+    '''
+    def __init__(self, path):
+        self.path = path
+        fname = os.path.join(path, SURVEY_INDEX)
+        if not os.path.exists(fname):
+            raise ValueError("%s is not a survey store" % path)
+        with open(fname) as f:
+            index = json.load(f)
+        self.lat = index['lat']
+        self.lon = index['lon']
+        self.resolution = index['resolution']
+        self.tile_size = index['tile_size']
+        self.flights = index['flights']
+        # 'tx,ty' : [max temp, latest observation time]
+        self.tile_info = index['tiles']
+        self.dlat = math.degrees(self.resolution / RADIUS_OF_EARTH)
+        self.dlon = self.dlat / math.cos(math.radians(self.lat))
+        self.tiles = {}
+        # tiles changed since the last save
+        self.dirty = set()
+        if index.get('pending'):
+            self.finish_save(index['pending'])
+
+    @staticmethod
+    def create(path, lat, lon, resolution=DEFAULT_RESOLUTION):
+        '''create an empty store with its origin at lat,lon'''
+        os.makedirs(path, exist_ok=True)
+        fname = os.path.join(path, SURVEY_INDEX)
+        if os.path.exists(fname):
+            raise ValueError("survey store %s already exists" % path)
+        index = { 'lat' : lat, 'lon' : lon, 'resolution' : resolution, 'tile_size' : TILE_SIZE,
+                  'flights' : [], 'tiles' : {} }
+        with open(fname, 'w') as f:
+            json.dump(index, f, indent=1)
+        return SurveyGrid(path)
+
+    def write_index(self, pending=None):
+        '''replace the index, listing the tile files still to be moved into place'''
+        index = { 'lat' : self.lat, 'lon' : self.lon, 'resolution' : self.resolution,
+                  'tile_size' : self.tile_size, 'flights' : self.flights, 'tiles' : self.tile_info }
+        if pending:
+            index['pending'] = pending
+        fname = os.path.join(self.path, SURVEY_INDEX)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(fname + '.tmp', fname)
+
+    def finish_save(self, pending):
+        '''move the new tile files of a committed save into place and clear them from the index'''
+        for name in pending:
+            fname = os.path.join(self.path, name)
+            if os.path.exists(fname + '.new'):
+                os.replace(fname + '.new', fname)
+        self.write_index()
+
+    def save(self):
+        '''write the changed tiles and the index'''
+        pending = []
+        for key in sorted(self.dirty):
+            name = tile_file(key[0], key[1])
+            with open(os.path.join(self.path, name + '.new'), 'wb') as f:
+                np.save(f, self.tiles[key])
+            pending.append(name)
+        # the flight is committed once the index lists its tiles
+        self.write_index(pending)
+        self.finish_save(pending)
+        self.dirty.clear()
+
+    def tile(self, tx, ty, create=False):
+        '''memory-mapped (tile_size*tile_size) cells of a tile, or None if it doesn't exist'''
+        key = (tx, ty)
+        if key in self.tiles:
+            return self.tiles[key]
+        fname = os.path.join(self.path, tile_file(tx, ty))
+        if os.path.exists(fname):
+            tile = np.load(fname, mmap_mode='c')
+        elif create:
+            tile = np.zeros(self.tile_size * self.tile_size, dtype=CELL_DTYPE)
+            tile['max_temp'] = np.nan
+            tile['last_temp'] = np.nan
+            tile['last_seen'] = np.nan
+        else:
+            return None
+        self.tiles[key] = tile
+        return tile
+
+    def to_cells(self, lat, lon):
+        '''integer cell x,y of arrays of lat,lon'''
+        return (np.floor((lon - self.lon) / self.dlon).astype(np.int64),
+                np.floor((self.lat - lat) / self.dlat).astype(np.int64))
+
+    def cell_centres(self, tx, ty, idx):
+        '''lat,lon of the centres of cells idx within tile tx,ty'''
+        x = tx * self.tile_size + idx % self.tile_size + 0.5
+        y = ty * self.tile_size + idx // self.tile_size + 0.5
+        return (self.lat - y * self.dlat, self.lon + x * self.dlon)
+
+    def add_observations(self, times, lats, lons, temps):
+        '''merge arrays of observations of temperature at lat,lon and time into the tiles'''
+        (x, y) = self.to_cells(lats, lons)
+        ts = self.tile_size
+        (tx, ty) = (x // ts, y // ts)
+        local = (y - ty * ts) * ts + (x - tx * ts)
+        # one sort groups the observations by tile, then cell, then time
+        order = np.lexsort((times, local, ty, tx))
+        (tx, ty, local, times, temps) = (tx[order], ty[order], local[order], times[order], temps[order])
+        n = len(order)
+        if n == 0:
+            return
+        new_cell = np.ones(n, dtype=bool)
+        new_cell[1:] = (local[1:] != local[:-1]) | (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1])
+        starts = np.flatnonzero(new_cell)
+        ends = np.append(starts[1:], n)
+        cell_max = np.maximum.reduceat(temps, starts)
+        cell_count = (ends - starts).astype(np.uint32)
+        # the latest observation of each cell is the last of its group
+        (cell_tx, cell_ty, cell_local) = (tx[starts], ty[starts], local[starts])
+        (cell_time, cell_temp) = (times[ends-1], temps[ends-1])
+
+        new_tile = np.ones(len(starts), dtype=bool)
+        new_tile[1:] = (cell_tx[1:] != cell_tx[:-1]) | (cell_ty[1:] != cell_ty[:-1])
+        tstarts = np.flatnonzero(new_tile)
+        tends = np.append(tstarts[1:], len(starts))
+        for (s, e) in zip(tstarts, tends):
+            key = (int(cell_tx[s]), int(cell_ty[s]))
+            tile = self.tile(key[0], key[1], create=True)
+            idx = cell_local[s:e]
+            cells = tile[idx]
+            cells['max_temp'] = np.fmax(cells['max_temp'], cell_max[s:e])
+            cells['count'] += cell_count[s:e]
+            newer = ~(cell_time[s:e] < cells['last_seen'])
+            cells['last_seen'][newer] = cell_time[s:e][newer]
+            cells['last_temp'][newer] = cell_temp[s:e][newer]
+            tile[idx] = cells
+            self.dirty.add(key)
+            info_key = "%d,%d" % key
+            (tmax, tlast) = self.tile_info.get(info_key, (-math.inf, -math.inf))
+            self.tile_info[info_key] = [max(tmax, float(cell_max[s:e].max())),
+                                        max(tlast, float(cell_time[s:e].max()))]
+
+    def query(self, select, min_tile_temp=None):
+        '''
+        SurveyCells of the cells for which select(cells) is True, only
+        opening tiles with a max temperature of at least min_tile_temp
+        '''
+        lats = []
+        lons = []
+        found = []
+        for (key, (tmax, tlast)) in sorted(self.tile_info.items()):
+            if min_tile_temp is not None and tmax < min_tile_temp:
+                continue
+            (tx, ty) = [int(v) for v in key.split(',')]
+            tile = self.tile(tx, ty)
+            if tile is None:
+                continue
+            idx = np.flatnonzero((tile['count'] > 0) & select(tile))
+            (lat, lon) = self.cell_centres(tx, ty, idx)
+            lats.append(lat)
+            lons.append(lon)
+            found.append(tile[idx])
+        if not found:
+            return SurveyCells(np.zeros(0), np.zeros(0), np.zeros(0, dtype=CELL_DTYPE))
+        return SurveyCells(np.concatenate(lats), np.concatenate(lons), np.concatenate(found))
+
+    def hot_cells(self, min_temp=DEFAULT_HOT_TEMP, since=None):
+        '''cells which were at least min_temp when last observed, optionally last observed after since'''
+        def select(tile):
+            ret = tile['last_temp'] >= min_temp
+            if since is not None:
+                ret &= tile['last_seen'] >= since
+            return ret
+        return self.query(select, min_tile_temp=min_temp)
+
+    def cooled_cells(self, min_temp=DEFAULT_HOT_TEMP, cool_temp=None):
+        '''cells which have been at least min_temp but were below cool_temp when last observed'''
+        if cool_temp is None:
+            cool_temp = min_temp
+        return self.query(lambda tile: (tile['max_temp'] >= min_temp) & (tile['last_temp'] < cool_temp),
+                          min_tile_temp=min_temp)
+
+    def cell_count(self):
+        '''number of cells observed'''
+        total = 0
+        for key in self.tile_info.keys():
+            (tx, ty) = [int(v) for v in key.split(',')]
+            total += int((self.tile(tx, ty)['count'] > 0).sum())
+        return total
+
+def block_centres(block):
+    '''x,y from -1 to 1 of the centres of the blocks of a thermal frame, in row major order'''
+    (bw, bh) = (thermal_width // block, thermal_height // block)
+    x = (2 * (np.arange(bw) + 0.5) * block / float(thermal_width)) - 1.0
+    y = (2 * (np.arange(bh) + 0.5) * block / float(thermal_height)) - 1.0
+    (xx, yy) = np.meshgrid(x, y)
+    return (xx.ravel(), yy.ravel())
+
+def frame_observations(images, flight_pos, block=DEFAULT_BLOCK, frame_interval=DEFAULT_FRAME_INTERVAL, terrain=None):
+    '''
+    generate (times, lats, lons, temps) arrays of block max temperature
+    observations for batches of frames, using at most one frame every
+    frame_interval seconds
+    '''
+    if thermal_width % block or thermal_height % block:
+        raise ValueError("block size %u does not divide the %ux%u thermal frame" % (block, thermal_width, thermal_height))
+    times = frame_times(images)
+    (x, y) = block_centres(block)
+    (bw, bh) = (thermal_width // block, thermal_height // block)
+    last = None
+    selected = []
+    for i in range(len(images)):
+        if last is not None and times[i] - last < frame_interval:
+            continue
+        fpos = flight_pos.find_by_timestamp(times[i])
+        if fpos is None:
+            continue
+        last = times[i]
+        selected.append((i, fpos))
+
+    def observations(batch, blocks, valid):
+        n = len(batch)
+        (lat, lon) = project_pixels([fpos for (i, fpos) in batch], x, y, thermal_FOV,
+                                    thermal_width/float(thermal_height), terrain)
+        t = np.repeat(times[[i for (i, fpos) in batch]], bh*bw).reshape(n, bh*bw)
+        ok = valid[:n,None] & np.isfinite(lat) & np.isfinite(lon)
+        return (t[ok], lat[ok], lon[ok], raw_to_temperature(blocks[:n][ok]).astype(np.float32))
+
+    def work(raw):
+        # max of each block in raw counts
+        return raw.reshape(bh, block, bw, block).max(axis=(1,3)).reshape(-1)
+
+    blocks = np.zeros((BATCH, bh*bw), dtype=np.uint16)
+    valid = np.zeros(BATCH, dtype=bool)
+    batch = []
+    for (j, raw, result) in FrameReader([images[i] for (i, fpos) in selected], work):
+        k = len(batch)
+        valid[k] = raw is not None
+        if raw is not None:
+            blocks[k] = result
+        batch.append(selected[j])
+        if len(batch) == BATCH:
+            yield observations(batch, blocks, valid)
+            batch = []
+    if batch:
+        yield observations(batch, blocks, valid)
+
+def add_flight(store, session, resolution=DEFAULT_RESOLUTION, block=DEFAULT_BLOCK,
+               frame_interval=DEFAULT_FRAME_INTERVAL, terrain=None, name=None):
+    '''add the thermal frames of a FlightSession to a survey store, creating it if needed, skipping a flight already added'''
+    if name is None:
+        name = os.path.abspath(session.flight_dir or session.thermal_dir)
+    flight_pos = session.flight_log().flight_pos
+    if os.path.exists(os.path.join(store, SURVEY_INDEX)):
+        grid = SurveyGrid(store)
+    else:
+        if flight_pos.count() == 0:
+            raise ValueError("no flight positions in %s" % session.binlog)
+        p = flight_pos.get(0)
+        grid = SurveyGrid.create(store, p.lat, p.lon, resolution)
+    if any(f['name'] == name for f in grid.flights):
+        print("Flight %s is already in %s" % (name, store))
+        return grid
+    images = session.thermal_files()
+    count = 0
+    (start, end) = (None, None)
+    with profiler.stage('survey_add', count=len(images)):
+        for (t, lat, lon, temp) in frame_observations(images, flight_pos, block=block,
+                                                      frame_interval=frame_interval, terrain=terrain):
+            grid.add_observations(t, lat, lon, temp)
+            count += len(t)
+            if len(t) > 0:
+                start = float(t.min()) if start is None else min(start, float(t.min()))
+                end = float(t.max()) if end is None else max(end, float(t.max()))
+    grid.flights.append({ 'name' : name, 'start' : start, 'end' : end, 'observations' : count })
+    grid.save()
+    print("Added %u observations from %s to %s, %u flights %u tiles" % (count, name, store, len(grid.flights),
+                                                                      len(grid.tile_info)))
+    return grid
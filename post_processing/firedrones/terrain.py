@@ -0,0 +1,184 @@
+'''
+terrain elevation from SRTM tiles and camera ray intersection
+
+tiles are the 1 degree SRTM .hgt files used by MAVProxy and ArduPilot,
+big-endian int16 heights in metres on a square grid with rows from north
+to south, named by their south west corner, eg. S36E149.hgt. They are
+opened with np.memmap and kept in a small LRU cache, so only the pages
+covering the flight area are read from disk.
+
+rays are intersected with the terrain by marching whole batches of rays
+together. Each step moves every ray still in the air a fixed distance,
+looks up the terrain under all of them with one vectorised bilinear
+interpolation, and drops rays which have gone below the ground after
+interpolating linearly between the last two steps for the crossing
+'''
+
+import os
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+# as used by mp_util.gps_offset
+RADIUS_OF_EARTH = 6378100.0
+
+SRTM_VOID = -32768
+
+DEFAULT_MAX_TILES = 16
+DEFAULT_STEP = 5.0
+DEFAULT_MAX_RANGE = 3000.0
+
+def tile_name(lat, lon):
+    '''SRTM tile name for the tile with its south west corner at integer lat,lon'''
+    return "%s%02u%s%03u.hgt" % ('N' if lat >= 0 else 'S', abs(lat),
+                                 'E' if lon >= 0 else 'W', abs(lon))
+
+def offset_latlon(lat, lon, north, east):
+    '''lat,lon arrays offset by north,east metres, a flat earth gps_offset for arrays'''
+    lat_scale = np.degrees(1.0 / RADIUS_OF_EARTH)
+    return (lat + north * lat_scale, lon + east * lat_scale / np.cos(np.radians(lat)))
+
+class TerrainTile(object):
+    '''one memory-mapped SRTM tile'''
+    def __init__(self, filename, lat, lon):
+        size = os.path.getsize(filename) // 2
+        n = int(round(math.sqrt(size)))
+        if n * n != size:
+            raise ValueError("%s is not a square SRTM tile" % filename)
+        self.filename = filename
+        self.lat = lat
+        self.lon = lon
+        self.n = n
+        self.data = np.memmap(filename, dtype='>i2', mode='r', shape=(n, n))
+        self._max_height = None
+
+    def max_height(self):
+        '''highest point in the tile'''
+        if self._max_height is None:
+            self._max_height = float(self.data.max())
+        return self._max_height
+
+    def interpolate(self, lat, lon):
+        '''bilinear heights at arrays of lat,lon within the tile, NaN next to voids'''
+        n = self.n
+        y = (self.lat + 1 - lat) * (n - 1)
+        x = (lon - self.lon) * (n - 1)
+        y0 = np.clip(np.floor(y).astype(np.intp), 0, n-2)
+        x0 = np.clip(np.floor(x).astype(np.intp), 0, n-2)
+        fy = y - y0
+        fx = x - x0
+        d = self.data
+        h = np.stack((d[y0, x0], d[y0, x0+1], d[y0+1, x0], d[y0+1, x0+1])).astype(float)
+        h[h == SRTM_VOID] = np.nan
+        top = h[0] + fx * (h[1] - h[0])
+        bottom = h[2] + fx * (h[3] - h[2])
+        return top + fy * (bottom - top)
+
+class TerrainModel(object):
+    '''terrain heights from a directory of SRTM tiles, with an LRU cache of open tiles'''
+    def __init__(self, tile_dir, max_tiles=DEFAULT_MAX_TILES):
+        if not os.path.isdir(tile_dir):
+            raise ValueError("terrain directory %s not found" % tile_dir)
+        self.tile_dir = tile_dir
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def tile(self, lat, lon):
+        '''the TerrainTile with south west corner at integer lat,lon or None if there is no tile'''
+        key = (lat, lon)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        fname = os.path.join(self.tile_dir, tile_name(lat, lon))
+        tile = None
+        if os.path.exists(fname):
+            tile = TerrainTile(fname, lat, lon)
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def heights(self, lat, lon):
+        '''terrain heights in metres at arrays of lat,lon, NaN where there is no data'''
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        ret = np.full(lat.shape, np.nan)
+        tlat = np.floor(lat).astype(int)
+        tlon = np.floor(lon).astype(int)
+        if len(lat) == 0:
+            return ret
+        if tlat.min() == tlat.max() and tlon.min() == tlon.max():
+            # the usual case of a flight within one tile
+            tile = self.tile(int(tlat[0]), int(tlon[0]))
+            if tile is not None:
+                ret[:] = tile.interpolate(lat, lon)
+            return ret
+        keys = tlat * 360 + tlon
+        for key in np.unique(keys):
+            sel = keys == key
+            i = np.argmax(sel)
+            tile = self.tile(int(tlat[i]), int(tlon[i]))
+            if tile is not None:
+                ret[sel] = tile.interpolate(lat[sel], lon[sel])
+        return ret
+
+    def max_height(self, lat, lon):
+        '''highest point of the tiles under arrays of lat,lon, or None if there are no tiles'''
+        ret = None
+        for (tlat, tlon) in set(zip(np.floor(lat).astype(int).tolist(), np.floor(lon).astype(int).tolist())):
+            tile = self.tile(tlat, tlon)
+            if tile is not None:
+                h = tile.max_height()
+                ret = h if ret is None else max(ret, h)
+        return ret
+
+    def intersect(self, lat, lon, alt, vectors, step=DEFAULT_STEP, max_range=DEFAULT_MAX_RANGE):
+        '''
+        distance along each ray to the terrain, for rays from arrays of
+        lat,lon,alt with (N,3) unit north,east,down vectors. Rays which
+        don't reach the terrain within max_range, or cross a void or
+        missing tile, give NaN
+        '''
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        alt = np.asarray(alt, dtype=float)
+        n = len(lat)
+        dist = np.full(n, np.nan)
+        if n == 0:
+            return dist
+        (north, east, down) = (vectors[:,0], vectors[:,1], vectors[:,2])
+
+        # start each ray just before it comes down to the highest terrain under the origins
+        t = np.zeros(n)
+        hmax = self.max_height(lat, lon)
+        if hmax is not None:
+            descending = down > 0
+            t[descending] = np.maximum((alt[descending] - hmax) / down[descending] - step, 0)
+
+        active = np.arange(n)
+        above = self.height_above(lat, lon, alt, north, east, down, t)
+        while len(active) > 0:
+            t = t + step
+            a = active
+            new_above = self.height_above(lat[a], lon[a], alt[a], north[a], east[a], down[a], t)
+            hit = new_above <= 0
+            # linear interpolation between the last two steps for the crossing
+            frac = above[hit] / np.maximum(above[hit] - new_above[hit], 1.0e-9)
+            dist[a[hit]] = t[hit] - step * (1.0 - np.clip(frac, 0, 1))
+            keep = ~hit & ~np.isnan(new_above) & (t < max_range)
+            active = a[keep]
+            t = t[keep]
+            above = new_above[keep]
+        return dist
+
+    def height_above(self, lat, lon, alt, north, east, down, t):
+        '''height above the terrain of points t metres along rays'''
+        (plat, plon) = offset_latlon(lat, lon, north * t, east * t)
+        return alt - down * t - self.heights(plat, plon)
+
+def open_terrain(tile_dir):
+    '''TerrainModel for a directory of SRTM tiles, or None when no directory is given'''
+    if tile_dir is None:
+        return None
+    return TerrainModel(tile_dir)
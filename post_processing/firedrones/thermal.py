@@ -0,0 +1,45 @@
+'''
+raw thermal frame loading, temperature ranging and colormapping
+'''
+
+import numpy as np
+
+from .archive import load_thermal_to_temperatures
+from .archive import thermal_width, thermal_height
+from .ranging import histogram_of_files
+from .profiling import profiler
+
+def find_temp_range(images):
+    '''find the range of temperatures in a list of thermal files'''
+    with profiler.stage('find_temp_range') as st:
+        h = histogram_of_files(images)
+        st.count = h.frames
+    if h.empty():
+        return (None, None)
+    return h.temp_range()
+
+def load_thermal_colormap(fname, tmin, tmax):
+    '''load a raw thermal file as an inferno colormapped RGB image'''
+    import matplotlib.pyplot as plt
+
+    a = load_thermal_to_temperatures(fname)
+    if a is None:
+        return None
+
+    # clip to the specified range
+    a = np.clip(a, tmin, tmax)
+
+    # convert to 0 to 1 range tmin to tmax
+    a = (a - tmin) / float(tmax - tmin)
+    a = a.reshape(thermal_height, thermal_width)
+
+    # apply colormap
+    rgb = plt.cm.inferno(a)
+    rgb_image = (rgb[..., :3] * 255).astype(np.uint8)
+
+    return rgb_image
+
+def colormap_lut():
+    '''get inferno colormap as a 256 entry uint8 lookup table'''
+    import matplotlib.pyplot as plt
+    return (plt.cm.inferno(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
@@ -0,0 +1,149 @@
+'''
+convert thermal images to CSV for Nicks project
+'''
+
+import os
+import math
+from datetime import datetime
+import numpy as np
+
+from .archive import thermal_width, thermal_height
+from .stats import FrameStatistics, frame_times
+from .profiling import profiler
+
+def parse_basepos(basepos):
+    '''parse a lat,lon,alt base position string'''
+    base = basepos.split(",")
+    return (float(base[0]), float(base[1]), float(base[2]))
+
+class SIYIData(object):
+    def __init__(self, filename, basepos):
+        from pymavlink import mavutil
+        print("Opening SIYI log %s" % filename)
+        (self.baselat, self.baselon, self.basealt) = basepos
+        mlog = mavutil.mavlink_connection(filename)
+        self.gps = []
+        while True:
+            m = mlog.recv_match(type=['GPS'])
+            if m is None:
+                break
+            self.gps.append(m)
+        self.timestamps = np.array([m._timestamp for m in self.gps], dtype=float)
+        self.lat = np.array([m.Lat for m in self.gps], dtype=float)
+        self.lng = np.array([m.Lng for m in self.gps], dtype=float)
+        self.alt = np.array([m.Alt for m in self.gps], dtype=float)
+        print("Loaded %u GPS records" % len(self.gps))
+
+    def get_distances(self, timestamps):
+        '''
+        distance from the base position using the first GPS record at or
+        after each timestamp, NaN after the last GPS record
+        '''
+        idx = np.searchsorted(self.timestamps, timestamps, side='left')
+        missing = idx >= len(self.gps)
+        if len(self.gps) == 0:
+            return np.full(len(idx), np.nan)
+        idx[missing] = 0
+        (baselat, baselon, basealt) = (self.baselat, self.baselon, self.basealt)
+        lat = self.lat[idx]
+        dLat = np.radians(lat - baselat)
+        dLon = np.radians(self.lng[idx] - baselon)
+        dAlt = np.radians(self.alt[idx] - basealt)
+
+        a = np.sin(0.5*dLat)**2 + np.sin(0.5*dLon)**2 * math.cos(math.radians(baselat)) * np.cos(np.radians(lat))
+        c = 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0-a))
+        ground_dist = 6371 * 1000 * c
+        ret = np.sqrt(ground_dist**2 + dAlt**2)
+        ret[missing] = np.nan
+        return ret
+
+    def get_distance(self, timestamp):
+        d = self.get_distances(np.array([timestamp], dtype=float))[0]
+        if np.isnan(d):
+            return None
+        return float(d)
+
+def open_summary(filename="summary.csv", columns=[]):
+    summary = open(filename,"w")
+    summary.write(",".join(["FileName", "TimeStamp", "Distance", "TMin", "TMax"] + columns) + "\n")
+    return summary
+
+def format_value(v):
+    '''format a statistics value, pixel counts as integers and temperatures to 0.01C'''
+    if isinstance(v, np.integer):
+        return '%u' % v
+    return '%.2f' % v
+
+def frame_csv_file(filename, out_dir):
+    '''the CSV file in out_dir for a thermal file or archive member'''
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(filename))[0] + '.csv')
+
+def convert_to_csv(filenames, siyi, summary, min_temp=-100, first_temp=200, stats=None, frame_csv=True, out_dir='.'):
+    '''
+    write a CSV of each frame into out_dir and a summary line per frame
+    with the columns of a FrameStatistics. Frames are loaded and reduced a
+    chunk at a time and the summary is written in one go at the end
+    '''
+    if stats is None:
+        stats = FrameStatistics(stats=False)
+    extra = stats.extra_columns()
+    timestamps = frame_times(filenames)
+    distances = siyi.get_distances(timestamps)
+    lines = []
+    seen_first_temp = False
+    for chunk in stats.chunks(filenames):
+        cols = chunk.columns
+        for i in np.flatnonzero(chunk.valid):
+            n = chunk.start + i
+            filename = filenames[n]
+            tmin = float(cols['TMin'][i])
+            tmax = float(cols['TMax'][i])
+
+            if tmax < min_temp:
+                continue
+
+            if not seen_first_temp and tmax < first_temp:
+                continue
+            seen_first_temp = True
+
+            timestamp = timestamps[n]
+            mtime_human = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            if np.isnan(distances[n]):
+                continue
+            distance = float(distances[n])
+
+            if frame_csv:
+                # Write the data to a CSV file
+                csv_filename = frame_csv_file(filename, out_dir)
+                data = chunk.stack[i].reshape((thermal_height, thermal_width))
+                np.savetxt(csv_filename, data, fmt='%.1f', delimiter=',')
+                print(f"Converted {filename} to {csv_filename} trange=[{tmin}, {tmax}] dist={distance} {mtime_human}")
+
+            values = ''.join(',' + format_value(cols[k][i]) for k in extra)
+            lines.append(f"{filename},{mtime_human},{distance},{tmin},{tmax}{values}\n")
+    summary.write(''.join(lines))
+    return len(lines)
+
+def thermal_to_csv(filenames, siyi_log, basepos, min_temp=-100, first_temp=200, summary_file="summary.csv",
+                   stats=None, frame_csv=True, out_dir=None):
+    '''
+    convert a list of thermal files to CSV, writing a summary file with the
+    columns of a FrameStatistics. The frame CSVs go in out_dir, by default
+    the directory of the summary file
+    '''
+    if out_dir is None:
+        out_dir = os.path.dirname(summary_file) or '.'
+    if frame_csv:
+        os.makedirs(out_dir, exist_ok=True)
+    if stats is None:
+        stats = FrameStatistics(stats=False)
+    summary = open_summary(summary_file, stats.extra_columns())
+    with profiler.stage('siyi_log'):
+        siyi = SIYIData(siyi_log, basepos)
+    with profiler.stage('convert_to_csv', count=len(filenames)):
+        count = convert_to_csv(filenames, siyi, summary, min_temp=min_temp, first_temp=first_temp,
+                               stats=stats, frame_csv=frame_csv, out_dir=out_dir)
+    summary.close()
+    print("Wrote %u of %u frames to %s" % (count, len(filenames), summary_file))
+    if stats.redundancy is not None:
+        print("Statistics: %s" % stats.redundancy.summary())
@@ -0,0 +1,518 @@
+'''
+thermal, flight state and combined RGB/thermal video products
+
+moviepy is imported when a video is made, so the rest of the package
+can be used without it
+
+with the web encode profile keyframes are forced onto wall clock
+second boundaries, with scene cut keyframes disabled and a bounded GOP,
+and a sidecar json maps the wall clock time of each keyframe to its PTS.
+The viewer seeks every video to the keyframe for the same wall clock
+time, so all of the videos show the same instant without decoding up
+to the seek point
+'''
+
+import os
+import re
+import math
+import json
+import subprocess
+import numpy as np
+
+from .archive import getmtime, thermal_width, thermal_height
+from .thermal import colormap_lut
+from .ranging import raw_level_lut, frame_histogram
+from .readahead import FrameReader
+from .profiling import profiler
+
+RGB_DIR = "100SIYI_VID"
+THERMAL_DIR = "102SIYI_TEM"
+LOG_NAME = "log.bin"
+SIYI_LOG_NAME = "SIYI_log.bin"
+
+ENCODE_PROFILES = ['default', 'web']
+DEFAULT_KEYFRAME_INTERVAL = 1.0
+KEYFRAME_SUFFIX = ".keyframes.json"
+
+class EncodeProfile(object):
+    '''output encoding options, the web profile is for seeking in the map viewer'''
+    def __init__(self, name='default', keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        if not name in ENCODE_PROFILES:
+            raise ValueError("unknown encode profile %s" % name)
+        self.name = name
+        self.keyframe_interval = keyframe_interval
+
+    def web(self):
+        return self.name == 'web'
+
+    def ffmpeg_params(self, start_time, fps=None):
+        '''ffmpeg output options for a video whose first frame is at wall clock start_time'''
+        if not self.web():
+            return []
+        interval = self.keyframe_interval
+        # video time of the first wall clock interval boundary
+        offset = (-start_time) % interval
+        ret = ['-force_key_frames', 'expr:gte(t,%f+n_forced*%f)' % (offset, interval),
+               '-sc_threshold', '0']
+        if fps is not None:
+            # only the forced keyframes, bounded if the forcing ever fails
+            ret += ['-g', str(int(math.ceil(2 * interval * fps)))]
+        return ret
+
+    def finish(self, video):
+        '''write the keyframe sidecar for a finished video, after its mtime is set'''
+        if self.web():
+            write_keyframe_map(video, self.keyframe_interval)
+
+def encode_profile_from_options(opts):
+    '''EncodeProfile from the --encode-profile and --keyframe-interval options'''
+    return EncodeProfile(opts.encode_profile, opts.keyframe_interval)
+
+def probe_keyframes(video):
+    '''(duration, keyframe PTS list) of the first video stream, decoding only the keyframes'''
+    p = subprocess.run(['ffmpeg', '-hide_banner', '-skip_frame', 'nokey', '-i', video,
+                        '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError("ffmpeg keyframe probe of %s failed" % video)
+    m = re.search(r'Duration: (\d+):(\d+):([\d.]+)', p.stderr)
+    if m is None:
+        raise RuntimeError("no duration for %s" % video)
+    duration = int(m.group(1))*3600 + int(m.group(2))*60 + float(m.group(3))
+    keyframes = [float(t) for t in re.findall(r'pts_time:([-\d.]+)', p.stderr)]
+    return (duration, keyframes)
+
+def keyframe_map_file(video):
+    return video + KEYFRAME_SUFFIX
+
+def write_keyframe_map(video, interval=DEFAULT_KEYFRAME_INTERVAL):
+    '''
+    write the sidecar of [wall clock time, PTS] for each keyframe, the
+    start time being the mtime less the duration as for the map viewer
+    '''
+    (duration, keyframes) = probe_keyframes(video)
+    start_time = os.path.getmtime(video) - duration
+    j = { "start_time" : start_time,
+          "interval" : interval,
+          "keyframes" : [[start_time + t, t] for t in keyframes] }
+    with open(keyframe_map_file(video), 'w') as f:
+        json.dump(j, f)
+    print("Wrote %u keyframes for %s" % (len(keyframes), video))
+
+def frame_work(redundancy=None):
+    '''
+    the work done on each frame as it is read ahead, giving the frame
+    histogram for ranging and the signature for a RedundancyDetector
+    '''
+    def work(raw):
+        return (frame_histogram(raw), redundancy.signature(raw) if redundancy is not None else None)
+    return work
+
+class ThermalFrameSource(object):
+    '''
+    raw frames read ahead in order as a video encoder asks for them, so
+    only the readahead ring is held however long the video is. Asking for
+    an earlier frame, or one further on than the readahead reaches, starts
+    reading again from there
+    '''
+    def __init__(self, images):
+        self.images = images
+        self.reader = None
+        self.base = 0
+        self.next = 0
+        self.depth = 0
+
+    def start(self, idx):
+        self.close()
+        reader = FrameReader(self.images[idx:])
+        self.base = idx
+        self.next = idx
+        self.depth = reader.depth
+        self.reader = iter(reader)
+
+    def get(self, idx):
+        '''flat raw frame idx, a view valid until the next call, or None if invalid'''
+        if self.reader is None or idx < self.next or idx >= self.next + self.depth:
+            self.start(idx)
+        while True:
+            (i, raw, result) = next(self.reader)
+            self.next = self.base + i + 1
+            if self.base + i == idx:
+                return raw
+
+    def close(self):
+        '''stop reading ahead'''
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+def thermal_clip(images, durations, ranges, ranging=None, times=None):
+    '''
+    a clip showing raw thermal frames for the given durations, colormapped
+    with a (tmin,tmax) range per frame. With ranges None each frame is
+    added to the agc ThermalRanging ranging at its time in times as it is
+    read, which gives its range. Frames are read and colormapped as they
+    are encoded with a lookup table on the raw counts. The clip
+    frame_source must be closed once the clip is written
+    '''
+    from moviepy.editor import VideoClip
+
+    starts = np.cumsum([0.0] + durations[:-1])
+    colours = colormap_lut()
+    source = ThermalFrameSource(images)
+    lut = { 'range' : None, 'frame' : None, 'image' : None, 'ranged' : -1 }
+
+    def make_frame(t):
+        i = min(max(np.searchsorted(starts, t, side='right') - 1, 0), len(images)-1)
+        if i == lut['frame']:
+            # a frame shown for several output frames is colormapped once
+            return lut['image']
+        raw = source.get(i)
+        lut['frame'] = i
+        if raw is None:
+            # an invalid frame keeps showing the frame before, or black
+            if lut['image'] is None:
+                lut['image'] = np.zeros((thermal_height, thermal_width, 3), dtype=np.uint8)
+            return lut['image']
+        r = ranges[i] if ranges is not None else lut['range']
+        if ranges is None and i > lut['ranged']:
+            # each frame is added once, in order, as the encoder reaches it
+            r = ranging.add_frame(times[i], raw)
+            lut['ranged'] = i
+        if r != lut['range']:
+            lut['range'] = r
+            lut['rgb'] = colours[raw_level_lut(*r)]
+        lut['image'] = lut['rgb'][raw].reshape(thermal_height, thermal_width, 3)
+        return lut['image']
+
+    ret = VideoClip(make_frame, duration=sum(durations))
+    ret.frame_source = source
+    return ret
+
+def make_thermal_video(images, start_time, rgb_duration, ranging, redundancy=None):
+    '''
+    make the thermal video which will be setup as PIP, ranging is a
+    ThermalRanging. With a RedundancyDetector redundant frames extend the
+    duration of the frame before them. An agc range only depends on the
+    frames before, so without a RedundancyDetector frames are ranged as
+    they are read for encoding. Otherwise they are read here, for the
+    global range or to find the redundant frames before the clip is
+    timed, and again as the clip is encoded
+    '''
+    from progress.bar import Bar
+
+    done = 0
+
+    bar = Bar('Loading raw thermal', max=len(images))
+
+    shown = []
+    durations = []
+    ranges = []
+    first_timestamp = None
+
+    st = profiler.stage('thermal_load')
+    with st:
+        # (image, mod_time, duration) of the frames during the RGB video
+        selected = []
+        for i in range(len(images)):
+            mod_time = getmtime(images[i])
+            if mod_time < start_time:
+                continue
+            if mod_time > start_time+rgb_duration:
+                break
+            if first_timestamp is None:
+                first_timestamp = mod_time
+            if i < len(images)-1:
+                next_mod_time = getmtime(images[i+1])
+            else:
+                next_mod_time = mod_time + 1.0
+            selected.append((images[i], mod_time, next_mod_time - mod_time))
+
+        if ranging.mode == 'agc' and redundancy is None:
+            st.count = len(selected)
+            ret = thermal_clip([s[0] for s in selected], [s[2] for s in selected], None,
+                               ranging=ranging, times=[s[1] for s in selected])
+            ret.start_time = first_timestamp
+            return ret
+
+        reader = FrameReader([s[0] for s in selected], frame_work(redundancy))
+        for (i, raw, result) in reader:
+            if raw is None:
+                continue
+            (image, mod_time, duration) = selected[i]
+            (counts, signature) = result
+            done += 1
+            st.count = done
+            bar.next()
+
+            if redundancy is not None and redundancy.check_signature(signature) and shown:
+                durations[-1] += duration
+                continue
+
+            ranges.append(ranging.add_frame(mod_time, raw, counts))
+            shown.append(image)
+            durations.append(duration)
+
+    if ranging.mode != 'agc':
+        r = ranging.global_range()
+        ranges = [r] * len(shown)
+        print("Temp range: %.1f to %.1f" % r)
+
+    ret = thermal_clip(shown, durations, ranges)
+    ret.start_time = first_timestamp
+
+    return ret
+
+def make_flight_state_video(states, start_time, rgb_duration):
+    '''make a video clip of flight state from a list of FlightState'''
+    from moviepy.editor import TextClip, CompositeVideoClip
+
+    clips = []
+    last_t = None
+    first_timestamp = None
+    last_txt = 'Mode: INIT'
+
+    for s in states:
+        if s.timestamp < start_time:
+            continue
+        if s.timestamp > start_time+rgb_duration:
+            break
+        if first_timestamp is None:
+            first_timestamp = s.timestamp
+            last_t = first_timestamp
+        if s.timestamp - last_t < 1.0:
+            continue
+        duration = s.timestamp - last_t
+        txt = f'''
+Mode: {s.mode}
+AltAGL: {s.CHeight:.2f}m
+'''
+        clip = TextClip(last_txt, color='red', font="Amiri-Bold", kerning = 5, fontsize=32)
+        clip = clip.set_start(last_t - first_timestamp)
+        clip = clip.set_duration(duration)
+        clip = clip.set_position(("right", "top"))
+        clip.start_time = last_t
+        clips.append(clip)
+        last_txt = txt
+        last_t = s.timestamp
+
+    video = CompositeVideoClip(clips, size=(thermal_width, thermal_height))
+    video.start_time = clips[0].start_time
+    return video
+
+def concatenate_videos(video_files, output_file, codec='h264', duration=None):
+    # Use NamedTemporaryFile to create a temporary file
+    flist=output_file[:-4] + "_flist.txt"
+    f = open(flist,'w')
+    for video in video_files:
+        f.write(f"file '{video}'\n")
+    f.close()
+
+    # Call ffmpeg to concatenate the videos using the temporary file list
+    argsc = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', flist,
+        '-c', codec,
+        '-movflags', 'faststart',
+        '-pix_fmt', 'yuv420p',
+        ]
+    if duration is not None:
+        argsc += ['-t', "%.2f" % duration]
+    profiler.run(argsc + [output_file], name='ffmpeg concat')
+    os.unlink(flist)
+
+    # set mtime to mtime of last file, so start time can be predicted from mtime
+    last_mtime = os.path.getmtime(video_files[-1])
+    os.utime(output_file, (last_mtime, last_mtime))
+
+def overlay_videos(rgb, thermal, flight_state, output, duration, codec='h264', profile=None, start_time=None, fps=None):
+    '''
+    Call ffmpeg to concatenate the videos using the temporary file list, fps
+    is that of the RGB video. With a start_time the output mtime is its end
+    on that clock, otherwise the mtime of the RGB video
+    '''
+    if profile is None:
+        profile = EncodeProfile()
+    params = []
+    if start_time is not None:
+        params = profile.ffmpeg_params(start_time, fps)
+    profiler.run([
+        'ffmpeg',
+        '-y',
+        '-i', rgb,
+        '-i', thermal,
+        '-i', flight_state,
+        '-filter_complex',
+        'overlay=0:0,overlay=main_w-overlay_w:0',
+        '-codec', codec,
+        '-movflags', 'faststart',
+        '-pix_fmt', 'yuv420p',
+        '-t', "%.2f" % duration,
+    ] + params + [
+        output
+    ], name='ffmpeg overlay')
+    mtime = start_time + duration if start_time is not None else os.path.getmtime(rgb)
+    os.utime(output, (mtime, mtime))
+    profile.finish(output)
+
+def make_rgb_video(videos, output_base, codec='h264', duration=None):
+    '''make the rgb video concatenating all RGB videos'''
+    from moviepy.editor import VideoFileClip
+
+    if len(videos) <= 1:
+        return videos[0]
+    first_duration = VideoFileClip(videos[0]).duration
+    start_time = os.path.getmtime(videos[0]) - first_duration
+    rgb_tmp = output_base + "_rgb_tmp.mp4"
+    print("Concatenating %u RGB videos" % len(videos))
+    concatenate_videos(videos, rgb_tmp, codec=codec, duration=duration)
+
+    # fixup mtime
+    duration = VideoFileClip(rgb_tmp).duration
+    end_time = start_time + duration
+    os.utime(rgb_tmp, (end_time, end_time))
+
+    return rgb_tmp
+
+def create_combined_video(session, output, ranging, codec='h264', duration=None, profile=None, redundancy=None):
+    '''create the RGB video with thermal PIP and flight state overlay for a FlightSession'''
+    from moviepy.editor import VideoFileClip
+
+    # get the base name of the output file for temporary files
+    output_base = output[:-4]
+
+    with profiler.stage('rgb_concat'):
+        rgb_file = make_rgb_video(session.rgb_videos(), output_base, codec=codec, duration=duration)
+
+    # get the RGB video
+    base_rgb = VideoFileClip(rgb_file)
+    # on the log clock, as are the thermal frame times and flight states
+    base_rgb.start_time = session.log_time(os.path.getmtime(rgb_file) - base_rgb.duration)
+
+    if duration is not None and base_rgb.duration > duration:
+        base_rgb = base_rgb.set_duration(duration)
+
+    print("Opened RGB video of length %.2fs" % base_rgb.duration)
+
+    # make a video of text clips showing text state from bin log
+    with profiler.stage('flight_state_log'):
+        flightstate_video = make_flight_state_video(session.flight_log().states, base_rgb.start_time, base_rgb.duration)
+    flightstate_tmp = output_base + "_flight_tmp.mp4"
+    with profiler.stage('flight_state_encode'):
+        flightstate_video.write_videofile(flightstate_tmp, fps=1, codec=codec)
+    flightstate_end_time = flightstate_video.start_time + flightstate_video.duration
+    os.utime(flightstate_tmp, (flightstate_end_time, flightstate_end_time))
+    print("Created flight state video of length %.2fs" % flightstate_video.duration)
+
+    print("making PIP thermal")
+    thermal_video = make_thermal_video(session.thermal_files(), base_rgb.start_time, base_rgb.duration,
+                                       ranging, redundancy=redundancy).set_position(("left","top"))
+    thermal_tmp = output_base + "_thermal_tmp.mp4"
+    ffmpeg_parm = [ '-movflags', 'faststart', '-pix_fmt', 'yuv420p' ]
+    with profiler.stage('thermal_encode'):
+        thermal_video.write_videofile(thermal_tmp, fps=1, codec=codec, ffmpeg_params=ffmpeg_parm)
+    thermal_video.frame_source.close()
+    thermal_end_time = thermal_video.start_time + thermal_video.duration
+    os.utime(thermal_tmp, (thermal_end_time, thermal_end_time))
+
+    print("Created thermal video of length %.2fs" % thermal_video.duration)
+    if redundancy is not None:
+        print("Thermal PIP: %s" % redundancy.summary())
+
+    thermal_offset = thermal_video.start_time - base_rgb.start_time
+    flight_offset = flightstate_video.start_time - base_rgb.start_time
+    print("thermal: offset=%.2fs duration=%.2f" % (thermal_offset, thermal_video.duration))
+    print("flight data: offset=%.2fs duration=%.2f" % (flight_offset, flightstate_video.duration))
+
+    print("Overlaying videos onto %s" % output)
+    overlay_videos(rgb_file, thermal_tmp, flightstate_tmp, output, base_rgb.duration, codec=codec,
+                   profile=profile, start_time=base_rgb.start_time, fps=base_rgb.fps)
+
+def create_thermal_video(images, output, ranging, fps=1, profile=None, redundancy=None):
+    '''
+    create a colormapped video of a list of thermal frames, timed by frame
+    mtime. The video mtime is set to its end so the start time can be
+    predicted from the mtime. With a RedundancyDetector redundant frames
+    extend the duration of the frame before them. An agc range only
+    depends on the frames before, so without a RedundancyDetector frames
+    are ranged as they are read for encoding. The global range needs all
+    frames and redundant frames change the clip timing, so otherwise
+    frames are read first for those and again as they are encoded
+    '''
+    if profile is None:
+        profile = EncodeProfile()
+    shown = []
+    start_time = None
+    durations = []
+    ranges = []
+    times = None
+
+    previous_mod_time = None
+    done = 0
+
+    st = profiler.stage('thermal_load')
+    with st:
+        if ranging.mode == 'agc' and redundancy is None:
+            # only the frame times are needed before encoding
+            times = [getmtime(f) for f in images]
+            shown = images
+            durations = [1] + [times[i] - times[i-1] for i in range(1, len(times))]
+            start_time = times[0] if times else None
+            ranges = None
+            reader = []
+            st.count = len(images)
+        else:
+            reader = FrameReader(images, frame_work(redundancy))
+        for (i, raw, result) in reader:
+            image_path = images[i]
+            mod_time = getmtime(image_path)
+
+            if previous_mod_time is not None:
+                # Calculate the duration each image should be displayed to match the time between frames
+                duration = mod_time - previous_mod_time
+            else:
+                duration = 1  # default duration for the first image
+
+            print("Loading %s (%u/%u) for %.3fs" % (image_path, done, len(images), duration))
+            done += 1
+            if raw is None:
+                continue
+            st.count += 1
+            (counts, signature) = result
+
+            if redundancy is not None and redundancy.check_signature(signature) and shown:
+                durations[-1] += duration
+                previous_mod_time = mod_time
+                continue
+
+            ranges.append(ranging.add_frame(mod_time, raw, counts))
+            shown.append(image_path)
+            durations.append(duration)
+            if start_time is None:
+                start_time = mod_time
+
+            previous_mod_time = mod_time
+
+    if ranging.mode != 'agc':
+        r = ranging.global_range()
+        ranges = [r] * len(shown)
+        print("Temp range: %.1fC to %.1fC" % r)
+    if redundancy is not None:
+        print("Thermal video: %s" % redundancy.summary())
+
+    video = thermal_clip(shown, durations, ranges, ranging=ranging, times=times)
+
+    # Output the video file, frames are read and colormapped as they are encoded
+    params = []
+    if start_time is not None:
+        params = profile.ffmpeg_params(start_time, fps)
+    with profiler.stage('encode', count=len(shown)):
+        video.write_videofile(output, fps=fps, ffmpeg_params=params)
+    video.frame_source.close()
+    if start_time is not None:
+        end_time = start_time + video.duration
+        os.utime(output, (end_time, end_time))
+    profile.finish(output)
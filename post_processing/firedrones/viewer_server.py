@@ -0,0 +1,291 @@
+'''
+local HTTP server for a flight directory generated by the map product
+
+answers time window and bounding box queries over the flight samples,
+hotspot events and heatmap bins from in-memory indexes, serves videos
+with HTTP Range support and serves the KML overlay from a local cache
+
+  /api/summary
+  /api/flight?t0=&t1=&bbox=lat1,lon1,lat2,lon2&step=
+  /api/hotspots?t0=&t1=&bbox=
+  /api/heatmap?t0=&t1=&bbox=&res=
+  /kml/NAME
+  /api/live (WebSocket, with --live)
+'''
+
+import os
+import json
+import urllib.parse
+import urllib.request
+import numpy as np
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# default heatmap bin size in degrees, roughly 50m
+HEATMAP_RES = 0.0005
+
+COPY_CHUNK = 256*1024
+
+class TimeIndex(object):
+    '''set of records sorted by timestamp with vectorised window and bbox queries'''
+    def __init__(self, records):
+        records = sorted(records, key=lambda r: r['timestamp'])
+        self.records = records
+        self.timestamps = np.array([r['timestamp'] for r in records], dtype=np.float64)
+        self.lats = np.array([r['lat'] for r in records], dtype=np.float64)
+        self.lons = np.array([r['lon'] for r in records], dtype=np.float64)
+
+    def count(self):
+        return len(self.records)
+
+    def query(self, t0=None, t1=None, bbox=None):
+        '''return array of record indexes within a time window and bounding box'''
+        i1 = 0
+        i2 = len(self.records)
+        if t0 is not None:
+            i1 = np.searchsorted(self.timestamps, t0, side='left')
+        if t1 is not None:
+            i2 = np.searchsorted(self.timestamps, t1, side='right')
+        idx = np.arange(i1, i2)
+        if bbox is not None and len(idx) > 0:
+            (lat1, lon1, lat2, lon2) = bbox
+            lats = self.lats[i1:i2]
+            lons = self.lons[i1:i2]
+            mask = (lats >= min(lat1, lat2)) & (lats <= max(lat1, lat2)) & (lons >= min(lon1, lon2)) & (lons <= max(lon1, lon2))
+            idx = idx[mask]
+        return idx
+
+    def get(self, idx):
+        return [self.records[i] for i in idx]
+
+class FlightData(object):
+    '''in-memory indexes over the flight data files in a flight directory'''
+    def __init__(self, flight_dir):
+        self.flight_dir = flight_dir
+        self.flight = TimeIndex(self.load_json('flight.json'))
+        self.hotspots = TimeIndex(self.load_json('hotspots.json'))
+        self.weights = np.array([r['weight'] for r in self.hotspots.records], dtype=np.float64)
+        print("Loaded %u flight samples and %u hotspots" % (self.flight.count(), self.hotspots.count()))
+
+    def load_json(self, name):
+        fname = os.path.join(self.flight_dir, name)
+        if not os.path.exists(fname):
+            print("No %s" % fname)
+            return []
+        with open(fname) as f:
+            return json.load(f)
+
+    def summary(self):
+        ret = { "count" : self.flight.count(), "hotspot_count" : self.hotspots.count() }
+        if self.flight.count() > 0:
+            ret["start"] = self.flight.timestamps[0]
+            ret["end"] = self.flight.timestamps[-1]
+            ret["bbox"] = [self.flight.lats.min(), self.flight.lons.min(), self.flight.lats.max(), self.flight.lons.max()]
+        return ret
+
+    def heatmap_bins(self, t0, t1, bbox, res):
+        '''bin hotspot weights onto a lat/lon grid of res degrees'''
+        idx = self.hotspots.query(t0, t1, bbox)
+        if len(idx) == 0:
+            return []
+        cells = np.stack((np.floor(self.hotspots.lats[idx] / res), np.floor(self.hotspots.lons[idx] / res)), axis=1)
+        (cells, inverse) = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        weight = np.bincount(inverse, weights=self.weights[idx])
+        count = np.bincount(inverse)
+        ret = []
+        for i in range(len(cells)):
+            ret.append({ "lat" : (cells[i][0] + 0.5) * res,
+                         "lon" : (cells[i][1] + 0.5) * res,
+                         "weight" : weight[i],
+                         "count" : int(count[i]) })
+        return ret
+
+class KMLCache(object):
+    '''local cache of remote KML files'''
+    def __init__(self, cache_dir, urls):
+        self.cache_dir = cache_dir
+        self.urls = { os.path.basename(u) : u for u in urls }
+
+    def get(self, name):
+        '''return filename of the cached KML, fetching it if needed'''
+        name = os.path.basename(name)
+        fname = os.path.join(self.cache_dir, name)
+        if os.path.exists(fname):
+            return fname
+        if not name in self.urls:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        print("Fetching %s" % self.urls[name])
+        with urllib.request.urlopen(self.urls[name], timeout=30) as r:
+            data = r.read()
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fname + '.tmp', fname)
+        return fname
+
+def parse_float(q, name):
+    '''get an optional float from a parsed query string'''
+    if not name in q:
+        return None
+    return float(q[name][0])
+
+def parse_bbox(q):
+    '''get an optional lat1,lon1,lat2,lon2 bounding box from a parsed query string'''
+    if not 'bbox' in q:
+        return None
+    bbox = [float(v) for v in q['bbox'][0].split(',')]
+    if len(bbox) != 4:
+        raise ValueError("bbox needs 4 values")
+    return bbox
+
+def parse_byte_range(spec, size):
+    '''
+    (start, end) of a single START-END, START- or -SUFFIX byte range of
+    a file of size bytes, raising ValueError if it is malformed
+    '''
+    (s1, s2) = spec.split('-', 1)
+    if not (s1 == '' or s1.isdigit()) or not (s2 == '' or s2.isdigit()) or s1 == s2 == '':
+        raise ValueError("bad byte range %s" % spec)
+    if s1 == '':
+        # suffix range, last N bytes
+        return (max(size - int(s2), 0), size-1)
+    if s2 == '':
+        return (int(s1), size-1)
+    return (int(s1), min(int(s2), size-1))
+
+def json_default(v):
+    '''allow numpy scalars in JSON replies'''
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError("can't encode %s" % type(v))
+
+class ViewerHandler(SimpleHTTPRequestHandler):
+    '''request handler for API queries, KML and static files with Range support'''
+    flight_data = None
+    kml_cache = None
+    live = None
+
+    def send_json(self, obj):
+        data = json.dumps(obj, default=json_default).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_api(self, path, q):
+        fd = self.flight_data
+        if path == '/api/summary':
+            if self.live is not None:
+                return self.live.summary()
+            return fd.summary()
+        t0 = parse_float(q, 't0')
+        t1 = parse_float(q, 't1')
+        bbox = parse_bbox(q)
+        if path == '/api/flight':
+            idx = fd.flight.query(t0, t1, bbox)
+            step = int(parse_float(q, 'step') or 1)
+            return fd.flight.get(idx[::max(step, 1)])
+        if path == '/api/hotspots':
+            return fd.hotspots.get(fd.hotspots.query(t0, t1, bbox))
+        if path == '/api/heatmap':
+            res = parse_float(q, 'res') or HEATMAP_RES
+            return fd.heatmap_bins(t0, t1, bbox, res)
+        return None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        if path == '/api/live' and self.live is not None:
+            self.live.serve_client(self)
+            return
+        if path.startswith('/api/'):
+            try:
+                ret = self.handle_api(path, urllib.parse.parse_qs(url.query))
+            except ValueError as ex:
+                self.send_error(400, str(ex))
+                return
+            if ret is None:
+                self.send_error(404, "Unknown query")
+                return
+            self.send_json(ret)
+            return
+        if path.startswith('/kml/'):
+            try:
+                fname = self.kml_cache.get(path[5:])
+            except Exception as ex:
+                self.send_error(502, "KML fetch failed: %s" % ex)
+                return
+            if fname is None:
+                self.send_error(404, "Unknown KML")
+                return
+            self.send_file(fname, 'application/vnd.google-earth.kml+xml')
+            return
+        fname = self.translate_path(url.path)
+        if not os.path.isfile(fname):
+            # directories and errors are handled by the standard handler
+            SimpleHTTPRequestHandler.do_GET(self)
+            return
+        self.send_file(fname, self.guess_type(fname))
+
+    def send_file(self, fname, ctype):
+        '''send a file, honouring a single byte range if requested'''
+        size = os.path.getsize(fname)
+        (start, end) = (0, size-1)
+        status = 200
+        rng = self.headers.get('Range')
+        if rng is not None and rng.startswith('bytes=') and not ',' in rng:
+            try:
+                (start, end) = parse_byte_range(rng[6:], size)
+            except ValueError:
+                # unsatisfiable, the same as a range past the end
+                (start, end) = (size, size-1)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%u' % size)
+                self.end_headers()
+                return
+            status = 206
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %u-%u/%u' % (start, end, size))
+        self.end_headers()
+        with open(fname, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                buf = f.read(min(COPY_CHUNK, length))
+                if not buf:
+                    break
+                try:
+                    self.wfile.write(buf)
+                except (BrokenPipeError, ConnectionResetError):
+                    # browsers drop video connections when seeking
+                    return
+                length -= len(buf)
+
+def run_server(flight_dir, port, kml_urls, kml_cache_dir, live=None):
+    '''serve a flight directory until interrupted, with live telemetry from a LiveTelemetry if given'''
+    flight_dir = os.path.abspath(flight_dir)
+
+    class Handler(ViewerHandler):
+        pass
+    Handler.flight_data = FlightData(flight_dir)
+    Handler.kml_cache = KMLCache(kml_cache_dir, kml_urls)
+    Handler.live = live
+    if live is not None:
+        live.start()
+
+    def make_handler(*hargs, **kwargs):
+        return Handler(*hargs, directory=flight_dir, **kwargs)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler)
+    print("Serving %s on http://127.0.0.1:%u/" % (flight_dir, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
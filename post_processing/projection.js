@@ -94,7 +94,11 @@ function get_latlon(fpos, x, y, FOV, aspect_ratio) {
     return gps_offset(latlon, v.y, v.x);
 }
 
-function get_viewport_corners(fpos, FOV, aspect_ratio) {
+function get_viewport_corners(fpos, FOV, aspect_ratio, corners) {
+    if (corners) {
+        // corners projected onto the terrain when flight.json was made
+        return corners.map(c => new google.maps.LatLng(c[0], c[1]));
+    }
     return [get_latlon(fpos, -1, -1, FOV, aspect_ratio),
 	    get_latlon(fpos, 1, -1,  FOV, aspect_ratio),
 	    get_latlon(fpos, 1, 1,   FOV, aspect_ratio),
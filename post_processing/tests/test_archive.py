@@ -0,0 +1,69 @@
+'''
+round trip tests for the thermal frame archive
+'''
+
+import os
+import numpy as np
+import pytest
+
+from firedrones import archive
+
+def smooth_frame():
+    '''a smooth scene with sensor noise and a hot spot, as >u2 counts'''
+    rng = np.random.default_rng(1)
+    (y, x) = np.mgrid[0:archive.thermal_height, 0:archive.thermal_width]
+    kelvin = 290 + 10 * np.sin(x / 97.0) + 5 * np.cos(y / 61.0)
+    kelvin[200:230, 300:340] += 150
+    counts = kelvin * 64 + rng.normal(0, 20, kelvin.shape)
+    return counts.astype('>u2')
+
+def random_frame():
+    '''full range noise, which has no small row differences at all'''
+    rng = np.random.default_rng(2)
+    return rng.integers(0, 65536, archive.FRAME_PIXELS).astype('>u2')
+
+def write_frames(thermal_dir, frames):
+    os.makedirs(thermal_dir)
+    for (i, (name, data)) in enumerate(frames):
+        fname = os.path.join(thermal_dir, name)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        os.utime(fname, (1000.0 + i, 1000.0 + i))
+
+def test_round_trip(tmp_path):
+    thermal_dir = str(tmp_path / 'thermal')
+    frames = [('IR_000001.raw', smooth_frame().tobytes()),
+              ('IR_000002.raw', b'\x01\x02' * 1000),
+              ('IR_000003.raw', random_frame().tobytes())]
+    write_frames(thermal_dir, frames)
+    archive_file = str(tmp_path / 'thermal.fta')
+    assert archive.create_archive(thermal_dir, archive_file) == 3
+
+    arc = archive.ThermalArchive(archive_file)
+    assert arc.names == [f[0] for f in frames]
+    assert list(arc.mtimes) == [1000.0, 1001.0, 1002.0]
+    for (i, (name, data)) in enumerate(frames):
+        assert arc.find(os.path.join(archive_file, name)) == i
+        assert arc.read_bytes(i) == data
+    assert arc.index['flags'][0] & archive.FLAG_HIGH_SPARSE
+    assert not arc.index['flags'][2] & archive.FLAG_HIGH_SPARSE
+    assert arc.load_raw(1) is None
+    out = np.zeros(archive.FRAME_PIXELS, dtype=np.uint16)
+    assert arc.load_raw(2, out) is out
+    assert np.array_equal(out, random_frame())
+    arc.close()
+
+    out_dir = str(tmp_path / 'extracted')
+    assert archive.extract_archive(archive_file, out_dir) == 3
+    for (name, data) in frames:
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            assert f.read() == data
+
+def test_long_name(tmp_path):
+    thermal_dir = str(tmp_path / 'thermal')
+    name = 'IR_' + 'x' * archive.MAX_NAME_BYTES + '.raw'
+    write_frames(thermal_dir, [(name, smooth_frame().tobytes())])
+    archive_file = str(tmp_path / 'thermal.fta')
+    with pytest.raises(ValueError):
+        archive.create_archive(thermal_dir, archive_file)
+    assert not os.path.exists(archive_file)
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+'''
+chunked lossless archive of raw SIYI thermal frames
+
+this is a wrapper around the firedrones archive command
+'''
+
+import sys
+
+from firedrones.cli import main
+
+if __name__ == '__main__':
+    main(['archive'] + sys.argv[1:])
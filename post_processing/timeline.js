@@ -16,10 +16,35 @@ var rgb_viewport = null;
 // treat a map click as a warp request if below this threshold
 var map_click_dist_threshold = 25.0;
 
+/*
+  thermal thumbnail sprite sheets, from thumbnails/thumbnails.json
+  */
+var thumbnails_json = null;
+var thumbnail_images = {};
+
+/*
+  when served by viewer_server.py the flight data is loaded a time
+  window at a time from the api, otherwise all of flight.json is loaded
+  */
+var flight_summary = null;
+var flight_window = null;
+var flight_window_seconds = 600;
+var flight_window_loading = false;
+
+/*
+  with viewer_server.py --live the summary has live set and records
+  arrive over a WebSocket, appended to flight_json with the map
+  following the newest record
+  */
+var live_socket = null;
+
 /*
   get time flight started, based on flight.json
   */
 function get_flight_start() {
+    if (flight_summary) {
+	return new Date(flight_summary.start*1000);
+    }
     return new Date(flight_json[0].timestamp*1000);
 }
 
@@ -27,6 +52,9 @@ function get_flight_start() {
   get time flight ended, based on flight.json
   */
 function get_flight_end() {
+    if (flight_summary) {
+	return new Date(flight_summary.end*1000);
+    }
     return new Date(flight_json[flight_json.length-1].timestamp*1000);
 }
 
@@ -34,7 +62,7 @@ function get_flight_end() {
   get flight json record for a given timestamp, takes a Date object
 */
 function get_data_for_timestamp(js_timestamp) {
-    if (!flight_json) {
+    if (!flight_json || flight_json.length == 0) {
 	return null;
     }
     var idx_low = 0;
@@ -51,6 +79,40 @@ function get_data_for_timestamp(js_timestamp) {
     return flight_json[idx_low];
 }
 
+/*
+  load the window of flight data around a js_timestamp from the api
+*/
+function load_flight_window(js_timestamp) {
+    if (flight_window_loading) {
+	return;
+    }
+    var t = js_timestamp.getTime()*0.001;
+    var t0 = t - flight_window_seconds;
+    var t1 = t + flight_window_seconds;
+    flight_window_loading = true;
+    fetch(`api/flight?t0=${t0}&t1=${t1}`).then(obj => obj.json()).then(json => {
+	flight_json = json;
+	flight_window = [t0, t1];
+	flight_window_loading = false;
+    }).catch(err => { flight_window_loading = false; });
+}
+
+/*
+  reload the flight data window if js_timestamp is getting close to its edge
+*/
+function check_flight_window(js_timestamp) {
+    if (!flight_summary || flight_summary.live || !js_timestamp) {
+	return;
+    }
+    var t = js_timestamp.getTime()*0.001;
+    var margin = flight_window_seconds/4;
+    if (flight_window == null ||
+	(t < flight_window[0] + margin && flight_window[0] > flight_summary.start) ||
+	(t > flight_window[1] - margin && flight_window[1] < flight_summary.end)) {
+	load_flight_window(js_timestamp);
+    }
+}
+
 /*
   find the timestamp closest to the given latlon, returns a js Date object
 */
@@ -91,16 +153,158 @@ function warp_map_to_timestamp(js_timestamp) {
 }
 
 /*
-  warp playback time of videos to a js_timestamp
+  find the PTS of the last keyframe at or before a js_timestamp from a
+  keyframe map, or null if the timestamp is before the first keyframe
+  */
+function get_keyframe_pts(keyframe_map, js_timestamp) {
+    var keyframes = keyframe_map.keyframes;
+    var t = js_timestamp.getTime()*0.001;
+    var idx_low = 0;
+    var idx_high = keyframes.length;
+    while (idx_low < idx_high) {
+	var mid = Math.floor((idx_low + idx_high) / 2);
+	if (keyframes[mid][0] <= t) {
+	    idx_low = mid+1;
+	} else {
+	    idx_high = mid;
+	}
+    }
+    if (idx_low == 0) {
+	return null;
+    }
+    return keyframes[idx_low-1][1];
+}
+
+/*
+  warp playback time of videos to a js_timestamp. Videos encoded with
+  the web profile have keyframes on the same wall clock seconds, so they
+  are all seeked to the keyframe at or before the timestamp, which shows
+  the same instant in every video without decoding up to the seek point
   */
 function warp_videos_to_timestamp(js_timestamp) {
     for (let i = 0; i < video_list.length; i++) {
 	var video = document.getElementById(video_list[i].video_id);
 	var seek_seconds = (js_timestamp - video_list[i].start_time)*0.001;
+	if (video_list[i].keyframe_map) {
+	    var pts = get_keyframe_pts(video_list[i].keyframe_map, js_timestamp);
+	    if (pts != null) {
+		seek_seconds = pts;
+	    }
+	}
 	video.currentTime = seek_seconds;
     }
 }
 
+/*
+  load the keyframe maps of videos encoded with the web profile, once
+  the video list has been set by the map initialisation
+  */
+var keyframe_maps_loaded = false;
+function load_keyframe_maps() {
+    if (keyframe_maps_loaded || typeof video_list === 'undefined') {
+	return;
+    }
+    keyframe_maps_loaded = true;
+    for (let i = 0; i < video_list.length; i++) {
+	if (video_list[i].keyframes) {
+	    fetch(video_list[i].keyframes).then(obj => obj.json()).then(json => {
+		video_list[i].keyframe_map = json;
+	    }).catch(err => {});
+	}
+    }
+}
+
+/*
+  find index of the last thumbnail at or before a js_timestamp
+  */
+function get_thumbnail_index(js_timestamp) {
+    var timestamps = thumbnails_json.timestamps;
+    var t = js_timestamp.getTime()*0.001;
+    var idx_low = 0;
+    var idx_high = timestamps.length - 1;
+    while (idx_low < idx_high) {
+	var mid = Math.ceil((idx_low + idx_high) / 2);
+	if (timestamps[mid] <= t) {
+	    idx_low = mid;
+	} else {
+	    idx_high = mid-1;
+	}
+    }
+    return idx_low;
+}
+
+/*
+  show the thermal thumbnail for a js_timestamp, this only moves the
+  background of the thumbnail div within an already loaded sprite sheet
+  */
+function warp_thumbnail_to_timestamp(js_timestamp) {
+    if (!thumbnails_json || !js_timestamp) {
+	return;
+    }
+    var el = document.getElementById("thermal_thumb");
+    if (!el) {
+	return;
+    }
+    var level = thumbnails_json.levels[get_thumbnail_level(el)];
+    var idx = get_thumbnail_index(js_timestamp);
+    var sheet = Math.floor(idx / level.per_sheet);
+    var tile = idx % level.per_sheet;
+    // the div is drawn at its displayed size, which may differ from the level
+    var scale = el.clientWidth / level.width;
+    var x = (tile % level.cols) * level.width * scale;
+    var y = Math.floor(tile / level.cols) * level.height * scale;
+    el.style.backgroundImage = `url(${level.sheets[sheet]})`;
+    el.style.backgroundSize = `${level.cols * level.width * scale}px auto`;
+    el.style.backgroundPosition = `-${x}px -${y}px`;
+}
+
+/*
+  the smallest thumbnail level with at least the displayed resolution of
+  the thumbnail div, the levels run from largest to smallest
+  */
+function get_thumbnail_level(el) {
+    var width = el.clientWidth * (window.devicePixelRatio || 1);
+    var levels = thumbnails_json.levels;
+    for (let i = levels.length-1; i > 0; i--) {
+	if (levels[i].width >= width) {
+	    return i;
+	}
+    }
+    return 0;
+}
+
+/*
+  preload the sprite sheets of the level for the displayed thumbnail size
+  */
+function preload_thumbnails() {
+    var el = document.getElementById("thermal_thumb");
+    if (!thumbnails_json || !el) {
+	return;
+    }
+    var level = get_thumbnail_level(el);
+    if (level in thumbnail_images) {
+	return;
+    }
+    thumbnail_images[level] = [];
+    var sheets = thumbnails_json.levels[level].sheets;
+    for (let i = 0; i < sheets.length; i++) {
+	var img = new Image();
+	img.src = sheets[i];
+	thumbnail_images[level].push(img);
+    }
+}
+
+/*
+  callback to set thumbnails_json, preloading the sprite sheets
+  */
+function set_thumbnails_json(json) {
+    thumbnails_json = json;
+    preload_thumbnails();
+}
+
+// a resize can change the thumbnail level shown
+window.addEventListener('resize', preload_thumbnails);
+
 /*
   create and display the timeline object
   */
@@ -129,6 +333,15 @@ function create_timeline() {
 	var timestamp = properties.time;
 	handle_timeline_click(timestamp);
     });
+
+    // draggable time marker for scrubbing the thermal thumbnails
+    timeline.addCustomTime(get_flight_start(), 'scrub');
+    timeline.on('timechange', function (properties) {
+	warp_thumbnail_to_timestamp(properties.time);
+    });
+    timeline.on('timechanged', function (properties) {
+	handle_timeline_click(properties.time);
+    });
 }
 
 /*
@@ -152,6 +365,7 @@ function check_video_playback() {
 	var js_timestamp = new Date(video_list[i].start_time);
 	js_timestamp.setSeconds(js_timestamp.getSeconds() + video.currentTime);
 	warp_map_to_timestamp(js_timestamp);
+	warp_thumbnail_to_timestamp(js_timestamp);
 	current_timestamp = new Date(js_timestamp);
 	break;
     }
@@ -163,7 +377,10 @@ function check_video_playback() {
 function update_viewports() {
     var js_timestamp = current_timestamp;
     var p = get_data_for_timestamp(js_timestamp);
-    var rgb_corners = get_viewport_corners(p, 88.0, 2560.0/1440.0)
+    if (!p) {
+	return;
+    }
+    var rgb_corners = get_viewport_corners(p, 88.0, 2560.0/1440.0, p.rgb_corners)
     if (rgb_viewport == null) {
 	rgb_viewport = new google.maps.Polygon({
 	    paths: rgb_corners,
@@ -177,7 +394,7 @@ function update_viewports() {
     } else {
 	rgb_viewport.setPaths(rgb_corners);
     }
-    var thermal_corners = get_viewport_corners(p, 22.8, 640.0/512.0)
+    var thermal_corners = get_viewport_corners(p, 22.8, 640.0/512.0, p.thermal_corners)
     if (thermal_viewport == null) {
 	thermal_viewport = new google.maps.Polygon({
 	    paths: thermal_corners,
@@ -200,6 +417,9 @@ function update_viewports() {
 function update_status() {
     var js_timestamp = current_timestamp;
     var p = get_data_for_timestamp(js_timestamp);
+    if (!p) {
+	return;
+    }
     var status = `
 <table>
 <tr>
@@ -220,8 +440,8 @@ SlantRange: ${p.SR.toFixed(1)}
 <tr>
 <td>
 <h2>Thermal</h2>
-TMin: ${p.TMin.toFixed(1)}<br>
-TMax: ${p.TMax.toFixed(1)}<br>
+TMin: ${p.TMin !== undefined ? p.TMin.toFixed(1) : "unknown"}<br>
+TMax: ${p.TMax !== undefined ? p.TMax.toFixed(1) : "unknown"}<br>
 </td>
 </tr>
 </table>
@@ -233,7 +453,9 @@ TMax: ${p.TMax.toFixed(1)}<br>
   handle 1Hz timer update
 */
 function handle_timer_update() {
+    load_keyframe_maps();
     check_video_playback();
+    check_flight_window(current_timestamp);
     update_status();
     update_viewports();
 }
@@ -243,7 +465,9 @@ function handle_timer_update() {
   */
 function handle_timeline_click(js_timestamp) {
     current_timestamp = new Date(js_timestamp);
+    check_flight_window(current_timestamp);
     warp_map_to_timestamp(js_timestamp);
+    warp_thumbnail_to_timestamp(js_timestamp);
     warp_videos_to_timestamp(js_timestamp);
 }
 
@@ -254,8 +478,41 @@ function handle_timeline_click(js_timestamp) {
   */
 function handle_map_click(mapsMouseEvent) {
     var latlon = mapsMouseEvent.latLng;
+    if (flight_summary && !flight_summary.live) {
+	handle_map_click_api(latlon);
+	return;
+    }
     var js_timestamp = get_timestamp_for_latlon(latlon);
+    warp_to_timestamp(js_timestamp);
+}
+
+/*
+  handle a map click using a bounding box query on the api, so the
+  whole flight is searched not just the loaded window
+  */
+function handle_map_click_api(latlon) {
+    // approx degrees for map_click_dist_threshold
+    var d = map_click_dist_threshold / 111000.0;
+    var dlon = d / Math.max(Math.cos(radians(latlon.lat())), 0.01);
+    var bbox = `${latlon.lat()-d},${latlon.lng()-dlon},${latlon.lat()+d},${latlon.lng()+dlon}`;
+    fetch(`api/flight?bbox=${bbox}`).then(obj => obj.json()).then(json => {
+	var saved_json = flight_json;
+	flight_json = json;
+	var js_timestamp = get_timestamp_for_latlon(latlon);
+	flight_json = saved_json;
+	if (js_timestamp != null) {
+	    check_flight_window(js_timestamp);
+	    warp_to_timestamp(js_timestamp);
+	}
+    });
+}
+
+/*
+  warp all UI elements to a js_timestamp
+  */
+function warp_to_timestamp(js_timestamp) {
     current_timestamp = new Date(js_timestamp);
+    warp_thumbnail_to_timestamp(js_timestamp);
     warp_videos_to_timestamp(js_timestamp);
     warp_map_to_timestamp(js_timestamp);
 }
@@ -266,6 +523,53 @@ function set_status_text(text) {
 }
 
 
+/*
+  callback to set flight_summary from the api, loading the first window
+  */
+function set_flight_summary(json) {
+    flight_summary = json;
+    current_timestamp = get_flight_start();
+    if (flight_summary.live) {
+	start_live();
+    } else {
+	load_flight_window(current_timestamp);
+    }
+    create_timeline();
+}
+
+/*
+  open the live telemetry WebSocket, the server sends the buffered
+  records first then new records as they arrive
+  */
+function start_live() {
+    flight_json = [];
+    var proto = (window.location.protocol == 'https:') ? 'wss:' : 'ws:';
+    var path = window.location.pathname.replace(/[^\/]*$/, '');
+    live_socket = new WebSocket(`${proto}//${window.location.host}${path}api/live`);
+    live_socket.onmessage = function(event) {
+	handle_live_update(JSON.parse(event.data));
+    };
+}
+
+/*
+  append live records, keeping as many as the server buffers, and move
+  the map, status and viewports to the newest record
+  */
+function handle_live_update(msg) {
+    if (msg.records.length == 0) {
+	return;
+    }
+    flight_json = flight_json.concat(msg.records);
+    if (flight_json.length > flight_summary.capacity) {
+	flight_json = flight_json.slice(flight_json.length - flight_summary.capacity);
+    }
+    flight_summary.end = flight_json[flight_json.length-1].timestamp;
+    current_timestamp = new Date(flight_summary.end*1000);
+    warp_map_to_timestamp(current_timestamp);
+    update_status();
+    update_viewports();
+}
+
 /*
   callback to set flight_json variable from flight.json
   */
@@ -274,8 +578,18 @@ function set_flight_json(json) {
     create_timeline();
 }
 
-// load flight.json
-fetch('flight.json').then(obj => obj.json()).then(json => set_flight_json(json));
+// use the viewer_server.py api if available, otherwise load all of flight.json
+fetch('api/summary').then(obj => {
+    if (!obj.ok) {
+	throw new Error('no api');
+    }
+    return obj.json();
+}).then(json => set_flight_summary(json)).catch(err => {
+    fetch('flight.json').then(obj => obj.json()).then(json => set_flight_json(json));
+});
+
+// load thumbnails.json if thumbnails were generated
+fetch('thumbnails/thumbnails.json').then(obj => obj.json()).then(json => set_thumbnails_json(json)).catch(err => {});
 
 // call check_video_playback at 1Hz
 window.setInterval(function(){ handle_timer_update() }, 1000);
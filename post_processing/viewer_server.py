@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+'''
+local viewer server for a flight directory
+
+this is a wrapper around the firedrones serve command
+'''
+
+import sys
+
+from firedrones.cli import main
+
+if __name__ == '__main__':
+    main(['serve'] + sys.argv[1:])